@@ -0,0 +1,107 @@
+"""
+Startup time benchmark for the olfactometry package.
+
+Each case is imported in a fresh interpreter, so nothing is cached between runs. The median import time is reported,
+along with whether the case pulled in PyQt4. The script exits with status 1 if a headless case imports PyQt4 or if a
+case takes longer than its budget, so it can be used to guard against startup time regressions:
+
+    python benchmarks/import_time.py --repeat 20 --budget 0.25
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (name, statement, headless). Headless cases must not import PyQt4.
+CASES = (('package', 'import olfactometry', True),
+         ('utils', 'from olfactometry import get_olfa_config, flatten_dictionary', True),
+         ('core', 'from olfactometry.core import OlfactometerRig', True),
+         ('gui', 'from olfactometry import Olfactometers', False))
+
+_TIMER = """
+import sys, time, json
+sys.path.insert(0, {repo!r})
+t = time.time()
+{statement}
+elapsed = time.time() - t
+print(json.dumps({{'elapsed': elapsed, 'qt': 'PyQt4' in sys.modules, 'modules': len(sys.modules)}}))
+"""
+
+
+def time_import(statement, python=sys.executable):
+    """
+    Times one import statement in a new interpreter.
+
+    :param statement: python import statement.
+    :param python: python executable to use.
+    :return: dictionary with the elapsed time (s), whether PyQt4 was imported and the number of loaded modules, or
+    None if the import failed (ie a dependency is not installed).
+    """
+    code = _TIMER.format(repo=REPO_DIR, statement=statement)
+    proc = subprocess.Popen([python, '-c', code], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    if proc.returncode:
+        return None
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def run(repeat=10, python=sys.executable):
+    """
+    :param repeat: number of fresh interpreters per case.
+    :return: list of result dictionaries, one per case.
+    """
+    results = []
+    for name, statement, headless in CASES:
+        runs = [time_import(statement, python) for _ in xrange(repeat)]
+        runs = [r for r in runs if r is not None]
+        if not runs:
+            results.append({'case': name, 'headless': headless, 'skipped': True})
+            continue
+        times = sorted(r['elapsed'] for r in runs)
+        results.append({'case': name,
+                        'headless': headless,
+                        'skipped': False,
+                        'median': times[len(times) // 2],
+                        'max': times[-1],
+                        'qt': any(r['qt'] for r in runs),
+                        'modules': runs[-1]['modules']})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures olfactometry import time.')
+    parser.add_argument('--repeat', type=int, default=10, help='fresh interpreters per case.')
+    parser.add_argument('--budget', type=float, default=None,
+                        help='maximum median import time in seconds for headless cases.')
+    parser.add_argument('--json', action='store_true', help='print results as JSON.')
+    args = parser.parse_args()
+
+    results = run(args.repeat)
+    failures = []
+    for r in results:
+        if r['skipped']:
+            continue
+        if r['headless'] and r['qt']:
+            failures.append('{0}: imported PyQt4'.format(r['case']))
+        if r['headless'] and args.budget is not None and r['median'] > args.budget:
+            failures.append('{0}: median {1:.4f} s is over budget ({2:.4f} s)'.format(r['case'], r['median'],
+                                                                                    args.budget))
+    if args.json:
+        print(json.dumps({'results': results, 'failures': failures}, indent=2))
+    else:
+        for r in results:
+            if r['skipped']:
+                print('{0:<10} skipped (import failed, missing dependency?)'.format(r['case']))
+            else:
+                print('{case:<10} median {median:8.4f} s   max {max:8.4f} s   modules {modules:4d}   qt {qt}'.format(**r))
+        for f in failures:
+            print('FAIL ' + f)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,234 @@
+"""
+End to end latency benchmark for stimulus delivery.
+
+Builds an OlfactometerRig of simulated olfactometers (see olfactometry/simulator.py) and times the control entry
+points: set_stimulus, run_stimulus_plan (precompiled stimuli), set_odors, set_vial, set_flows, set_dummy_vials and MFC
+polling. For each entry point, p50, p99 and max latency are reported along with the number of serial commands sent per
+call.
+
+    python benchmarks/stimulus_latency.py --olfas 4 --dilutors 1 --global-dilutors 1 --json results.json
+
+Background MFC polling is paused and flow checking is disabled while timing, so that the latencies and command counts
+only include the work done by the entry point itself. The valve lockout is also disabled so vials can be reopened
+immediately.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from olfactometry.core import OlfactometerRig
+
+ODORS = ('pinene', 'limonene', 'menthone', 'acetophenone')
+
+
+def build_config(n_olfas=1, n_dilutors=0, n_global_dilutors=0, simulator=None):
+    """
+    :param n_olfas: number of olfactometers.
+    :param n_dilutors: number of dilutors attached to each olfactometer.
+    :param n_global_dilutors: number of global dilutors.
+    :param simulator: "simulator" configuration object used for every device.
+    :return: configuration dictionary of simulated devices.
+    """
+    simulator = simulator or {}
+
+    def dilutor():
+        return {'dilutor_type': 'serial_forwarding',
+                'simulator': simulator,
+                'MFCs': [{'MFC_type': 'alicat_digital_raw', 'address': 'A', 'capacity': 2000, 'gas': 'vac'},
+                         {'MFC_type': 'alicat_digital_raw', 'address': 'B', 'capacity': 2000, 'gas': 'Air'}]}
+
+    vials = {'4': {'odor': 'dummy', 'conc': 0}}
+    for i, odor in enumerate(ODORS):
+        vials[str(i + 5)] = {'odor': odor, 'conc': 0.01}
+    olfas = []
+    for i in xrange(n_olfas):
+        olfas.append({'slave_index': 1,
+                      'com_port': 'bench{0}'.format(i),
+                      'simulator': simulator,
+                      'MFCs': [{'MFC_type': 'alicat_digital', 'capacity': 1000, 'gas': 'Air', 'address': 'A',
+                                'arduino_port_num': 1},
+                               {'MFC_type': 'alicat_digital', 'capacity': 100, 'gas': 'Nitrogen', 'address': 'A',
+                                'arduino_port_num': 2}],
+                      'Dilutors': [dilutor() for _ in xrange(n_dilutors)],
+                      'Vials': vials})
+    return {'Olfactometers': olfas, 'Dilutors': [dilutor() for _ in xrange(n_global_dilutors)]}
+
+
+def stimulus(rig, trial):
+    """
+    :return: stimulus dictionary for the rig that changes all flows and the odor on every trial.
+    """
+    stim = {'olfas': {}}
+    for i, olfa in enumerate(rig.olfas):
+        o = {'odor': ODORS[(trial + i) % len(ODORS)],
+             'vialconc': 0.01,
+             'mfc_0_flow': 900 + trial % 2 * 50,
+             'mfc_1_flow': 50 + trial % 2 * 10,
+             'dilutors': {}}
+        for j in xrange(len(olfa.dilutors)):
+            o['dilutors']['dilutor_{0}'.format(j)] = {'vac_flow': 1000 + trial % 2 * 100, 'air_flow': 900}
+        stim['olfas']['olfa_{0}'.format(i)] = o
+    if rig.dilutors:
+        stim['dilutors'] = {}
+        for j in xrange(len(rig.dilutors)):
+            stim['dilutors']['dilutor_{0}'.format(j)] = {'vac_flow': 1000 + trial % 2 * 100, 'air_flow': 900}
+    return stim
+
+
+def transports(rig):
+    for olfa in rig.olfas:
+        yield olfa.transport
+        for d in olfa.dilutors:
+            yield d.transport
+    for d in rig.dilutors:
+        yield d.transport
+
+
+def commands_sent(rig):
+    return sum(t.commands_sent for t in transports(rig))
+
+
+def percentile(sorted_values, p):
+    """
+    Nearest rank percentile.
+    """
+    k = max(int(round(p / 100. * len(sorted_values) + .5)) - 1, 0)
+    return sorted_values[min(k, len(sorted_values) - 1)]
+
+
+def measure(rig, name, fn, setup, repeat):
+    """
+    Times fn(trial) repeat times. setup(trial) is called before each call and is not timed.
+
+    :return: result dictionary.
+    """
+    latencies = []
+    counts = []
+    successes = 0
+    for trial in xrange(repeat):
+        if setup is not None:
+            setup(trial)
+        n = commands_sent(rig)
+        t = time.time()
+        success = fn(trial)
+        latencies.append(time.time() - t)
+        counts.append(commands_sent(rig) - n)
+        successes += bool(success) or success is None
+    latencies.sort()
+    return {'entry_point': name,
+            'calls': repeat,
+            'successes': successes,
+            'p50_ms': percentile(latencies, 50) * 1000.,
+            'p99_ms': percentile(latencies, 99) * 1000.,
+            'max_ms': latencies[-1] * 1000.,
+            'mean_ms': sum(latencies) / len(latencies) * 1000.,
+            'commands_per_call': sum(counts) / float(len(counts)),
+            'max_commands_per_call': max(counts)}
+
+
+def run(rig, repeat=100):
+    """
+    Runs all entry points on the rig.
+
+    :return: list of result dictionaries.
+    """
+    for olfa in rig.olfas:
+        olfa.stop_mfc_polling()
+        olfa.valve_lockout = 0.
+        olfa.all_off()  # clears the lockout started at startup.
+        for d in olfa.dilutors:
+            d.stop_mfc_polling()
+    for d in rig.dilutors:
+        d.stop_mfc_polling()
+    rig.set_check_flows(False)
+    olfa = rig.olfas[0]
+
+    def close_vials(trial):
+        rig.set_dummy_vials()
+
+    def open_vials(trial):
+        rig.set_dummy_vials()
+        rig.set_odors([ODORS[trial % len(ODORS)]] * len(rig.olfas), concs=[0.01] * len(rig.olfas))
+
+    def poll(trial):
+        for o in rig.olfas:
+            o._poll_mfcs()
+
+    plans = [rig.compile_stimulus(stimulus(rig, trial)) for trial in xrange(len(ODORS))]  # stimuli repeat every 4.
+    flows = lambda trial: [(900 + trial % 2 * 50, 50 + trial % 2 * 10)] * len(rig.olfas)
+    results = [measure(rig, 'set_stimulus', lambda trial: rig.set_stimulus(stimulus(rig, trial)), close_vials, repeat),
+               measure(rig, 'run_stimulus_plan', lambda trial: rig.run_stimulus_plan(plans[trial % len(plans)]),
+                       close_vials, repeat),
+               measure(rig, 'set_odors', lambda trial: rig.set_odors([ODORS[trial % len(ODORS)]] * len(rig.olfas),
+                                                                     concs=[0.01] * len(rig.olfas)),
+                       close_vials, repeat),
+               measure(rig, 'set_vial', lambda trial: olfa.set_vial(5 + trial % len(ODORS), 1), close_vials, repeat),
+               measure(rig, 'set_dummy_vials', lambda trial: rig.set_dummy_vials(), open_vials, repeat),
+               measure(rig, 'set_flows', lambda trial: rig.set_flows(flows(trial)), None, repeat),
+               measure(rig, 'poll_mfcs', poll, None, repeat)]
+    rig.set_dummy_vials()
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures stimulus delivery latency against simulated devices.')
+    parser.add_argument('--olfas', type=int, default=1, help='number of olfactometers.')
+    parser.add_argument('--dilutors', type=int, default=0, help='dilutors attached to each olfactometer.')
+    parser.add_argument('--global-dilutors', type=int, default=0, help='number of global dilutors.')
+    parser.add_argument('--repeat', type=int, default=100, help='calls per entry point.')
+    parser.add_argument('--latency', type=float, default=.001, help='simulated command latency (s).')
+    parser.add_argument('--jitter', type=float, default=.0005, help='simulated latency jitter (s).')
+    parser.add_argument('--alicat-latency', type=float, default=.005, help='simulated Alicat reply time (s).')
+    parser.add_argument('--drop-rate', type=float, default=0., help='fraction of simulated replies dropped.')
+    parser.add_argument('--seed', type=int, default=0, help='simulator random seed.')
+    parser.add_argument('--json', default='', help='write results to this file ("-" for stdout).')
+    args = parser.parse_args()
+
+    simulator = {'latency': args.latency, 'jitter': args.jitter, 'alicat_latency': args.alicat_latency,
+                 'drop_rate': args.drop_rate, 'seed': args.seed, 'initial_flow': .5}
+    config = build_config(args.olfas, args.dilutors, args.global_dilutors, simulator)
+    rig = OlfactometerRig(config)
+    try:
+        results = run(rig, args.repeat)
+    finally:
+        rig.close_serials()
+
+    report = {'revision': git_revision(),
+              'python': platform.python_version(),
+              'olfas': args.olfas,
+              'dilutors': args.dilutors,
+              'global_dilutors': args.global_dilutors,
+              'repeat': args.repeat,
+              'simulator': simulator,
+              'results': results}
+    if args.json == '-':
+        print(json.dumps(report, indent=2))
+        return 0
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    print('{0:<18} {1:>9} {2:>9} {3:>9} {4:>10} {5:>6}'.format('entry point', 'p50 ms', 'p99 ms', 'max ms',
+                                                               'commands', 'ok'))
+    for r in results:
+        print('{entry_point:<18} {p50_ms:9.2f} {p99_ms:9.2f} {max_ms:9.2f} {commands_per_call:10.1f} '
+              '{successes:3d}/{calls:<3d}'.format(**r))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -15,6 +15,7 @@
 #define MODE_DIGITAL 13
 #define SET_D_MFC    14
 #define READ_D_MFC   15
+#define POLL_D_MFC   16
 
 #define OFF 0
 #define ON  1
@@ -35,6 +36,69 @@ int arg1, arg2, arg3;
 uint8_t i2cBuffer[64];
 int resp;
 
+// Binary framing. Frames are accepted as well as ASCII command lines, so the
+// PC can use either. A frame is:
+//   0xA5 <LEN> <SEQ> <OPCODE> <LEN payload bytes> <CRC16 high> <CRC16 low>
+// The CRC (CCITT, initial value 0xFFFF) covers LEN, SEQ, OPCODE and the
+// payload. The reply is a frame with the same SEQ, OPCODE | 0x80 and a
+// payload of the 16 bit status (low byte first, 0 is OK, otherwise the code
+// printed as "Error <code>" in ASCII) followed by the reply data. A frame
+// with a bad CRC is answered with a FRAME_NAK frame with status -4.
+// The opcodes are the command definitions above:
+//   SET_VIAL    <DEVICE> <N> <STATE>
+//   SET_MFC     <DEVICE> <N> <VALUE LOW> <VALUE HIGH>, value = 0..65535
+//   READ_MFC    <DEVICE> <N>          -> <VALUE LOW> <VALUE HIGH>
+//   VIAL_ON     <DEVICE> <N>
+//   VIAL_OFF    <DEVICE> <N>
+//   SET_D_MFC   <DEVICE> <N> <ASCII command>
+//   READ_D_MFC  <DEVICE> <N>          -> <ASCII data frame>
+//   POLL_D_MFC  <DEVICE> <N> <ADDRESS> [<N> <ADDRESS>]
+//                                     -> <N>:<reply>[;<N>:<reply>]
+// The "protocol" ASCII command replies "protocol binary 1" so the PC can
+// check that framing is supported.
+#define FRAME_SYNC    0xA5
+#define FRAME_REPLY   0x80
+#define FRAME_NAK     0x7F
+#define FRAME_MAX     160
+#define FRAME_TIMEOUT 100   // ms to receive a whole frame.
+
+// LEN, SEQ, OPCODE, payload and CRC of the frame being received.
+uint8_t frame[FRAME_MAX + 5];
+// 0 when no frame is being received, otherwise 1 + the bytes received.
+uint16_t frameIdx = 0;
+uint32_t frameStart = 0;
+// Reply data of frames and reply of DMFCpoll.
+char replyBuffer[FRAME_MAX];
+
+// Stimulus sequences. A schedule of vial and MFC steps is uploaded with
+// seqAdd and started with seqRun. The steps are executed on the Teensy clock,
+// so their timing does not depend on the PC. Each executed step is reported
+// with an unsolicited line that starts with '!', so that the PC can tell it
+// apart from the replies to its commands:
+//   !seq <INDEX> <T> <STATUS>    T is the time in ms since seqRun and STATUS
+//                                is 0 or the error code of the step.
+//   !seqDone <N>                 all N steps have been executed.
+#define SEQ_MAX_STEPS 32
+#define SEQ_MAX_ARG   16
+
+struct SeqStep {
+  uint32_t time;          // ms after seqRun.
+  uint8_t device;
+  uint8_t command;        // VIAL_ON, VIAL_OFF, SET_VIAL, SET_MFC or SET_D_MFC.
+  uint8_t n;              // vial or MFC number.
+  char arg[SEQ_MAX_ARG];  // "on"/"off", MFC value or MFC command string.
+  uint32_t doneTime;      // ms after seqRun when the step was executed.
+  int result;
+};
+
+SeqStep seqSteps[SEQ_MAX_STEPS];
+uint8_t seqLen = 0;       // number of steps uploaded.
+uint8_t seqNext = 0;      // next step to execute.
+uint8_t seqReported = 0;  // next step to report.
+bool seqRunning = false;
+bool seqError = false;    // a step could not be added, so seqRun is refused.
+uint32_t seqStart = 0;
+
 // Parse a line into words and store those words in argv array.
 void parse(char *line, char **argv, uint8_t maxArgs) {
   uint8_t argCount = 0;
@@ -347,6 +411,65 @@ int SetDMFC(uint8_t deviceAddr, uint8_t MFCNum, char *command) {
 	return 0;    // all OK
 }
 
+// Removes trailing carriage returns and line feeds from a string.
+void StripEOL(char *s) {
+  int len = strlen(s);
+  while (len > 0 && (s[len - 1] == '\r' || s[len - 1] == '\n'))
+    s[--len] = '\0';
+}
+
+// This function polls several digital MFCs in one go. Each MFC is given as
+// a pair of MFC number and Alicat address (ie "1 A 2 A"). The poll requests
+// are forwarded to all the MFCs first, so the Alicats reply concurrently, and
+// then each reply is read back. The replies are written to reply as:
+//   <N>:<reply>;<N>:<reply>
+// where <reply> is the Alicat data frame or "Error <code>".
+// Returns 0 iff all the arguments are sane.
+int PollDMFCs(uint8_t deviceAddr, char **args, char *reply, uint16_t size) {
+  uint8_t mfcs[2];
+  uint8_t nmfcs = 0;
+  int tries;
+  int len;
+  // Check to make sure the arguments are sane
+  if (deviceAddr > 127)
+    return -1;
+  while (nmfcs < 2 && args[2 * nmfcs] && strlen(args[2 * nmfcs]) > 0
+         && args[2 * nmfcs + 1] && strlen(args[2 * nmfcs + 1]) > 0) {
+    mfcs[nmfcs] = (uint8_t)atoi(args[2 * nmfcs]);
+    if (mfcs[nmfcs] == 0 || mfcs[nmfcs] > 2)
+      return -1;
+    nmfcs++;
+  }
+  if (nmfcs == 0)
+    return -1;
+
+  // Flush any stale reply and ask every MFC for a data frame.
+  for (uint8_t i = 0; i < nmfcs; i++) {
+    ReadDMFC(deviceAddr, mfcs[i]);
+    SetDMFC(deviceAddr, mfcs[i], args[2 * i + 1]);
+  }
+  reply[0] = '\0';
+  for (uint8_t i = 0; i < nmfcs; i++) {
+    len = strlen(reply);
+    snprintf(reply + len, size - len, i > 0 ? ";%d:" : "%d:", mfcs[i]);
+    tries = 0;
+    // -2 means that the Alicat has not replied yet.
+    while ((resp = ReadDMFC(deviceAddr, mfcs[i])) == -2 && tries++ < 50) {
+      delay(2);
+      SeqUpdate();
+    }
+    len = strlen(reply);
+    if (resp) {
+      snprintf(reply + len, size - len, "Error %d", resp);
+    } else {
+      // Alicat frames end with a carriage return, which would split the line.
+      StripEOL((char*)i2cBuffer);
+      snprintf(reply + len, size - len, "%s", (char*)i2cBuffer);
+    }
+  }
+  return 0;
+}
+
 // This function will exclusively set a single vial and the dummy vial ON.
 // The arguments to the function is the device address and the vial number.
 int VialOn(uint8_t device, uint8_t vial) {
@@ -513,6 +636,255 @@ int ModeDigital(uint8_t device, uint8_t pin, uint8_t value) {
   return 0;    // all OK
 }
 
+// Adds a step to the sequence. The arguments are the time in ms after
+// seqRun and the words of the command without the device address
+// (ie "vialOn 5" or "DMFC 1 A32000"). Steps must be added in time order.
+// Returns 0 iff the step is sane. If a step is refused, seqRun is refused
+// until the sequence is cleared, so a partial sequence is never run.
+int SeqAdd(uint8_t device, uint32_t time, char **args) {
+  SeqStep *step;
+  if (device > 127 || seqRunning || seqLen >= SEQ_MAX_STEPS)
+    return -1;
+  if (!args[0] || !args[1])
+    return -1;
+  if (seqLen > 0 && time < seqSteps[seqLen - 1].time)
+    return -1;
+  step = &seqSteps[seqLen];
+  step->time = time;
+  step->device = device;
+  step->n = (uint8_t)atoi(args[1]);
+  step->arg[0] = '\0';
+  if (args[2]) {
+    if (strlen(args[2]) >= SEQ_MAX_ARG)
+      return -1;
+    strcpy(step->arg, args[2]);
+  }
+  if (strcmp(args[0], "vialOn") == 0)
+    step->command = VIAL_ON;
+  else if (strcmp(args[0], "vialOff") == 0)
+    step->command = VIAL_OFF;
+  else if (strcmp(args[0], "vial") == 0
+           && (strcmp(step->arg, "on") == 0 || strcmp(step->arg, "off") == 0))
+    step->command = SET_VIAL;
+  else if (strcmp(args[0], "MFC") == 0 && strlen(step->arg) > 0)
+    step->command = SET_MFC;
+  else if (strcmp(args[0], "DMFC") == 0 && strlen(step->arg) > 0)
+    step->command = SET_D_MFC;
+  else
+    return -1;
+  if (step->command == SET_MFC || step->command == SET_D_MFC) {
+    if (step->n == 0 || step->n > 2)
+      return -1;
+  } else if (step->n == 0 || step->n > 16) {
+    return -1;
+  }
+  seqLen++;
+  return 0;
+}
+
+// Executes a single sequence step, as the equivalent serial command would.
+int SeqExecute(SeqStep *step) {
+  int r;
+  switch (step->command) {
+    case VIAL_ON:
+      SetDigital(step->device, (uint8_t)3, (uint8_t)ON);
+      if (!(r = VialOn(step->device, step->n)))
+        SetDigital(step->device, (uint8_t)3, (uint8_t)OFF);
+      return r;
+    case VIAL_OFF:
+      return VialOff(step->device, step->n);
+    case SET_VIAL:
+      if (strcmp(step->arg, "off") == 0)
+        return SetVial(step->device, step->n, (uint8_t)OFF);
+      SetDigital(step->device, (uint8_t)3, (uint8_t)ON);
+      if (!(r = SetVial(step->device, step->n, (uint8_t)ON)))
+        SetDigital(step->device, (uint8_t)3, (uint8_t)OFF);
+      return r;
+    case SET_MFC:
+      return SetMFC(step->device, step->n, atof(step->arg));
+    case SET_D_MFC:
+      return SetDMFC(step->device, step->n, step->arg);
+  }
+  return -1;
+}
+
+// Executes the sequence steps that are due. This is called on every pass of
+// loop() and while waiting for MFCs, so steps are not held up by commands.
+void SeqUpdate() {
+  SeqStep *step;
+  while (seqRunning && seqNext < seqLen
+         && millis() - seqStart >= seqSteps[seqNext].time) {
+    step = &seqSteps[seqNext];
+    step->result = SeqExecute(step);
+    step->doneTime = millis() - seqStart;
+    seqNext++;
+  }
+  if (seqRunning && seqNext >= seqLen)
+    seqRunning = false;
+}
+
+// Reports the executed steps. This is only called between commands, so the
+// reports do not split the echo and reply of a command. The prompt is printed
+// again after the reports.
+void SeqReport() {
+  if (seqReported >= seqNext)
+    return;
+  while (seqReported < seqNext) {
+    Serial.print("!seq ");
+    Serial.print(seqReported);
+    Serial.print(" ");
+    Serial.print(seqSteps[seqReported].doneTime);
+    Serial.print(" ");
+    Serial.println(seqSteps[seqReported].result);
+    seqReported++;
+  }
+  if (!seqRunning && seqReported >= seqLen) {
+    Serial.print("!seqDone ");
+    Serial.println(seqLen);
+  }
+  Serial.print(">");
+}
+
+uint16_t Crc16(uint16_t crc, const uint8_t *data, uint16_t len) {
+  while (len--) {
+    crc ^= (uint16_t)(*data++) << 8;
+    for (uint8_t i = 0; i < 8; i++)
+      crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : (crc << 1);
+  }
+  return crc;
+}
+
+void SendFrame(uint8_t seq, uint8_t opcode, int status, const uint8_t *data, uint8_t len) {
+  uint8_t header[6];
+  uint16_t crc;
+  header[0] = FRAME_SYNC;
+  header[1] = len + 2;
+  header[2] = seq;
+  header[3] = opcode;
+  header[4] = status & 0xff;
+  header[5] = (status >> 8) & 0xff;
+  crc = Crc16(0xFFFF, &header[1], 5);
+  crc = Crc16(crc, data, len);
+  Serial.write(header, 6);
+  if (len)
+    Serial.write(data, len);
+  Serial.write((uint8_t)(crc >> 8));
+  Serial.write((uint8_t)(crc & 0xff));
+}
+
+// Executes a frame and sends the reply frame. The commands do the same as
+// their ASCII equivalents.
+void HandleFrame(uint8_t seq, uint8_t opcode, uint8_t *p, uint8_t len) {
+  int status = -1;
+  uint8_t outLen = 0;
+  char mfcCommand[33];
+  char mfcNums[2][4];
+  char mfcAddrs[2][2];
+  char *pollArgs[5];
+  float value;
+  uint16_t intValue;
+
+  if (len >= 2) {
+    uint8_t device = p[0];
+    uint8_t n = p[1];
+    switch (opcode) {
+      case SET_VIAL:
+        if (len < 3)
+          break;
+        if (p[2]) {
+          SetDigital(device, (uint8_t)3, (uint8_t)ON);
+          if (!(status = SetVial(device, n, (uint8_t)ON)))
+            SetDigital(device, (uint8_t)3, (uint8_t)OFF);
+        } else {
+          status = SetVial(device, n, (uint8_t)OFF);
+        }
+        replyBuffer[0] = p[2];
+        outLen = 1;
+        break;
+      case VIAL_ON:
+        SetDigital(device, (uint8_t)3, (uint8_t)ON);
+        if (!(status = VialOn(device, n)))
+          SetDigital(device, (uint8_t)3, (uint8_t)OFF);
+        break;
+      case VIAL_OFF:
+        status = VialOff(device, n);
+        break;
+      case SET_MFC:
+        if (len < 4)
+          break;
+        intValue = p[2] | ((uint16_t)p[3] << 8);
+        status = SetMFC(device, n, intValue / 65535.0);
+        break;
+      case READ_MFC:
+        if (!(status = ReadMFC(device, n, &value))) {
+          intValue = value * 65535;
+          replyBuffer[0] = intValue & 0xff;
+          replyBuffer[1] = intValue >> 8;
+          outLen = 2;
+        }
+        break;
+      case SET_D_MFC:
+        if (len < 3 || len - 2 > 32)
+          break;
+        memcpy(mfcCommand, &p[2], len - 2);
+        mfcCommand[len - 2] = '\0';
+        status = SetDMFC(device, n, mfcCommand);
+        break;
+      case READ_D_MFC:
+        if (!(status = ReadDMFC(device, n))) {
+          StripEOL((char*)i2cBuffer);
+          outLen = strlen((char*)i2cBuffer);
+          memcpy(replyBuffer, i2cBuffer, outLen);
+        }
+        break;
+      case POLL_D_MFC:
+        // payload is the device and pairs of MFC number and address.
+        if (len != 3 && len != 5)
+          break;
+        for (uint8_t i = 0; i < (len - 1) / 2; i++) {
+          snprintf(mfcNums[i], sizeof(mfcNums[i]), "%d", p[1 + 2 * i]);
+          mfcAddrs[i][0] = p[2 + 2 * i];
+          mfcAddrs[i][1] = '\0';
+          pollArgs[2 * i] = mfcNums[i];
+          pollArgs[2 * i + 1] = mfcAddrs[i];
+          pollArgs[2 * i + 2] = NULL;
+        }
+        if (!(status = PollDMFCs(device, pollArgs, replyBuffer, sizeof(replyBuffer))))
+          outLen = strlen(replyBuffer);
+        break;
+    }
+  }
+  SendFrame(seq, opcode | FRAME_REPLY, status, (uint8_t*)replyBuffer, outLen);
+}
+
+// Receives the bytes of a frame, starting with the sync byte, and handles the
+// frame once it is complete.
+void ReceiveFrameByte(uint8_t c) {
+  uint8_t len;
+  uint16_t crc;
+  if (frameIdx == 0) {  // sync byte.
+    frameIdx = 1;
+    frameStart = millis();
+    return;
+  }
+  frame[frameIdx - 1] = c;
+  frameIdx++;
+  if (frame[0] > FRAME_MAX) {  // not a frame, resync.
+    frameIdx = 0;
+    return;
+  }
+  len = frame[0];
+  if (frameIdx - 1 < len + 5)
+    return;
+  frameIdx = 0;
+  crc = ((uint16_t)frame[len + 3] << 8) | frame[len + 4];
+  if (Crc16(0xFFFF, frame, len + 3) != crc) {
+    SendFrame(frame[1], FRAME_NAK, -4, NULL, 0);
+    return;
+  }
+  HandleFrame(frame[1], frame[2], &frame[3], len);
+}
+
 void setup() 
 {
   pinMode(0, OUTPUT);
@@ -526,9 +898,16 @@ void setup()
 void loop() 
 {
   uint8_t c;
+  SeqUpdate();
+  if (frameIdx > 0 && millis() - frameStart > FRAME_TIMEOUT)
+    frameIdx = 0;  // drop an incomplete frame.
+  if (idx == 0 && frameIdx == 0)
+    SeqReport();
   if (Serial.available() > 0) { // PC communication
     c = Serial.read();
-    if (c == '\r') {
+    if (frameIdx > 0 || (idx == 0 && c == FRAME_SYNC)) {
+      ReceiveFrameByte(c);
+    } else if (c == '\r') {
       buffer[idx] = 0;
       Serial.println();
       parse((char*)buffer, argv, sizeof(argv));
@@ -742,6 +1121,63 @@ void loop()
     	  else {
     		  Serial.println("DMFC <DEVICE> <N> {string}");
     	  }
+      } else if (strcmp(argv[0], "DMFCpoll") == 0) {
+        if (strlen(argv[1]) > 0) {
+          arg1 = atoi(argv[1]);
+          if (arg1 > 0 && arg1 < 128) {
+            if (resp = PollDMFCs((uint8_t)arg1, &argv[2], replyBuffer, sizeof(replyBuffer))) {
+              Serial.print("Error ");
+              Serial.println(resp);
+            } else {
+              Serial.print("MFCpoll ");
+              Serial.println(replyBuffer);
+            }
+          } else {
+            Serial.println("DMFCpoll <DEVICE> <N> <ADDRESS> [<N> <ADDRESS>], N = {1..2}");
+          }
+        } else {
+          Serial.println("DMFCpoll <DEVICE> <N> <ADDRESS> [<N> <ADDRESS>]");
+        }
+      } else if (strcmp(argv[0], "protocol") == 0) {
+        Serial.println("protocol binary 1");
+      } else if (strcmp(argv[0], "seqClear") == 0) {
+        // Clears the sequence. This also stops a running sequence.
+        if (argv[1] && strlen(argv[1]) > 0) {
+          seqRunning = false;
+          seqError = false;
+          seqLen = seqNext = seqReported = 0;
+          Serial.println("seq cleared");
+        } else {
+          Serial.println("seqClear <DEVICE>");
+        }
+      } else if (strcmp(argv[0], "seqAdd") == 0) {
+        if (argv[1] && argv[2] && strlen(argv[1]) > 0 && strlen(argv[2]) > 0) {
+          arg1 = atoi(argv[1]);
+          if (resp = SeqAdd((uint8_t)arg1, (uint32_t)atol(argv[2]), &argv[3])) {
+            seqError = true;
+            Serial.print("Error ");
+            Serial.println(resp);
+          } else {
+            Serial.print("seq step ");
+            Serial.println(seqLen - 1);
+          }
+        } else {
+          Serial.println("seqAdd <DEVICE> <T> <COMMAND> <N> [<ARG>]");
+        }
+      } else if (strcmp(argv[0], "seqRun") == 0) {
+        if (argv[1] && strlen(argv[1]) > 0) {
+          if (seqRunning || seqError || seqLen == 0) {
+            Serial.println("Error -1");
+          } else {
+            seqNext = seqReported = 0;
+            seqStart = millis();
+            seqRunning = true;
+            Serial.print("seq started ");
+            Serial.println(seqLen);
+          }
+        } else {
+          Serial.println("seqRun <DEVICE>");
+        }
       } else if (strcmp(argv[0], "analogSet") == 0) {
         if (strlen(argv[1]) > 0 && strlen(argv[2]) > 0 && strlen(argv[3]) > 0) {
           arg1 = atoi(argv[1]);
@@ -875,6 +1311,18 @@ void loop()
            Serial.println("DMFC <DEVICE> <N> {string}, N = {1..2},"
         		   " string = {ASCII string} \t Send or Read"
         		   " (when no string specified) a command to MFC N");
+           Serial.println("DMFCpoll <DEVICE> <N> <ADDRESS> [<N> <ADDRESS>],"
+        		   " N = {1..2}\t ==> \t Poll several digital MFCs and"
+        		   " return all replies on one line");
+           Serial.println("protocol\t ==> \t Supported protocols (binary frames"
+        		   " are accepted as well as ASCII commands)");
+           Serial.println("seqClear <DEVICE>\t ==> \t Clear (and stop) the"
+        		   " stimulus sequence");
+           Serial.println("seqAdd <DEVICE> <T> <COMMAND> <N> [<ARG>]\t ==> \t"
+        		   " Add a step at T ms. COMMAND = {vialOn, vialOff, vial,"
+        		   " MFC, DMFC}, with the arguments of that command");
+           Serial.println("seqRun <DEVICE>\t ==> \t Run the sequence, steps"
+        		   " are reported with \"!seq <INDEX> <T> <STATUS>\"");
            Serial.println("analogSet <DEVICE> <N> {value}, N = {1..2},"
         		   " value = {0.0...1.0} ");
            Serial.println("analogRead <DEVICE> <N>, N = {1..6}");
@@ -1,14 +1,81 @@
+"""
+Submodules and the names exported here (ie Olfactometers, get_olfa_config) are imported on first access. Scripts that
+only use the configuration utilities or the headless core (olfactometry.core) do not import Qt, and the QApplication
+is only created when a gui module or name (Olfactometers, TeensyOlfa, cleaning, ...) is first used.
+"""
 __author__ = 'chris'
-import sip  # these lines are necessary because of a Traits dependancy on use of V2 of these APIs.
-sip.setapi('QString', 2)
-sip.setapi('QVariant', 2)
-from PyQt4 import QtGui
-from main import *
-import cleaning
-from utils import *
 import sys
+import types
+import importlib
 
+try:
+    import sip  # these lines are necessary because of a Traits dependancy on use of V2 of these APIs.
+    sip.setapi('QString', 2)  # must be called before PyQt4 is imported, but does not import PyQt4 itself.
+    sip.setapi('QVariant', 2)
+except ImportError:  # PyQt4 is not installed. The headless core can still be used.
+    pass
 
-qapp = QtGui.QApplication.instance()
-if qapp is None:
-    qapp = QtGui.QApplication(sys.argv)
+_SUBMODULES = ('calibration', 'cleaning', 'core', 'dilutor', 'framing', 'main', 'mfc', 'olfactometer', 'polling',
+               'simulator', 'telemetry', 'transport', 'utils')
+_GUI_SUBMODULES = ('calibration', 'cleaning', 'dilutor', 'main', 'mfc', 'olfactometer')
+
+# {name: submodule} for the names that used to be imported here with "from main import *" and "from utils import *".
+_LAZY_NAMES = {'Olfactometers': 'main',
+               'main': 'main',
+               'QtCore': 'main',
+               'QtGui': 'main',
+               'Olfactometer': 'olfactometer',
+               'TeensyOlfa': 'olfactometer',
+               'Dilutor': 'dilutor',
+               'OlfactometerRig': 'core',
+               'get_olfa_config': 'utils',
+               'flatten_dictionary': 'utils',
+               'connect_serial': 'utils',
+               'OlfaException': 'utils',
+               'CONFIG_FILENAME_DEFAULT': 'utils'}
+
+__all__ = sorted(_LAZY_NAMES.keys()) + ['cleaning', 'qapp']
+
+
+def _get_qapp():
+    """
+    Returns the running QApplication, creating one if needed. Widgets cannot be built without one.
+    """
+    from PyQt4 import QtGui
+    qapp = QtGui.QApplication.instance()
+    if qapp is None:
+        qapp = QtGui.QApplication(sys.argv)
+    return qapp
+
+
+class _LazyPackage(types.ModuleType):
+    """
+    Package module that imports submodules and exported names the first time they are accessed.
+    """
+
+    def __getattr__(self, name):
+        # this is only called when normal lookup fails. Loaded names are stored, so each is only loaded once.
+        if name == 'qapp':
+            value = _get_qapp()
+        elif name in _LAZY_NAMES or name in _SUBMODULES:
+            module_name = _LAZY_NAMES.get(name, name)
+            if module_name in _GUI_SUBMODULES:
+                self.qapp = _get_qapp()
+            module = importlib.import_module('{0}.{1}'.format(self.__name__, module_name))
+            if name in _LAZY_NAMES:
+                value = getattr(module, name)  # "main" is the main() function, not the submodule.
+            else:
+                value = module
+        else:
+            raise AttributeError("'module' object has no attribute '{0}'".format(name))
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__.keys()) | set(_SUBMODULES) | set(_LAZY_NAMES.keys()))
+
+
+_package = _LazyPackage(__name__, __doc__)
+_package.__dict__.update(globals())
+_package._module = sys.modules[__name__]  # keeps this module's globals alive, they are used by _LazyPackage.
+sys.modules[__name__] = _package
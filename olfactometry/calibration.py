@@ -5,15 +5,10 @@ import tables as tb
 from PyQt4 import QtCore, QtGui
 import logging
 import os
-from matplotlib.backends.backend_qt4agg import FigureCanvas
+import json
+import shutil
+from matplotlib.backends.backend_qt4agg import FigureCanvas, NavigationToolbar2QT
 from matplotlib.figure import Figure
-try:
-    from numba import jit  # used for detrending maths. Not required.
-except ImportError:
-    logging.warning('Numba is not installed. Please install numba package for optimal performance!')
-
-    def jit(a):
-        return a
 
 __author__ = 'chris'
 
@@ -30,6 +25,11 @@ class CalibrationViewer(QtGui.QMainWindow):
         self.setWindowTitle('Olfa Calibration')
         self.statusBar()
         self.trial_selected_list = []
+        self._trial_cache = {}  # {(trial number, padding): (detrended stream, odorconc, mean value)}
+        self._trial_artists = {}  # {(trial number, padding): (PID line, mean value point)}
+        self._group_artists = {}  # {group index: (artist, (trials, padding, color), regression or None)}
+        self._trial_envelopes = {}  # {(trial number, padding): EnvelopePyramid of the detrended stream}
+        self._line_envelopes = {}  # {PID trace line: EnvelopePyramid that it is drawn from}
         self.trialsChanged.connect(self._trial_selection_changed)
 
         mainwidget = QtGui.QWidget(self)
@@ -106,7 +106,7 @@ class CalibrationViewer(QtGui.QMainWindow):
 
         plots_box = QtGui.QGroupBox()
         plots_box.setTitle('Plots')
-        plots_layout = QtGui.QHBoxLayout()
+        plots_layout = QtGui.QVBoxLayout()
 
         self.figure = Figure((9, 5))
         self.figure.patch.set_facecolor('None')
@@ -114,12 +114,14 @@ class CalibrationViewer(QtGui.QMainWindow):
         self.canvas.setParent(plots_box)
         self.canvas.setSizePolicy(QtGui.QSizePolicy.Expanding, QtGui.QSizePolicy.Expanding)
         plots_layout.addWidget(self.canvas)
+        plots_layout.addWidget(NavigationToolbar2QT(self.canvas, plots_box))
         plots_box.setLayout(plots_layout)
         layout.addWidget(plots_box, 0, 3)
         self.ax_pid = self.figure.add_subplot(2, 1, 1)
         self.ax_pid.set_title('PID traces')
         self.ax_pid.set_ylabel('')
         self.ax_pid.set_xlabel('t (ms)')
+        self.ax_pid.callbacks.connect('xlim_changed', self._pid_xlim_changed)
         # self.ax_pid.set_yscale('log')
         self.ax_mean_plots = self.figure.add_subplot(2, 1, 2)
         self.ax_mean_plots.set_title('Mean value')
@@ -136,16 +138,13 @@ class CalibrationViewer(QtGui.QMainWindow):
     def _filters_changed(self):
         mask = np.ones_like(self.trial_mask)
         for v in self.filters:
-            mask *= v.trial_mask
+            mask &= v.trial_mask
         self.trial_mask = mask
-        self.trial_select_list.itemSelectionChanged.disconnect(self._trial_selection_changed)
-        for i in xrange(len(self.trial_mask)):
-            hide = not self.trial_mask[i]
-            it = self.trial_select_list.item(i)
-            it.setHidden(hide)
-            select = it.isSelected() * self.trial_mask[i]
-            it.setSelected(select)
-        self.trial_select_list.itemSelectionChanged.connect(self._trial_selection_changed)
+        # the proxy model hides the filtered trials and drops them from the selection. Signals are blocked so that
+        # we only redraw once.
+        self.trial_select_list.blockSignals(True)
+        self.trial_select_list.set_trial_mask(self.trial_mask)
+        self.trial_select_list.blockSignals(False)
         self.trial_select_list.itemSelectionChanged.emit()  # emit that something changed so that we redraw.
 
     @QtCore.pyqtSlot()
@@ -159,24 +158,11 @@ class CalibrationViewer(QtGui.QMainWindow):
         if fn:
             data = CalibrationFile(str(fn))
             self.data = data
+            self._clear_plots()
             self.trial_actions = []
-            trial_num_list = []
-            self.trial_select_list.clear()
             trials = self.data.trials
-            for i, t in enumerate(trials):
-                tstr = "Trial {0}".format(i)
-                it = QtGui.QListWidgetItem(tstr, self.trial_select_list)
-                # trial = trials[i]
-                # odor = trial['odor']
-                # vialconc = trial['vialconc']
-                # odorconc = trial['odorconc']
-                # dilution = 1000 - trial['dilution'][0]
-                # trst = 'Odor: {0}, vialconc: {1}, odorconc: {2}, dilution: {3}'.format(odor, vialconc, odorconc,
-                #                                                                        dilution)
-                # it.setStatusTip(trst)
-                trial_num_list.append(i)
-            self.trial_select_list.trial_num_list = np.array(trial_num_list)
-            self.trial_mask = np.ones(len(self.trial_select_list.trial_num_list), dtype=bool)
+            self.trial_mask = np.ones(len(trials), dtype=bool)
+            self.trial_select_list.set_trials(np.arange(len(trials)), self.trial_mask)
             self.build_filters(trials)
         else:
             print('No file selected.')
@@ -236,139 +222,197 @@ class CalibrationViewer(QtGui.QMainWindow):
 
     @QtCore.pyqtSlot()
     def _remove_trials(self):
-        selected_idxes = self.trial_select_list.selectedIndexes()
-        remove_idxes = []
-        for id in selected_idxes:
-            idx = id.row()
-            remove_idxes.append(idx)
-        while self.trial_select_list.selectedIndexes():
-            selected_idxes = self.trial_select_list.selectedIndexes()
-            idx = selected_idxes[0].row()
-            self.trial_select_list.takeItem(idx)
-        new_trials_array = np.zeros(len(self.trial_select_list.trial_num_list)-len(remove_idxes), dtype=np.int)
-        ii = 0
-        remove_trialnums = []
-        new_trials_mask = np.zeros_like(new_trials_array, dtype=bool)
-        for i in xrange(len(self.trial_select_list.trial_num_list)):
-            if i not in remove_idxes:
-                new_trials_mask[ii] = self.trial_mask[i]
-                new_trials_array[ii] = self.trial_select_list.trial_num_list[i]
-                ii += 1
-            else:
-                remove_trialnums.append(self.trial_select_list.trial_num_list[i])
-        self.trial_mask = new_trials_mask
-        self.trial_select_list.trial_num_list = new_trials_array
+        keep = np.ones(len(self.trial_mask), dtype=bool)
+        keep[self.trial_select_list.selected_rows()] = False
+        if keep.all():
+            return
+        remove_trialnums = self.trial_select_list.trial_num_list[~keep]
+        self.trial_mask = self.trial_mask[keep]
+        self.trial_select_list.blockSignals(True)
+        self.trial_select_list.remove_rows(keep)
+        self.trial_select_list.blockSignals(False)
 
         for f in self.filters:
-            f.remove_trials(remove_idxes)
+            f.remove_trials(keep)
         self.trial_group_list._remove_trials(remove_trialnums)
+        self.trial_select_list.itemSelectionChanged.emit()  # the removed trials were selected, so we redraw.
 
     @QtCore.pyqtSlot()
     def _trial_selection_changed(self):
-        selected_idxes = self.trial_select_list.selectedIndexes()
-        selected_trial_nums = []
-        for id in selected_idxes:
-            idx = id.row()
-            trialnum = self.trial_select_list.trial_num_list[idx]
-            selected_trial_nums.append(trialnum)
+        selected_trial_nums = list(self.trial_select_list.selected_trials())
         self.update_plots(selected_trial_nums)
         self.trial_group_list.blockSignals(True)
-        for i, g in zip(xrange(self.trial_group_list.count()), self.trial_group_list.trial_groups):
-            it = self.trial_group_list.item(i)
-            all_in = True
-            group_trials = g['trial_nums']
-            for t in group_trials:
-                if t not in selected_trial_nums:
-                    all_in = False
-            if not all_in:
-                it.setSelected(False)
-            elif all_in:
-                it.setSelected(True)
+        complete_groups = self.trial_group_list.get_complete_groups(selected_trial_nums)
+        for i in xrange(self.trial_group_list.count()):
+            self.trial_group_list.item(i).setSelected(bool(complete_groups[i]))
         self.trial_group_list.blockSignals(False)
         return
 
     @QtCore.pyqtSlot()
     def _trial_group_selection_changed(self):
-        selected_idxes = self.trial_group_list.selectedIndexes()
+        selected_groups = [i.row() for i in self.trial_group_list.selectedIndexes()]
         self._select_all_filters()
-        selected_trial_nums = []
-        for id in selected_idxes:
-            idx = id.row()
-            trialnums = self.trial_group_list.trial_groups[idx]['trial_nums']
-            selected_trial_nums.extend(trialnums)
+        selected_trial_nums = self.trial_group_list.get_group_trials(selected_groups)
         self.trial_select_list.blockSignals(True)
-        for i in range(self.trial_select_list.count()):
-            item = self.trial_select_list.item(i)
-            self.trial_select_list.setItemSelected(item, False)
-        for i in selected_trial_nums:
-            idx = np.where(self.trial_select_list.trial_num_list == i)[0][0]
-            it = self.trial_select_list.item(idx)
-            if not it.isSelected():
-                it.setSelected(True)
+        self.trial_select_list.select_trials(selected_trial_nums)
         self.trial_select_list.blockSignals(False)
         self._trial_selection_changed()
 
     def update_plots(self, trials):
+        """
+        Plots the selected trials. Trial values and artists are cached, so only the trials and groups whose selection
+        changed are computed and plotted again.
+
+        :param trials: selected trial numbers.
+        """
         padding = (2000, 2000)  #TODO: make this changable - this is the number of ms before/afterr trial to extract for stream.
-        trial_streams = []
-        trial_colors = []
-        while self.ax_pid.lines:
-            self.ax_pid.lines.pop(0)
-        while self.ax_mean_plots.lines:
-            self.ax_mean_plots.lines.pop(0)
-        groups_by_trial = []
-        all_groups = set()
-        ntrials = len(trials)
-        vals = np.empty(ntrials)
-        concs = np.empty_like(vals)
-        if trials:
-            a = max([1./len(trials), .25])
-            for i, tn in enumerate(trials):
-                color = self.trial_group_list.get_trial_color(tn)
-                groups = self.trial_group_list.get_trial_groups(tn)
-                trial_colors.append(color)
-                groups_by_trial.append(groups)
-                all_groups.update(groups)
-                trial = self.data.return_trial(tn, padding=padding)
-                stream = remove_stream_trend(trial.streams['sniff'], (0, padding[0]))
-                stream -= stream[0:padding[0]].min()
-                # TODO: remove baseline (N2) trial average from this.
-                trial_streams.append(stream)
-                self.ax_pid.plot(stream, color=color, alpha=a)
-                conc = trial.trials['odorconc']
-                baseline = np.mean(stream[:2000])
-                val = np.mean(stream[3000:4000]) - baseline
-                vals[i] = val
-                concs[i] = conc
-                self.ax_mean_plots.plot(conc, val, '.', color=color)
-        minlen = 500000000
-        for i in trial_streams:
-            minlen = min(len(i), minlen)
-        streams_array = np.empty((ntrials, minlen))
-        for i in xrange(ntrials):
-            streams_array[i, :] = trial_streams[i][:minlen]
-        for g in all_groups:
-            mask = np.empty(ntrials, dtype=bool)
-            for i in xrange(ntrials):
-                groups = groups_by_trial[i]
-                mask[i] = g in groups
-            c = concs[mask]
-            groupstreams = streams_array[mask]
-            if len(np.unique(c)) < 2:
-                self.ax_pid.plot(groupstreams.mean(axis=0), color='k', linewidth=2)
-            else:
-                v = vals[mask]
-                a, b, _, _, _ = stats.linregress(c, v)
-                color = self.trial_group_list.get_group_color(g)
-                minn, maxx = self.ax_mean_plots.get_xlim()
-                x = np.array([minn, maxx])
-                self.ax_mean_plots.plot(x, a*x + b, color=color)
+        trials = self._compute_trials(trials, padding)
+        self._update_trial_artists(trials, padding)
+        self._update_group_artists(trials, padding)
         self.ax_pid.relim()
+        self.ax_pid.autoscale_view()
         self.ax_mean_plots.set_yscale('log')
         self.ax_mean_plots.set_xscale('log')
         self.ax_mean_plots.relim()
 
-        self.canvas.draw()
+        self.canvas.draw_idle()
+
+    def _compute_trials(self, trials, padding):
+        """
+        Extracts and detrends the trials that are not in the trial cache, in one batch. Trials without start or end
+        times (ie aborted trials) are cached as None and are not plotted.
+
+        :return: the trials that can be plotted.
+        """
+        missing = [tn for tn in trials if (tn, padding) not in self._trial_cache]
+        if missing:
+            starts, ends = self.data._trial_times(self.data.trials[missing])
+            valid = (starts != 0) & (ends != 0)
+            for tn, v in zip(missing, valid):
+                if not v:
+                    self._trial_cache[(tn, padding)] = None
+            missing = [tn for tn, v in zip(missing, valid) if v]
+        if missing:
+            lengths = np.maximum(ends[valid] - starts[valid] + padding[0] + padding[1], 0)
+            streams_array, trial_data = self.data.return_trial_matrix(missing, padding=padding,
+                                                                      nsamples=int(lengths.max()))
+            remove_stream_trend(streams_array, (0, padding[0]))
+            # samples before the start of the recording are NaN (ie when the first trial starts less than padding[0]
+            # samples in), so they are left out of the baseline and response windows.
+            streams_array -= np.nanmin(streams_array[:, 0:padding[0]], axis=1)[:, np.newaxis]
+            # TODO: remove baseline (N2) trial average from this.
+            baselines = np.nanmean(streams_array[:, :2000], axis=1)
+            vals = np.nanmean(streams_array[:, 3000:4000], axis=1) - baselines
+            for i, tn in enumerate(missing):
+                self._trial_cache[(tn, padding)] = (streams_array[i, :lengths[i]], trial_data['odorconc'][i], vals[i])
+        return [tn for tn in trials if self._trial_cache[(tn, padding)] is not None]
+
+    def _update_trial_artists(self, trials, padding):
+        """
+        Removes the lines of trials that are no longer selected, and adds lines for the newly selected trials.
+        """
+        keys = set((tn, padding) for tn in trials)
+        for k in [k for k in self._trial_artists if k not in keys]:
+            for artist in self._trial_artists.pop(k):
+                self._remove_artist(artist)
+        alpha = max([1./len(trials), .25]) if trials else 1.
+        for tn in trials:
+            color = self.trial_group_list.get_trial_color(tn)
+            artists = self._trial_artists.get((tn, padding))
+            if artists is None:
+                stream, conc, val = self._trial_cache[(tn, padding)]
+                envelope = self._trial_envelopes.get((tn, padding))
+                if envelope is None:
+                    envelope = self._trial_envelopes[(tn, padding)] = EnvelopePyramid(stream)
+                line = self._plot_envelope(envelope, color=color, alpha=alpha)
+                point, = self.ax_mean_plots.plot(conc, val, '.', color=color)
+                self._trial_artists[(tn, padding)] = (line, point)
+            else:
+                line, point = artists
+                line.set_color(color)  # group colors can change without a selection change.
+                line.set_alpha(alpha)
+                point.set_color(color)
+
+    def _update_group_artists(self, trials, padding):
+        """
+        Plots the mean trace (groups with one concentration) or the regression line of each group of selected trials.
+        Groups are only refit when their selected trials or color changed.
+        """
+        members = {}
+        if trials:
+            group_members = self.trial_group_list.get_group_members(trials)
+            for g in np.flatnonzero(group_members.any(axis=0)):
+                members[int(g)] = [tn for tn, m in zip(trials, group_members[:, g]) if m]
+        for g in [g for g in self._group_artists if g not in members]:
+            self._remove_artist(self._group_artists.pop(g)[0])
+        minn, maxx = self.ax_mean_plots.get_xlim()
+        x = np.array([minn, maxx])
+        for g, group_trials in members.iteritems():
+            color = self.trial_group_list.get_group_color(g)
+            key = (tuple(group_trials), padding, tuple(color))
+            artist, old_key, fit = self._group_artists.get(g, (None, None, None))
+            if key == old_key:
+                if fit is not None:
+                    artist.set_data(x, fit[0]*x + fit[1])  # the x limits change as trials are added.
+                continue
+            if artist is not None:
+                self._remove_artist(artist)
+            values = [self._trial_cache[(tn, padding)] for tn in group_trials]
+            c = np.array([v[1] for v in values])
+            if len(np.unique(c)) < 2:
+                minlen = min(len(v[0]) for v in values)
+                groupstreams = np.array([v[0][:minlen] for v in values])
+                artist = self._plot_envelope(EnvelopePyramid(groupstreams.mean(axis=0)), color='k', linewidth=2)
+                fit = None
+            else:
+                v = np.array([v[2] for v in values])
+                a, b, _, _, _ = stats.linregress(c, v)
+                artist, = self.ax_mean_plots.plot(x, a*x + b, color=color)
+                fit = (a, b)
+            self._group_artists[g] = (artist, key, fit)
+
+    def _clear_plots(self):
+        """
+        Removes all trial and group artists and empties the trial cache (ie when a new file is opened).
+        """
+        for artists in self._trial_artists.values():
+            for artist in artists:
+                self._remove_artist(artist)
+        for artist, _, _ in self._group_artists.values():
+            self._remove_artist(artist)
+        self._trial_artists = {}
+        self._group_artists = {}
+        self._trial_cache = {}
+        self._trial_envelopes = {}
+
+    def _plot_envelope(self, envelope, **kwargs):
+        """
+        Plots a trace on the PID axes from its envelope pyramid, with about as many points as the axes have pixels.
+
+        :return: line artist.
+        """
+        line, = self.ax_pid.plot(*self._envelope_points(envelope), **kwargs)
+        self._line_envelopes[line] = envelope
+        return line
+
+    def _envelope_points(self, envelope):
+        max_points = 2 * max(int(self.ax_pid.bbox.width), 100)  # a min and a max per pixel.
+        if self.ax_pid.get_autoscalex_on():  # the whole trace is needed to autoscale.
+            return envelope.points(max_points=max_points)
+        x0, x1 = self.ax_pid.get_xlim()
+        return envelope.points(x0, x1, max_points)
+
+    def _pid_xlim_changed(self, ax):
+        """
+        Redraws the PID traces at the level of detail of the new x limits (ie after zooming).
+        """
+        for line, envelope in self._line_envelopes.iteritems():
+            line.set_data(*self._envelope_points(envelope))
+        self.canvas.draw_idle()
+
+    def _remove_artist(self, artist):
+        self._line_envelopes.pop(artist, None)
+        artist.remove()
 
     @QtCore.pyqtSlot()
     def _select_none_filters(self):
@@ -387,13 +431,143 @@ class CalibrationViewer(QtGui.QMainWindow):
         self._filters_changed()
 
 
-class TrialListWidget(QtGui.QListWidget):
+class TrialListModel(QtCore.QAbstractListModel):
+    """
+    Model of the trial list. Rows are the trials that were not removed, in the order of the Trials table.
+    """
+
+    def __init__(self, parent=None):
+        super(TrialListModel, self).__init__(parent)
+        self.trial_num_list = np.array([], dtype=np.int)
+
+    def set_trials(self, trial_num_list):
+        self.beginResetModel()
+        self.trial_num_list = np.asarray(trial_num_list, dtype=np.int)
+        self.endResetModel()
+
+    def remove_rows(self, keep):
+        """
+        Removes the rows where keep is False, with one removeRows() call per run of consecutive rows.
+
+        :param keep: boolean array, one per row.
+        """
+        edges = np.diff(np.r_[0, ~keep, 0].astype(np.int8))
+        starts = np.flatnonzero(edges == 1)
+        ends = np.flatnonzero(edges == -1)
+        for start, end in zip(starts[::-1], ends[::-1]):  # from the end, so that the rows before do not move.
+            self.removeRows(start, end - start)
+
+    def removeRows(self, row, count, parent=QtCore.QModelIndex()):
+        if parent.isValid() or count < 1 or row < 0 or row + count > len(self.trial_num_list):
+            return False
+        self.beginRemoveRows(parent, row, row + count - 1)
+        self.trial_num_list = np.delete(self.trial_num_list, np.s_[row:row + count])
+        self.endRemoveRows()
+        return True
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.trial_num_list)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if role == QtCore.Qt.DisplayRole and index.isValid():
+            return 'Trial {0}'.format(self.trial_num_list[index.row()])
+        return None
+
+
+class TrialFilterProxyModel(QtGui.QSortFilterProxyModel):
+    """
+    Shows the rows of the trial list where the trial mask (the combination of the filters) is True.
+    """
+
+    def __init__(self, parent=None):
+        super(TrialFilterProxyModel, self).__init__(parent)
+        self.trial_mask = np.array([], dtype=bool)
+
+    def set_trial_mask(self, trial_mask):
+        self.trial_mask = trial_mask
+        self.invalidateFilter()
+
+    def filterAcceptsRow(self, source_row, source_parent):
+        return source_row >= len(self.trial_mask) or bool(self.trial_mask[source_row])
+
+
+class TrialListWidget(QtGui.QListView):
 
     createGroupSig = QtCore.pyqtSignal(list)
+    itemSelectionChanged = QtCore.pyqtSignal()
 
     def __init__(self):
         super(TrialListWidget, self).__init__()
-        self.trial_num_list = np.array([])
+        self.trial_model = TrialListModel(self)
+        self.proxy_model = TrialFilterProxyModel(self)
+        self.proxy_model.setSourceModel(self.trial_model)
+        self.setModel(self.proxy_model)
+        self.selectionModel().selectionChanged.connect(self._selection_changed)
+
+    @property
+    def trial_num_list(self):
+        return self.trial_model.trial_num_list
+
+    def set_trials(self, trial_num_list, trial_mask):
+        """
+        Replaces the trials in the list.
+
+        :param trial_num_list: trial numbers, one per row.
+        :param trial_mask: boolean array, True for the rows to show.
+        """
+        self.proxy_model.set_trial_mask(trial_mask)
+        self.trial_model.set_trials(trial_num_list)
+
+    def set_trial_mask(self, trial_mask):
+        self.proxy_model.set_trial_mask(trial_mask)
+
+    def remove_rows(self, keep):
+        """
+        Removes the trials where keep is False from the list.
+
+        :param keep: boolean array, one per row of the trial model.
+        """
+        self.trial_model.remove_rows(keep)
+        # the rows that are left keep their visibility, so the proxy does not need to filter again.
+        self.proxy_model.trial_mask = self.proxy_model.trial_mask[keep]
+
+    def selected_rows(self):
+        """
+        :return: sorted array of the selected rows of the trial model (indices in trial_num_list).
+        """
+        selection = self.proxy_model.mapSelectionToSource(self.selectionModel().selection())
+        rows = [np.arange(selection[i].top(), selection[i].bottom() + 1) for i in xrange(len(selection))]
+        if not rows:
+            return np.array([], dtype=np.int)
+        return np.unique(np.concatenate(rows))
+
+    def selected_trials(self):
+        """
+        :return: array of the selected trial numbers.
+        """
+        return self.trial_num_list[self.selected_rows()]
+
+    def select_trials(self, trial_nums):
+        """
+        Replaces the selection with the rows of the trial numbers.
+
+        :param trial_nums: trial numbers to select.
+        """
+        rows = np.flatnonzero(np.in1d(self.trial_num_list, trial_nums))
+        # one selection range per run of consecutive rows.
+        breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+        starts = rows[np.r_[0, breaks]] if len(rows) else rows
+        ends = rows[np.r_[breaks - 1, -1]] if len(rows) else rows
+        selection = QtGui.QItemSelection()
+        for start, end in zip(starts, ends):
+            selection.select(self.trial_model.index(start), self.trial_model.index(end))
+        self.selectionModel().select(self.proxy_model.mapSelectionFromSource(selection),
+                                     QtGui.QItemSelectionModel.ClearAndSelect)
+
+    def _selection_changed(self, selected, deselected):
+        self.itemSelectionChanged.emit()
 
     def mousePressEvent(self, event):
         if event.button() == QtCore.Qt.LeftButton:
@@ -407,11 +581,7 @@ class TrialListWidget(QtGui.QListWidget):
             popMenu.exec_(event.globalPos())
 
     def _create_group(self):
-        selected_trial_nums = []
-        for i in self.selectedIndexes():
-            ii = i.row()
-            trialnum = self.trial_num_list[ii]
-            selected_trial_nums.append(trialnum)
+        selected_trial_nums = list(self.selected_trials())
         self.createGroupSig.emit(selected_trial_nums)
 
 
@@ -422,6 +592,8 @@ class TrialGroupListWidget(QtGui.QListWidget):
         super(TrialGroupListWidget, self).__init__()
         self.setSelectionMode(QtGui.QAbstractItemView.ExtendedSelection)
         self.trial_groups = []
+        # membership[trial number, group index] is True if the trial is in the group. Rows are added as needed.
+        self.membership = np.zeros((0, 0), dtype=bool)
         self.name_widget = QtGui.QInputDialog()
         # self.itemPressed.connect(self._mouse_pressed)
 
@@ -451,13 +623,10 @@ class TrialGroupListWidget(QtGui.QListWidget):
             popMenu.exec_(event.globalPos())
 
     def get_trial_color(self, trialnum):
-        color = 'b'
-        for g in self.trial_groups:
-            if trialnum in g['trial_nums']:
-                qc = g['color']
-                assert isinstance(qc, QtGui.QColor)
-                color = [qc.redF(), qc.greenF(), qc.blueF()]
-        return color
+        groups = self.get_trial_groups(trialnum)
+        if not groups:
+            return 'b'
+        return self.get_group_color(groups[-1])  # the last group wins.
 
     def get_group_color(self, groupnum):
         g = self.trial_groups[groupnum]
@@ -465,13 +634,40 @@ class TrialGroupListWidget(QtGui.QListWidget):
         return [qc.redF(), qc.greenF(), qc.blueF()]
 
     def get_trial_groups(self, trialnum):
-        groups = []
-        trial_groups = self.trial_groups
-        for i in xrange(self.count()):
-            g = trial_groups[i]
-            if trialnum in g['trial_nums']:
-                groups.append(i)
-        return groups
+        if trialnum >= len(self.membership):
+            return []
+        return list(np.flatnonzero(self.membership[trialnum]))
+
+    def get_group_trials(self, groupnums):
+        """
+        :param groupnums: sequence of group indexes.
+        :return: array of the trial numbers that are in any of the groups.
+        """
+        return np.flatnonzero(self.membership[:, list(groupnums)].any(axis=1))
+
+    def get_group_members(self, trialnums):
+        """
+        :param trialnums: sequence of trial numbers.
+        :return: boolean array of shape (len(trialnums), number of groups), True where the trial is in the group.
+        """
+        trialnums = np.asarray(trialnums, dtype=np.int)
+        self._add_trial_rows(trialnums.max() + 1 if len(trialnums) else 0)
+        return self.membership[trialnums]
+
+    def get_complete_groups(self, trialnums):
+        """
+        :param trialnums: sequence of trial numbers (ie the selected trials).
+        :return: boolean array, True for the groups whose trials are all in trialnums.
+        """
+        included = np.zeros(len(self.membership), dtype=bool)
+        trialnums = np.asarray(trialnums, dtype=np.int)
+        included[trialnums[trialnums < len(included)]] = True
+        return ~(self.membership & ~included[:, np.newaxis]).any(axis=0)
+
+    def _add_trial_rows(self, n_trials):
+        if n_trials > len(self.membership):
+            rows = np.zeros((n_trials - len(self.membership), self.membership.shape[1]), dtype=bool)
+            self.membership = np.vstack((self.membership, rows))
 
     @QtCore.pyqtSlot(list)
     def create_group(self, trial_numbers):
@@ -491,9 +687,13 @@ class TrialGroupListWidget(QtGui.QListWidget):
         it.setSelected(True)
         self.addItem(it)
         group_dict = {'name': new_group_name,
-                      'trial_nums': trial_numbers,
                       'color': QtGui.QColor(0, 0, 0, 255)}  # black
         self.trial_groups.append(group_dict)
+        trial_numbers = np.asarray(trial_numbers, dtype=np.int)
+        self._add_trial_rows(trial_numbers.max() + 1 if len(trial_numbers) else 0)
+        column = np.zeros((len(self.membership), 1), dtype=bool)
+        column[trial_numbers, 0] = True
+        self.membership = np.hstack((self.membership, column))
         return
 
     def _remove_groups(self):
@@ -502,12 +702,10 @@ class TrialGroupListWidget(QtGui.QListWidget):
             ii = i.row()
             remove_idxes.append(ii)
         remove_idxes.sort(reverse=True)
-        while self.selectedIndexes():
-            i = self.selectedIndexes()[0]
-            ii = i.row()
-            self.takeItem(ii)
         for i in remove_idxes:
+            self.takeItem(i)
             del self.trial_groups[i]
+        self.membership = np.delete(self.membership, remove_idxes, axis=1)
         return
 
     def _color_selection_triggered(self):
@@ -544,12 +742,10 @@ class TrialGroupListWidget(QtGui.QListWidget):
             item.setText(name)
 
     def _remove_trials(self, removetrials):
-        #TODO: connect this.
-        for group in self.trial_groups:
-            trials = group['trial_nums']
-            for i in removetrials:
-                if i in trials:
-                    trials.remove(i)
+        removetrials = np.asarray(removetrials, dtype=np.int)
+        removed = np.zeros(len(self.membership), dtype=bool)
+        removed[removetrials[removetrials < len(removed)]] = True
+        self.membership[removed] = False
         return
 
 
@@ -569,7 +765,7 @@ class FiltersListWidget(QtGui.QListWidget):
         self.setSelectionMode(QtGui.QAbstractItemView.ExtendedSelection)
         self.fieldname = fieldname
         self.list_values = np.array([])
-        self.trial_values = np.array([])
+        self.trial_codes = np.array([], dtype=np.int)  # index of the trial's value in list_values, for every trial.
         self.trial_mask = np.array([], dtype=bool)
         self.itemSelectionChanged.connect(self._selection_changed)
         return
@@ -579,8 +775,8 @@ class FiltersListWidget(QtGui.QListWidget):
         self.clear()
         fieldname = self.fieldname
         trial_vals = trials[fieldname]
-        self.trial_values = trial_vals  # values for the field for every trial
-        self.list_values = np.unique(trial_vals)  # values as they correspond to the list.
+        # values are encoded once as integer codes (their row in the list), masks are then computed on the codes.
+        self.list_values, self.trial_codes = np.unique(trial_vals, return_inverse=True)
         self.trial_mask = np.ones(len(trial_vals), dtype=bool)
         for val in self.list_values:
             it = QtGui.QListWidgetItem(str(val), self)
@@ -593,9 +789,7 @@ class FiltersListWidget(QtGui.QListWidget):
     def toggle_visible(self):
         self.setVisible(not self.isVisible())
         if not self.isVisible():
-            for i in xrange(self.count()):
-                field = self.item(i)
-                field.setSelected(True)
+            self.selectAll()
 
     @QtCore.pyqtSlot(QtGui.QMouseEvent)
     def mousePressEvent(self, event):
@@ -617,52 +811,40 @@ class FiltersListWidget(QtGui.QListWidget):
 
     @QtCore.pyqtSlot()
     def _combine(self):
-        selected = self.selectedIndexes()
+        selected = [i.row() for i in self.selectedIndexes()]
         assert len(selected) > 1
-        template_i = selected[0]
-        template_ii = template_i.row()
-        template_val = self.list_values[template_ii]
-        template_item = self.item(template_ii)
-        remove_vals = []
-        self.item(template_ii).setSelected(False)
-        for i in self.selectedIndexes():
-            ii = i.row()
-            val = self.list_values[ii]
-            self.trial_values[self.trial_values == val] = template_val
-            remove_vals.append(val)
-        while self.selectedIndexes():
-            idx = self.selectedIndexes()[0].row()
-            self.takeItem(idx)
-        new_list_vals = []
-        for i in self.list_values:
-            if i not in remove_vals:
-                new_list_vals.append(i)
-        self.list_values = np.array(new_list_vals)
-        template_item.setSelected(True)
+        template_ii = selected[0]
+        merged = np.zeros(len(self.list_values), dtype=bool)
+        merged[selected[1:]] = True
+        # merged values take the code of the template, then codes are renumbered to the rows that are left.
+        new_codes = np.arange(len(self.list_values))
+        new_codes[merged] = template_ii
+        new_codes = (np.cumsum(~merged) - 1)[new_codes]
+        self.trial_codes = new_codes[self.trial_codes]
+        self.list_values = self.list_values[~merged]
+        self.itemSelectionChanged.disconnect(self._selection_changed)
+        self.clearSelection()
+        for ii in sorted(selected[1:], reverse=True):
+            self.takeItem(ii)
+        self.item(new_codes[template_ii]).setSelected(True)
+        self.itemSelectionChanged.connect(self._selection_changed)
+        self._selection_changed()
         return
 
     @QtCore.pyqtSlot()
     def _selection_changed(self):
-        mask = np.zeros_like(self.trial_mask)
-        for i in self.selectedIndexes():
-            ii = i.row()
-            val = self.list_values[ii]
-            mask += self.trial_values == val
-        self.trial_mask = mask
+        selected_codes = np.zeros(len(self.list_values), dtype=bool)
+        selected_codes[[i.row() for i in self.selectedIndexes()]] = True
+        self.trial_mask = selected_codes[self.trial_codes]
         self.filterChanged.emit()
         return
 
-    def remove_trials(self, removeidx_list):
-        new_trial_val_list = []
-        new_trial_mask_list = []
-        for i in xrange(len(self.trial_values)):
-            if i not in removeidx_list:
-                val = self.trial_values[i]
-                new_trial_val_list.append(val)
-                m = self.trial_mask[i]
-                new_trial_mask_list.append(m)
-        self.trial_values = np.array(new_trial_val_list)
-        self.trial_mask = np.array(new_trial_mask_list, dtype=bool)
+    def remove_trials(self, keep):
+        """
+        :param keep: boolean array, False for the trials to remove.
+        """
+        self.trial_codes = self.trial_codes[keep]
+        self.trial_mask = self.trial_mask[keep]
 
     def sizeHint(self):
         s = QtCore.QSize()
@@ -689,21 +871,105 @@ class RichData(object):
         return
 
 
+CACHE_VERSION = 1  # increment when the contents of CalibrationCache change, so that existing caches are rebuilt.
+
+
+class CalibrationCache(object):
+    """
+    Preprocessed copy of a recording, stored in a directory next to it (<file>.cache). The Trials table, continuous
+    streams and event streams are saved as .npy files, which are memory-mapped when the recording is opened again.
+
+    The cache is keyed by the recording's path, modification time and size, and by CACHE_VERSION. It is invalid if any
+    of these changed, and is rebuilt.
+    """
+
+    def __init__(self, h5_path):
+        self.source = os.path.abspath(h5_path)
+        self.path = self.source + '.cache'
+
+    def _key(self):
+        st = os.stat(self.source)
+        return {'version': CACHE_VERSION, 'source': self.source, 'mtime': st.st_mtime, 'size': st.st_size}
+
+    def load_manifest(self, request):
+        """
+        :param request: stream and event names requested when the cache was built.
+        :return: manifest dictionary, or None if there is no valid cache for the request.
+        """
+        try:
+            with open(os.path.join(self.path, 'manifest.json')) as f:
+                manifest = json.load(f)
+        except (IOError, ValueError):
+            return None
+        key = self._key()
+        if any(manifest.get(k) != v for k, v in key.iteritems()) or manifest.get('request') != request:
+            logging.info('Calibration cache {0} is out of date.'.format(self.path))
+            return None
+        return manifest
+
+    def save_manifest(self, manifest):
+        """
+        Writes the manifest, which makes the cache valid. It must be written after all arrays.
+        """
+        manifest = dict(manifest, **self._key())
+        with open(os.path.join(self.path, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+
+    def clear(self):
+        """
+        Removes the cache contents so that it can be rebuilt.
+        """
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.makedirs(self.path)
+
+    def array_path(self, name):
+        return os.path.join(self.path, name + '.npy')
+
+    def save(self, name, array):
+        np.save(self.array_path(name), array)
+
+    def load(self, name):
+        """
+        :return: read-only memory map of a cached array.
+        :rtype: np.memmap
+        """
+        return np.load(self.array_path(name), mmap_mode='r')
+
+
 class CalibrationFile(object):
     """
     Container to dynamically load and parse Voyeur hdf5 files.
+
+    The parsed trials and streams are stored in a CalibrationCache, so opening the file again only memory-maps them.
+    Only the parts of the streams that are accessed are read into memory.
     """
     def __init__(self, h5_path, stream_names=('sniff',),
-                 event_names=('lick1', 'lick2'),):
+                 event_names=('lick1', 'lick2'), use_cache=True):
         """
 
         :param h5_path: Path to file
 
         :param stream_names:
         :param event_names:
+        :param use_cache: if False, the file is parsed into memory without reading or writing the cache.
         :return:
         """
         self.fn = h5_path
+        self.streams = {}
+        self.events = {}
+        self.event_sample_rates = {}
+
+        request = {'stream_names': list(stream_names), 'event_names': list(event_names)}
+        cache = CalibrationCache(h5_path) if use_cache else None
+        manifest = cache.load_manifest(request) if cache else None
+        if manifest is not None:
+            try:
+                self._load_cache(cache, manifest)
+                return
+            except (IOError, OSError, ValueError, KeyError) as e:  # ie an array is missing or truncated.
+                logging.warning('Cannot load calibration cache {0} ({1}), rebuilding it.'.format(cache.path, e))
+                self.streams, self.events, self.event_sample_rates = {}, {}, {}
 
         with tb.open_file(h5_path, 'r') as h5:
             h5_attr = h5.root._v_attrs
@@ -716,13 +982,59 @@ class CalibrationFile(object):
                 if isinstance(event_names, str):
                     event_names = [event_names]
             self.trials = h5.root.Trials.read()
-            self.streams = {}
-            self.events = {}
+            if cache:
+                try:
+                    self._build_cache(h5, cache, request, stream_names, event_names)
+                    return
+                except (IOError, OSError, TypeError, ValueError) as e:
+                    logging.warning('Cannot write calibration cache {0} ({1}).'.format(cache.path, e))
+                    self.streams, self.events, self.event_sample_rates = {}, {}, {}
 
             for stream_name in stream_names:
                 self.streams[stream_name] = self._process_continuous_stream(h5, stream_name)
             for event_name in event_names:
-                self.events[event_name] = self._process_event_stream(h5, event_name)
+                self.events[event_name], self.event_sample_rates[event_name] = self._process_event_stream(h5, event_name)
+
+    def _build_cache(self, h5, cache, request, stream_names, event_names):
+        """
+        Parses the streams of the file into the cache, then loads the cache.
+        """
+        logging.info('Building calibration cache {0}.'.format(cache.path))
+        cache.clear()
+        manifest = {'request': request, 'stream_names': list(stream_names), 'event_names': list(event_names),
+                    'streams': [], 'events': {}}
+        cache.save('trials', self.trials)
+        for stream_name in stream_names:
+            st = self._process_continuous_stream(h5, stream_name, cache.array_path('stream_' + stream_name))
+            if st is not None:
+                st.flush()
+                manifest['streams'].append(stream_name)
+            del st  # closes the memory map.
+        for event_name in event_names:
+            ev, fs = self._process_event_stream(h5, event_name)
+            if ev is not None:
+                cache.save('events_' + event_name, ev)
+                if isinstance(fs, np.generic):  # attributes are read as numpy scalars, which json cannot write.
+                    fs = fs.item()
+                manifest['events'][event_name] = fs
+        cache.save_manifest(manifest)
+        self._load_cache(cache, manifest)
+
+    def _load_cache(self, cache, manifest):
+        """
+        Memory-maps the trials and streams from the cache. Streams that are not in the file are None, as when they are
+        parsed.
+        """
+        self.trials = cache.load('trials')
+        for stream_name in manifest['stream_names']:
+            self.streams[str(stream_name)] = None
+        for stream_name in manifest['streams']:
+            self.streams[str(stream_name)] = cache.load('stream_' + stream_name)
+        for event_name in manifest['event_names']:
+            self.events[str(event_name)], self.event_sample_rates[str(event_name)] = None, None
+        for event_name, fs in manifest['events'].iteritems():
+            self.events[str(event_name)] = cache.load('events_' + event_name)
+            self.event_sample_rates[str(event_name)] = fs
 
     @staticmethod
     def _process_event_stream(h5, stream_name):
@@ -736,98 +1048,115 @@ class CalibrationFile(object):
         :param stream_name: string of the stream name (as enumerated in the H5 file_nm).
         :type h5: tables.File
         :type stream_name str
-        :return:
+        :return: (events array, sample rate of the stream)
         """
-        st = []
+        packets = []
         fs = None
         for trial in h5.root:
             try:
-                tr_st = trial._f_get_child(stream_name).read()
-                for i in tr_st:
-                    if i.size % 2:
-                        # Protocol convention states that event streams are sent in even length packets of [on, off]
-                        # The first event is a forced off event, so we should discard this, and subsequent stream packets
-                        # will be 'in-phase', meaning (ON, OFF, ON, OFF).
-                        continue
-                    for ii in i:
-                        st.append(ii)
-                # Get sampling rate for individual stream, if not available, set to voyeur default (1 kHz).
-                if fs is None:
-                    try:
-                        fs = tr_st.attrs['sample_rate']
-                    except KeyError:
-                        try:
-                            h5.get_node_attr('/', 'voyeur_sample_rate')
-                        except AttributeError:
-                            fs = 1000  # default == 1000
+                node = trial._f_get_child(stream_name)
+                tr_st = node.read()
             except tb.NoSuchNodeError:  # if the stream does not exist in this file_nm, return None.
-                return None
+                return None, None
             except AttributeError:  # if the table doesn't have an Events table, continue to the next trial group.
                 continue
-        # Reshape the array so that it will be 2 columns, column 1 is 'on' and column 2 is 'off'.
-        st_arr = np.array(st)
-        # this will reshape the array such that the first column is "on" events, and the second is "off events"
-        st_attr = {'sample_rate' : fs}
+            # Protocol convention states that event streams are sent in even length packets of [on, off]. The first
+            # event is a forced off event, so we should discard this, and subsequent stream packets will be 'in-phase',
+            # meaning (ON, OFF, ON, OFF).
+            sizes = np.fromiter((p.size for p in tr_st), dtype=np.int64, count=len(tr_st))
+            packets.extend(tr_st[i] for i in np.flatnonzero(sizes % 2 == 0))
+            if fs is None:
+                fs = CalibrationFile._sample_rate(h5, node)
+        st_arr = np.concatenate(packets) if packets else np.array([])
         if stream_name.startswith('lick'):
-            l = st_arr.size / 2
-            st_arr.shape = (l, 2)
-        # stream_obj = RichData(st_arr, st_attr)
-        return st_arr
+            # this will reshape the array such that the first column is "on" events, and the second is "off events"
+            st_arr = st_arr.reshape(-1, 2)
+        return st_arr, fs
+
+    @staticmethod
+    def _sample_rate(h5, node):
+        """
+        :return: sample rate of a stream node. If the node does not have one, the file's Voyeur sample rate or the
+        Voyeur default (1 kHz).
+        """
+        try:
+            return node.attrs.sample_rate
+        except AttributeError:
+            pass
+        try:
+            return h5.get_node_attr('/', 'voyeur_sample_rate')
+        except AttributeError:
+            return 1000  # default == 1000
 
     @staticmethod
-    def _process_continuous_stream(h5, stream_name):
+    def _process_continuous_stream(h5, stream_name, out_path=''):
         """
         Processes continuous analog acquisition streams (ie sniff,
 
+        The Events tables are read first to size the stream, then each trial's packets are copied into place. Memory
+        use is proportional to the length of the recording.
+
         :param h5: tables file_nm object.
         :param stream_name: string specifying the name of the stream to parse.
+        :param out_path: optional path of a .npy file to write the stream to (as a memory map) instead of memory.
         :type h5: tables.File
         :type stream_name: str
         :return: continuous sniff array.
         """
         #TODO: extract and return sampling frequency from attributes.
-        st = np.zeros(1e8, dtype=np.int16)  # allocate memory for ~ 23 hrs of recording at 1 kHz.
-        fs = None
+        frames = []
+        size = 0
         for trial in h5.root:
             try:
-                tr_events = trial.Events.read()
-                tr_st = trial._f_get_child(stream_name).read()
-                # HANDLE EMPTY FRAMES:
-                del_list=[]
-                for i, ev in enumerate(tr_events):
-                    if ev[1] == 0:
-                        del_list.append(i)
-                if del_list:
-                    tr_events = np.delete(tr_events, del_list)
-                # MOVE FROM TRIAL TO CONTINUOUS STREAM:
-                for ev, st_pkt in zip(tr_events, tr_st):
-                    tail = ev[0]
-                    head = tail - ev[1]
-                    st[head:tail] = st_pkt[:]
-                if fs is None:
-                    try:
-                        fs = tr_st.attrs['sample_rate']
-                    except KeyError:
-                        try:
-                            h5.get_node_attr('/', 'voyeur_sample_rate')
-                        except AttributeError:
-                            fs = 1000  # default == 1000
+                tails, lengths = CalibrationFile._stream_frames(trial.Events.read())
+                stream_node = trial._f_get_child(stream_name)
             except tb.NoSuchNodeError:  # if the stream does not exist in this file_nm, return None.
-                # print 'no such node'
                 return None
-            except AttributeError as e:  # if the table doesn't have an Events table, continue to the next trial group.
-                # print 'attribute error'
-                # print e
+            except AttributeError:  # if the table doesn't have an Events table, continue to the next trial group.
                 continue
-        st_attr = {'sample_rate': fs}
-        # stream_obj = RichData(st[:tail], st_attr)  # last tail is the last sample we need to save
-        return st[:tail]
+            if len(tails):
+                size = max(size, int(tails.max()))
+                frames.append((tails, lengths, stream_node))
+        if out_path:
+            st = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.int16, shape=(size,))  # zero filled.
+        else:
+            st = np.zeros(size, dtype=np.int16)
+        for tails, lengths, stream_node in frames:
+            packets = stream_node.read()
+            n = min(len(packets), len(tails))  # packets are paired with the non-empty frames in order.
+            if not n:
+                continue
+            tails, lengths = tails[:n], lengths[:n]
+            heads = tails - lengths
+            data = np.concatenate(packets[:n])
+            if np.all(heads[1:] == tails[:-1]):  # frames are usually contiguous, so the trial is one slice.
+                st[heads[0]:tails[-1]] = data
+            else:
+                offsets = np.cumsum(lengths) - lengths  # start of each packet in data.
+                st[np.repeat(heads - offsets, lengths) + np.arange(len(data))] = data
+        return st
+
+    @staticmethod
+    def _stream_frames(tr_events):
+        """
+        :param tr_events: Events table of a trial. Each row is (end sample of the frame, number of samples in frame).
+        :type tr_events: np.array
+        :return: (tails, lengths) arrays for the frames that have samples.
+        """
+        if tr_events.dtype.names:
+            tails, lengths = tr_events[tr_events.dtype.names[0]], tr_events[tr_events.dtype.names[1]]
+        else:
+            tails, lengths = tr_events[:, 0], tr_events[:, 1]
+        keep = lengths != 0  # HANDLE EMPTY FRAMES.
+        return tails[keep].astype(np.int64), lengths[keep].astype(np.int64)
 
     def return_time_period(self, start_time, end_time, read_streams=True):
         """
 
         :param start_time:
         :param end_time:
+        :param read_streams: if False, the streams of the epoch are read-only views of the file's streams instead of
+        copies. Use this when the streams are not modified (ie for display).
         :type start_time: int
         :type end_time: int
         :return:
@@ -855,18 +1184,16 @@ class CalibrationFile(object):
                 else:
                     events[k] = np.array([], dtype=ev.dtype)
         for k, stream_node in self.streams.iteritems():
+            if stream_node is None:
+                continue
             if read_streams:
                 streams[k] = np.copy(stream_node[start_time:end_time])  # reads these values from the stream node into memory.
             elif not read_streams:
-                #TODO: implement function where we can read values that we want later instead of loading into memory now.
-                pass
+                view = stream_node[start_time:end_time]  # memory-mapped streams are only read when accessed.
+                view.flags.writeable = False
+                streams[k] = view
         # assume that all 'Trials' events occur between the 'starttrial' and 'endtrial' times.
-        try:
-            starts = self.trials['starttrial']
-            ends = self.trials['endtrial']
-        except ValueError:
-            starts = self.trials['trialstart']
-            ends = self.trials['trialend']
+        starts, ends = self._trial_times()
         idx = (starts <= end_time) * (starts >= start_time) * (ends <= end_time) * (
         ends >= start_time)  # a bit redundant.
         trials = self.trials[idx]  # produces a tables.Table
@@ -902,26 +1229,133 @@ class CalibrationFile(object):
         end += padding[1]
         return self.return_time_period(start, end)
 
+    def return_trial_matrix(self, trial_indices, padding=(2000, 2000), stream_name='sniff', nsamples=None):
+        """
+        Extracts a stream for many trials at once, aligned on the trial starts.
+
+        Row i holds the samples from (start of trial i - padding[0]) on. Samples outside of the recording, and the rows
+        of trials without start or end times, are NaN.
+
+        :param trial_indices: indices of the trials within the Trials table.
+        :param padding: (samples before trial start, samples after trial end).
+        :param stream_name: name of the continuous stream.
+        :param nsamples: number of samples per trial. By default, the length of the shortest padded trial.
+        :type trial_indices: np.array
+        :type padding: tuple of [int]
+        :return: (float array of shape (ntrials, nsamples), Trials table rows of the trials)
+        :rtype: tuple
+        """
+        if np.isscalar(padding):
+            padding = [padding, padding]
+        trial_indices = np.asarray(trial_indices, dtype=np.int64)
+        trials = self.trials[trial_indices]
+        starts, ends = self._trial_times(trials)
+        valid = (starts != 0) & (ends != 0)
+        if nsamples is None:
+            lengths = ends[valid] - starts[valid] + padding[0] + padding[1]
+            nsamples = int(lengths.min()) if len(lengths) else 0
+        stream = self.streams[stream_name]
+        idx = (starts.astype(np.int64) - padding[0])[:, np.newaxis] + np.arange(nsamples)
+        in_stream = (idx >= 0) & (idx < len(stream)) & valid[:, np.newaxis]
+        matrix = np.empty((len(trial_indices), nsamples))
+        matrix.fill(np.nan)
+        matrix[in_stream] = stream[idx[in_stream]]
+        return matrix, trials
+
+    def _trial_times(self, trials=None):
+        """
+        :param trials: rows of the Trials table, by default all trials.
+        :return: (trial start times, trial end times)
+        """
+        if trials is None:
+            trials = self.trials
+        if 'starttrial' in trials.dtype.names:
+            return trials['starttrial'], trials['endtrial']
+        return trials['trialstart'], trials['trialend']
 
-@jit  # this is a >30x performance over native python (30 ms vs <1 ms)
-def remove_stream_trend(stream, slice_indeces, x=None):
+
+class EnvelopePyramid(object):
+    """
+    Min/max envelopes of a stream at decreasing resolutions, used to draw long traces with a bounded number of points.
+    Level k has bins of 2**k samples. Drawing the min and max of each bin keeps the peaks of the trace visible.
+    """
+
+    def __init__(self, stream):
+        """
+
+        :param stream: 1 dimensional stream.
+        :type stream: np.array
+        """
+        self.stream = np.asarray(stream)
+        self.levels = []  # (mins, maxs) of levels 1, 2, ...
+        mins = maxs = self.stream
+        while len(mins) > 1:
+            if len(mins) % 2:
+                mins = np.append(mins, mins[-1])
+                maxs = np.append(maxs, maxs[-1])
+            mins = np.minimum(mins[0::2], mins[1::2])
+            maxs = np.maximum(maxs[0::2], maxs[1::2])
+            self.levels.append((mins, maxs))
+
+    def points(self, x0=None, x1=None, max_points=2000):
+        """
+        Returns the points to plot the stream between samples x0 and x1, from the finest level that has at most
+        max_points points in that range.
+
+        :param x0: first sample, or None for the start of the stream.
+        :param x1: last sample, or None for the end of the stream.
+        :param max_points: maximum number of points (about twice the width of the plot in pixels).
+        :return: (x, y) arrays.
+        """
+        n = len(self.stream)
+        i0 = 0 if x0 is None else int(min(max(np.floor(x0), 0), n))
+        i1 = n if x1 is None else int(min(max(np.ceil(x1) + 1, i0), n))
+        level = 0
+        while level < len(self.levels) and 2 * ((i1 - i0) >> level) > max_points:
+            level += 1
+        if not level:
+            return np.arange(i0, i1), self.stream[i0:i1]
+        size = 1 << level
+        mins, maxs = self.levels[level - 1]
+        b0, b1 = i0 >> level, min(-(-i1 >> level), len(mins))
+        starts = np.arange(b0, b1) * size
+        x = np.empty(2 * (b1 - b0))
+        y = np.empty_like(x)
+        x[0::2] = starts
+        x[1::2] = np.minimum(starts + size - 1, n - 1)
+        y[0::2] = mins[b0:b1]
+        y[1::2] = maxs[b0:b1]
+        return x, y
+
+
+def remove_stream_trend(stream, slice_indeces, x=None, inplace=True):
     """
     Finds trend in stream[slice_indeces] using linear regression and removes it from entire stream
 
-    :param stream: stream to detrend.
+    The slope is found with the closed form least squares solution, so a 2 dimensional array of streams (one per row)
+    is detrended in a single call. NaN samples in the slice are ignored.
+
+    :param stream: stream to detrend, or 2 dimensional array with one stream per row.
     :param sample_indeces: (start, stop) indeces prior to stimulus onset. This defines the trend.
     :param x: optional x array.
+    :param inplace: if False, stream is not modified and the detrended stream is returned as a new float array.
     :return: detrended array
     :type stream: np.array
     :rtype: np.array
     """
-
-    stream_slice = stream[slice_indeces[0]:slice_indeces[1]]
-    if not x:
-        x = np.linspace(0, len(stream_slice)-1, len(stream_slice))
-    a, b, _, _, _ = stats.linregress(x, stream_slice)
-    for i in xrange(len(stream)):
-        stream[i] -= i * a
+    stream_slice = stream[..., slice_indeces[0]:slice_indeces[1]]
+    if x is None:
+        x = np.arange(stream_slice.shape[-1], dtype=np.float64)
+    valid = np.isfinite(stream_slice)
+    n = valid.sum(axis=-1)
+    xm = np.where(valid, x, 0.).sum(axis=-1) / n
+    ym = np.where(valid, stream_slice, 0.).sum(axis=-1) / n
+    dx = np.where(valid, x - xm[..., np.newaxis], 0.)
+    a = (dx * np.where(valid, stream_slice - ym[..., np.newaxis], 0.)).sum(axis=-1) / (dx * dx).sum(axis=-1)
+    trend = a[..., np.newaxis] * np.arange(stream.shape[-1])
+    if not inplace:
+        return stream - trend
+    np.subtract(stream, trend, out=stream, casting='unsafe')  # integer streams are truncated, as before.
     return stream
 
 
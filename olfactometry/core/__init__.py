@@ -0,0 +1,19 @@
+"""
+Headless olfactometry core. Device, protocol and state classes with no Qt dependency.
+
+Use this to run olfactometers from scripts or servers without a display:
+
+    from olfactometry.core import OlfactometerRig
+    rig = OlfactometerRig('C:\\your_config_dir\\your_config_name.json')
+    rig.set_odors(['pinene'])
+
+Stimuli that are presented many times can be compiled once with rig.compile_stimulus() (see plan.py).
+"""
+
+from mfc import RetryPolicy, MFCDevice, MFCAnalogDevice, MFCAlicatDigArduinoDevice, MFCAlicatDigRawDevice, \
+    MFC_DEVICES
+from dilutor import DilutorDevice, DILUTOR_DEVICES
+from olfactometer import OlfactometerDevice, TeensyOlfaDevice, VialSet, OLFACTOMETER_DEVICES
+from plan import MFCSetpoint, DilutorPlan, OlfactometerPlan, RigPlan
+from sequence import StimulusSequence, SequenceRun, SequenceStep, SequenceAck
+from rig import OlfactometerRig
@@ -0,0 +1,175 @@
+"""
+Headless dilutor device. The Dilutor widget in olfactometry.dilutor is a view over this object.
+"""
+
+import threading
+import logging
+from olfactometry.utils import OlfaException, connect_serial
+from olfactometry.transport import SerialTransport
+from olfactometry.polling import ReadingCache, PollingWorker
+from olfactometry.telemetry import DEFAULT_HISTORY_SIZE
+from olfactometry.simulator import SimulatedAlicatBus
+from mfc import MFC_DEVICES
+from plan import DilutorPlan, compile_setpoints, run_setpoints
+
+
+class DilutorDevice(object):
+    """
+    Dillutor v1 by CW.
+    """
+    # TODO: implement json? dillution factor calibration system
+    def __init__(self, config, polling_interval=1.1):
+        baudrate = 115200
+        self.com_port = config.get('com_port')  # not needed for simulated dilutors.
+        if 'simulator' in config:
+            logging.info('Starting simulated dilutor ({0})'.format(self.com_port))
+            self.serial = SimulatedAlicatBus.from_config(config)
+        else:
+            self.serial = connect_serial(self.com_port, baudrate=baudrate, timeout=1, writeTimeout=1)
+        self._eol = '\r'  # Alicats use this EOL, so we have to catch it.
+        # commands for the Alicats are terminated by the MFC classes, so the transport doesn't add a terminator.
+        self.transport = SerialTransport(self.serial, terminator='', eol=self._eol, echo=False,
+                                         name='Dilutor {0}'.format(self.com_port))
+
+        self.mfc_readings = ReadingCache(config.get('flow_history_size', DEFAULT_HISTORY_SIZE))
+        self.mfc_lock = threading.RLock()
+        self.mfcs = self._config_mfcs(config['MFCs'])
+        self.polling_interval = polling_interval
+        self.mfc_poller = self.start_mfc_polling()
+        return
+
+    def _config_mfcs(self, mfc_config):
+        mfcs = [None, None]
+        gas_positions = {'vac': 0, 'air': 1}
+        for mfc_spec in mfc_config:
+            mfc_type = mfc_spec['MFC_type']
+            gas = mfc_spec['gas']
+            mfc = MFC_DEVICES[mfc_type](self, mfc_spec)
+            mfcs[gas_positions[gas.lower()]] = mfc
+        return mfcs
+
+    def start_mfc_polling(self, polling_interval_sec=2.):
+        logging.debug('Starting MFC polling.')
+        mfc_poller = PollingWorker(self.poll_mfcs, polling_interval_sec, name='Dilutor MFC poller')
+        mfc_poller.start()
+        return mfc_poller
+
+    def poll_mfcs(self):
+        with self.mfc_lock:
+            for mfc in self.mfcs:
+                mfc.poll()
+        return
+
+    def stop_mfc_polling(self):
+        self.mfc_poller.pause()
+        return
+
+    def restart_mfc_polling(self):
+        self.mfc_poller.resume()
+        return
+
+    def send_command(self, command, tries=1):
+        # must send with '\r' end of line
+        line = None
+        for i in xrange(tries):
+            line = self.transport.send(command).result()
+        return line
+
+    def send_command_async(self, command, match=None):
+        """
+        Queues a command without waiting for the reply.
+
+        :param command: command string, including the '\r' end of line.
+        :param match: optional function recognizing the reply line (see SerialTransport.send). The Alicats do not echo
+        commands, so this is how the reply of one MFC is told apart from a late reply of the other.
+        :return: future whose result() is the reply line (or None).
+        :rtype: transport.CommandFuture
+        """
+        return self.transport.send(command, match)
+
+    def close_serial(self):
+        """
+        Stops polling and closes the serial connection (used during restarts).
+
+        :return:
+        """
+        self.mfc_poller.stop()
+        self.transport.close()
+
+    def flow_history(self, start=None, end=None):
+        """
+        :param start: start time (time.time()), or None for the oldest reading kept.
+        :param end: end time, or None for the newest reading.
+        :return: dictionary of {'mfc_<index>': history records} (see telemetry.py).
+        :rtype: dict
+        """
+        return dict(('mfc_{0}'.format(i), mfc.history(start, end)) for i, mfc in enumerate(self.mfcs) if mfc)
+
+    def set_stimulus(self, stim_dict):
+        """
+        Sets dilutor flows based on stimulus dictionary defined in generate_stimulus_template.
+
+        :param stim_dict:
+        :
+        :return: True if set completed.
+        """
+        a = stim_dict['vac_flow']
+        b = stim_dict['air_flow']
+        return self.set_flows((a, b))
+
+    def set_flows(self, flows):
+        """
+        Sets flowrates of attached MFCs.
+
+        :param flows: iterable of flowrates to set MFCs, ordered as (vac, air).
+        :return:
+        """
+        if not len(flows) == len(self.mfcs):
+            ex_str = 'Number of flows specified ({0}) not equal to number of MFCs in Dilutor ({1}).'.format(len(flows),
+                                                                                                         len(self.mfcs))
+            raise OlfaException(ex_str)
+        else:
+            successes = []
+            with self.mfc_lock:
+                for mfc, flow in zip(self.mfcs, flows):
+                    success = mfc.set_flowrate(flow)
+                    successes.append(success)
+            return all(successes)
+
+    def compile_stimulus(self, stim_dict):
+        """
+        Compiles a stimulus dictionary (as used by set_stimulus) into a plan that can be run many times.
+
+        :param stim_dict: dictionary conforming to the stimulus template.
+        :return: plan for run_stimulus_plan().
+        :rtype: plan.DilutorPlan
+        """
+        flows = (stim_dict['vac_flow'], stim_dict['air_flow'])
+        return DilutorPlan(compile_setpoints(self.mfcs, flows, 'Dilutor'))
+
+    def run_stimulus_plan(self, plan):
+        """
+        Sets the flows of a plan from compile_stimulus(). MFCs that are already at their setpoint are not set again.
+
+        :param plan: DilutorPlan compiled by this dilutor.
+        :return: True if set completed.
+        :rtype: bool
+        """
+        with self.mfc_lock:
+            return run_setpoints(plan.setpoints)
+
+    def generate_stimulus_template_string(self):
+        stim_template_dict = {'dilution_factor': 'float (optional)',
+                              'vac_flow': 'int flowrate in flow units',
+                              'air_flow': 'int flowrate in flow units',}
+        return stim_template_dict
+
+    def generate_tables_definition(self):
+        import tables
+        tables_def = {'dilution_factor': tables.Float64Col(),
+                      'vac_flow': tables.Float64Col(),
+                      'air_flow': tables.Float64Col()}
+        return tables_def
+
+
+DILUTOR_DEVICES = {'serial_forwarding': DilutorDevice,}
@@ -0,0 +1,514 @@
+"""
+Headless MFC devices. These implement the protocol for each MFC type and have no Qt dependency. The MFC widgets in
+olfactometry.mfc are views over these objects.
+"""
+
+import time
+import logging
+
+
+class RetryPolicy(object):
+    """
+    Bounded retry schedule for MFC transactions that have to wait for the MFC (ie waiting for an Alicat to reply).
+
+    Each attempt waits for its reply to arrive instead of polling, and attempts are spaced with exponential backoff so
+    the olfactometer is not flooded with repeat requests. All attempts must complete before the deadline, which is
+    measured in wall clock time.
+
+    The policy is configurable per MFC using an optional "retry" object in the MFC configuration, ie:
+        "retry": {"timeout": 0.2, "backoff": 0.002, "backoff_factor": 2, "max_backoff": 0.05}
+    """
+
+    def __init__(self, timeout=.2, backoff=.002, backoff_factor=2., max_backoff=.05):
+        """
+
+        :param timeout: total time allowed for a transaction in seconds.
+        :param backoff: delay before the first retry in seconds.
+        :param backoff_factor: factor to increase the delay by after every retry.
+        :param max_backoff: maximum delay between retries in seconds.
+        """
+        self.timeout = float(timeout)
+        self.backoff = float(backoff)
+        self.backoff_factor = float(backoff_factor)
+        self.max_backoff = float(max_backoff)
+
+    @classmethod
+    def from_config(cls, retry_config=None):
+        """
+        Builds a policy from the "retry" object of an MFC configuration. Missing values use the defaults.
+
+        :param retry_config: dict or None.
+        :rtype: RetryPolicy
+        """
+        if not retry_config:
+            return cls()
+        return cls(**retry_config)
+
+    def deadline(self):
+        """
+        :return: wall clock time at which a transaction starting now must be completed.
+        :rtype: float
+        """
+        return time.time() + self.timeout
+
+    def attempts(self, deadline=None):
+        """
+        Generator that yields once per attempt with the time remaining before the deadline. It sleeps with
+        exponential backoff between attempts and stops when the deadline is reached. There is always one attempt.
+
+        :param deadline: optional wall clock deadline (from deadline()) to share one budget between several loops.
+        """
+        if deadline is None:
+            deadline = self.deadline()
+        delay = self.backoff
+        yield max(deadline - time.time(), 0.)
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0.:
+                return
+            time.sleep(min(delay, remaining))
+            delay = min(delay * self.backoff_factor, self.max_backoff)
+            remaining = deadline - time.time()
+            if remaining <= 0.:
+                return
+            yield remaining
+
+
+class MFCDevice(object):
+    """
+    Base class for MFCs. Communication goes through the parent device (olfactometer or dilutor), which owns the serial
+    port and the reading cache that polled flows are stored in.
+    """
+
+    def __init__(self, parent_device, mfc_config, flow_units='SCCM', setflow=-1):
+        """
+
+        :param parent_device: Parent olfactometer or dilutor device.
+        :param mfc_config: MFC configuration dictionary (see readme for specs on configuration file)
+        :param flow_units: units of the MFC capacity.
+        :param setflow: flowrate to set on startup. If outside of capacity, the current flow is read instead.
+        :return:
+        """
+        self.parent_device = parent_device
+        self.mfc_type = mfc_config['MFC_type']
+        self.capacity = int(mfc_config['capacity'])
+        self.units = flow_units
+        self.gas = mfc_config['gas']
+        if self.mfc_type.startswith('alicat_digital'):
+            self.address = mfc_config['address']
+        if 'arduino_port_num' in mfc_config.keys():  # this is only needed for Teensy olfactometers. This is the device ID
+            self.arduino_port = int(mfc_config['arduino_port_num'])
+        self.retry_policy = RetryPolicy.from_config(mfc_config.get('retry'))
+        self.setpoint = None  # last confirmed setpoint in units of capacity, None if unknown.
+
+        # readings are shared with the parent device, which polls on a background thread.
+        self.readings = parent_device.mfc_readings
+
+        if setflow < 0 or setflow > self.capacity:
+            flow = self.get_flowrate()
+            if flow is not None:
+                self.readings.update(self, flow, self._normalized_setpoint())
+        else:
+            self.set_flowrate(setflow)
+
+    @property
+    def name(self):
+        return "{0} {1:0.1f}{2}".format(self.gas, self.capacity, self.units)
+
+    @property
+    def reading(self):
+        """
+        Latest reading from the reading cache.
+
+        :rtype: polling.FlowReading
+        """
+        return self.readings.get(self)
+
+    @property
+    def flow(self):
+        """
+        Latest flow reading normalized to capacity, from the reading cache.
+        """
+        return self.readings.get(self).flow
+
+    @property
+    def last_poll_time(self):
+        """
+        Time of the latest successful flow reading, from the reading cache.
+        """
+        return self.readings.get(self).timestamp
+
+    def history(self, start=None, end=None):
+        """
+        Flow readings recorded between start and end (see telemetry.py).
+
+        :param start: start time (time.time()), or None for the oldest reading kept.
+        :param end: end time, or None for the newest reading.
+        :rtype: numpy.ndarray
+        """
+        return self.readings.history(self, start, end)
+
+    def poll(self):
+        return self.finish_poll(self.start_poll())
+
+    def start_poll(self):
+        """
+        Sends the commands needed to read the flow without waiting for the replies, so that several MFCs can be
+        queried at once. The returned object is passed to finish_poll().
+
+        :return: pending request, or None if the MFC cannot split its read transaction.
+        """
+        return None
+
+    def finish_poll(self, pending):
+        """
+        Completes a poll started with start_poll() and records the reading in the reading cache.
+
+        :param pending: object returned by start_poll().
+        :return: False if there is a reportable polling error, True otherwise.
+        :rtype: bool
+        """
+        if pending is None:
+            flow = self.get_flowrate()
+        else:
+            flow = self._read_flowrate(pending)
+        return self._update_flow(flow)
+
+    def _update_flow(self, flow):
+        """
+        Records a flow reading (or a failed reading if flow is None) in the reading cache. This can run on the polling
+        thread, so it must not touch the widgets. The display is refreshed from the cache by update_display().
+
+        :param flow: flow normalized to capacity, or None if the reading failed.
+        :return: False if there is a reportable polling error, True otherwise.
+        :rtype: bool
+        """
+        self.readings.update(self, flow, self._normalized_setpoint())
+        if flow is not None:
+            return True
+        else:
+            if hasattr(self.parent_device, 'polling_interval'):
+                if time.time() - self.last_poll_time > self.parent_device.polling_interval * 2:
+                    horror = True
+                else:
+                    horror = False
+            else:
+                horror = True
+            return not horror  # this will return false if there is a reportable error and true otherwise.
+
+    def _normalized_setpoint(self):
+        if self.setpoint is None:
+            return None
+        return float(self.setpoint) / self.capacity
+
+    def setpoint_command(self, flowrate):
+        """
+        Formats the command that sets a flowrate, so that it can be stored in a stimulus plan.
+
+        :param flowrate: flowrate in units of self.capacity.
+        :return: command string, or None if the flowrate cannot be set with a single command.
+        """
+        return None
+
+    def start_set_flowrate(self, flowrate, command=None):
+        """
+        Sends a new setpoint without waiting for confirmation. The returned object is passed to finish_set_flowrate().
+
+        :param flowrate: flowrate in units of self.capacity.
+        :param command: optional command from setpoint_command(flowrate), to avoid formatting it again.
+        :return: pending request.
+        """
+        return flowrate
+
+    def finish_set_flowrate(self, pending):
+        """
+        Completes a setpoint change started with start_set_flowrate().
+
+        :param pending: object returned by start_set_flowrate().
+        :return: True if the setpoint was confirmed.
+        :rtype: bool
+        """
+        success = self.set_flowrate(pending)
+        self.setpoint = pending if success else None
+        return success
+
+    def set_flowrate(self, flowrate):
+        pass
+
+    def get_flowrate(self):
+        pass
+
+    def _retry(self, command, done, first=None, deadline=None, match=None):
+        """
+        Sends a command until done(reply) is True or the retry policy deadline passes. Each attempt blocks until its
+        reply arrives (or the deadline passes) and attempts are spaced by the policy's backoff.
+
+        :param command: command to send to the parent device.
+        :param done: function taking the reply string and returning True if no more attempts are needed.
+        :param first: optional future for an attempt that is already in flight.
+        :param deadline: optional wall clock deadline shared with other retry loops.
+        :param match: optional function recognizing the reply line (see SerialTransport.send).
+        :return: last reply received, or None.
+        """
+        reply = None
+        for remaining in self.retry_policy.attempts(deadline):
+            if first is not None:
+                future, first = first, None
+            else:
+                future = self.parent_device.send_command_async(command, match)
+            reply = future.result(remaining)
+            if reply is not None and done(reply):
+                break
+        return reply
+
+    def _read_flowrate(self, pending):
+        pass
+
+
+
+class MFCAnalogDevice(MFCDevice):
+    def setpoint_command(self, flowrate):
+        if flowrate > self.capacity or flowrate < 0:
+            return None
+        return "MFC " + str(self.parent_device.slaveindex) + " " + str(self.arduino_port) + " " + str(flowrate * 1.0 / self.capacity)
+
+    def get_flowrate(self, *args, **kwargs):
+        """ get MFC flow rate measure as a percentage of total capacity (0.0 to 100.0)"""
+
+        command = "MFC " + str(self.parent_device.slaveindex) + " " + str(self.arduino_port)
+        rate = self.parent_device.send_command(command)
+        if (rate < 0):
+            print "Couldn't get MFC flow rate measure"
+            print "mfc index: " + str(self.arduino_port), "error code: ", rate
+            return None
+        else:
+            return float(rate)
+
+    def set_flowrate(self, flowrate, *args, **kwargs):
+        """ sets the value of the MFC flow rate setting as a % from 0.0 to 100.0
+            argument is the absolute flow rate """
+        return self.finish_set_flowrate(self.start_set_flowrate(flowrate))
+
+    def start_set_flowrate(self, flowrate, command=None):
+        if flowrate > self.capacity or flowrate < 0:
+            return None  # warn about setting the wrong value here
+        # if the rate is already what it should be don't do anything
+        flow = self.flow
+        if flow is not None and abs(flowrate - flow) < 0.0005:
+            return flowrate, None  # floating points have inherent imprecision when using comparisons
+        if command is None:
+            command = self.setpoint_command(flowrate)
+        return flowrate, self.parent_device.send_command_async(command)
+
+    def finish_set_flowrate(self, pending):
+        self.setpoint = None
+        if pending is None:
+            return False
+        flowrate, future = pending
+        if future is not None:
+            set = future.result()
+            if(set != "MFC set\r\n"):
+                print "Error setting MFC: ", set
+                return False
+        self.setpoint = flowrate
+        return True
+
+class MFCAlicatDigArduinoDevice(MFCDevice):
+    def set_flowrate(self, flowrate):
+        """
+
+        :param flowrate: flowrate in units of self.capacity (usually ml/min)
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        return self.finish_set_flowrate(self.start_set_flowrate(flowrate))
+
+    def setpoint_command(self, flowrate):
+        if flowrate > self.capacity or flowrate < 0:
+            return None
+        flownum = (flowrate * 1. / self.capacity) * 64000.
+        flownum = int(flownum)
+        return "DMFC {0:d} {1:d} A{2:d}".format(self.parent_device.slaveindex, self.arduino_port, flownum)
+
+    def start_set_flowrate(self, flowrate, command=None):
+        # print "Setting rate of: ", flowrate
+        if command is None:
+            command = self.setpoint_command(flowrate)
+        if command is None:
+            return None
+        return flowrate, self.parent_device.send_command_async(command)
+
+    def finish_set_flowrate(self, pending):
+        success = False
+        self.setpoint = None
+        if pending is None:
+            return success
+        deadline = self.retry_policy.deadline()
+        flowrate, future = pending
+        confirmation = future.result()
+        if(confirmation != "MFC set\r\n"):
+            print "Error setting MFC: ", confirmation
+        else:
+            self.setpoint = flowrate
+            # Attempt to read back, waiting until the Alicat has replied (Error -2 means no reply yet).
+            success = True
+            command = "DMFC {0:d} {1:d}".format(self.parent_device.slaveindex, self.arduino_port)
+            self._retry(command, lambda r: not r.startswith('Error -2'), deadline=deadline)
+        return success
+
+    def get_flowrate(self):
+        """
+
+        :param args:
+        :param kwargs:
+        :return: float flowrate normalized to max flowrate.
+        """
+        if self.parent_device is None:
+            return
+        return self._read_flowrate(self._request_flowrate())
+
+    def start_poll(self):
+        return self._request_flowrate()
+
+    def _request_flowrate(self):
+        """
+        Asks the Alicat for a data frame. The flush and the request are queued together so that requests to several
+        MFCs can be in flight at once.
+
+        :return: (flush, request) futures.
+        """
+        command = "DMFC {0:d} {1:d} A".format(self.parent_device.slaveindex, self.arduino_port)
+        command_get = "DMFC {0:d} {1:d}".format(self.parent_device.slaveindex, self.arduino_port)
+        # first, flush the buffer on the Teensy, then ask the Alicat for a data frame:
+        return self.parent_device.send_command_async(command_get), self.parent_device.send_command_async(command)
+
+    def _read_flowrate(self, pending):
+        """
+        Collects the data frame requested by _request_flowrate().
+
+        :param pending: (flush, request) futures returned by _request_flowrate().
+        :return: float flowrate normalized to max flowrate.
+        """
+        deadline = self.retry_policy.deadline()
+        command = "DMFC {0:d} {1:d} A".format(self.parent_device.slaveindex, self.arduino_port)
+        command_get = "DMFC {0:d} {1:d}".format(self.parent_device.slaveindex, self.arduino_port)
+
+        flush, request = pending
+        flush.result()
+        # retry until the olfactometer confirms that it forwarded the request to the alicat.
+        self._retry(command, lambda r: r.startswith("MFC set"), first=request, deadline=deadline)
+        # retry until the olfactometer has the flow data from the alicat.
+        returnstring = self._retry(command_get, lambda r: not r.startswith("Error -2"), deadline=deadline)
+        # once it returns a good string, parse the string and return the flow.
+        return self._parse_flowrate(returnstring)
+
+    def poll_reply(self, returnstring):
+        """
+        Updates the MFC from a data frame that was read by a batched poll of all MFCs on the olfactometer.
+
+        :param returnstring: Alicat data frame, or an error string from the olfactometer.
+        :return: False if there is a reportable polling error, True otherwise.
+        :rtype: bool
+        """
+        return self._update_flow(self._parse_flowrate(returnstring))
+
+    def _parse_flowrate(self, returnstring):
+        """
+        Parses an Alicat data frame.
+
+        :param returnstring: data frame string (ie "A +014.70 +025.00 +02.004 +02.004 02.000 N2")
+        :return: float flowrate normalized to max flowrate, or None if the frame cannot be parsed.
+        """
+        if returnstring is None:
+            returnstring = ''
+        li = returnstring.split(' ')
+        if len(li) > 4:
+            r_str = li[4]  # 5th column is mass flow, so index 4.
+            try:
+                flow = float(r_str)
+                if self.capacity > 1000:
+                    flow *= 1000.
+                flow = flow / self.capacity  # normalize as per analog api.
+            except ValueError:
+                flow = None
+            if flow is not None and flow < 0:
+                logging.error('MFC reporting negative flow.')
+                logging.error(returnstring)
+        else:
+            flow = None
+            # Failure
+
+        return flow
+
+
+class MFCAlicatDigRawDevice(MFCDevice):
+    def set_flowrate(self, flowrate):
+        return self.finish_set_flowrate(self.start_set_flowrate(flowrate))
+
+    def setpoint_command(self, flowrate):
+        if flowrate > self.capacity or flowrate < 0.:
+            return None
+        flownum = (flowrate * 1. / self.capacity) * 64000.
+        flownum = int(flownum)
+        return "{0}{1}\r".format(self.address, flownum)
+
+    def start_set_flowrate(self, flowrate, command=None):
+        if command is None:
+            command = self.setpoint_command(flowrate)
+        if command is None:
+            raise ValueError('Flow rate supplied ({0}) is above capacity ({1}) or below 0.'.format(flowrate, self.capacity))
+        return flowrate, self.parent_device.send_command_async(command, self._is_own_frame)
+
+    def finish_set_flowrate(self, pending):
+        flowrate, future = pending
+        confirmation = future.result()
+        # the Alicat replies with its data frame, unless the command or the reply was lost.
+        if confirmation is None or not self._is_own_frame(confirmation):
+            logging.warning('No reply setting MFC {0}.'.format(self.address))
+            self.setpoint = None
+            return False
+        self.setpoint = flowrate
+        return True
+
+    def _is_own_frame(self, line):
+        """
+        :return: True if line is a data frame from this MFC. The MFCs of a dilutor share the bus, and data frames start
+        with the unit ID of the MFC that sent them.
+        """
+        words = line.split()
+        return bool(words) and words[0] == self.address
+
+    def get_flowrate(self):
+        command = "{0}\r".format(self.address)
+        # wait for the data frame to arrive, up to the retry policy's timeout.
+        returnstring = self._retry(command, self._is_own_frame, match=self._is_own_frame)
+        if returnstring is None:
+            returnstring = ''
+        li = returnstring.split(' ')
+        if len(li) > 4:
+            r_str = li[4]  # 5th column is mass flow, so index 4.
+            try:
+                flow = float(r_str)
+            except ValueError:  # garbled or partial frame.
+                logging.warning('Cannot parse data frame from MFC {0}: {1}'.format(self.address, repr(returnstring)))
+                return None
+            if self.capacity > 1000:
+                flow *= 1000.
+            flow = flow / self.capacity  # normalize as per analog api.
+            if (flow < 0):
+                print "Couldn't get MFC flow rate measure"
+                print "mfc index: " + str(self.address), "error code: ", flow
+                return None
+        else:
+            flow = None
+            # Failure
+        return flow
+
+        pass
+
+
+MFC_DEVICES = {'analog': MFCAnalogDevice,
+               'alicat_digital': MFCAlicatDigArduinoDevice,
+               'alicat_digital_raw': MFCAlicatDigRawDevice}
+
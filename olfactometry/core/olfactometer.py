@@ -0,0 +1,888 @@
+"""
+Headless olfactometer devices. These own the serial connection, MFCs, dilutors and vial state and have no Qt
+dependency. The olfactometer widgets in olfactometry.olfactometer are views over these objects.
+"""
+
+import time
+import threading
+import logging
+from bisect import bisect_left
+from olfactometry.utils import OlfaException, flatten_dictionary, connect_serial
+from olfactometry.transport import SerialTransport, FramedTransport
+from olfactometry.polling import ReadingCache, PollingWorker
+from olfactometry.telemetry import DEFAULT_HISTORY_SIZE
+from olfactometry.simulator import SimulatedTeensy
+from mfc import MFC_DEVICES, MFCAlicatDigArduinoDevice
+from dilutor import DILUTOR_DEVICES
+from plan import OlfactometerPlan, compile_setpoints, run_setpoints
+from sequence import SequenceRun, SequenceAck, MAX_SEQUENCE_STEPS, SEQUENCE_TIMEOUT_MARGIN
+
+
+class OlfactometerDevice(object):
+    """
+    Base class for olfactometer devices.
+
+    Objects that need to know when a vial changes (ie the vial buttons of the gui) can register a function with
+    add_vial_listener(). It is called with the number of the vial that changed.
+    """
+
+    def __init__(self):
+        self.check_flows_before_opening = True  # this will check
+        self._vial_listeners = []
+
+    def add_vial_listener(self, fn):
+        """
+        Registers fn(vial_num) to be called whenever a vial is set.
+        """
+        self._vial_listeners.append(fn)
+
+    def remove_vial_listener(self, fn):
+        self._vial_listeners.remove(fn)
+
+    def _vial_changed(self, vial_num):
+        for fn in self._vial_listeners:
+            fn(vial_num)
+
+    def set_stimulus(self, stimulus_dict):
+        pass
+
+    def compile_stimulus(self, stimulus_dict):
+        raise OlfaException('compile_stimulus is not supported by this olfactometer class')
+
+    def run_stimulus_plan(self, plan, open_vials=True):
+        pass
+
+    def set_odor(self, odor, conc=None, valvestate=None):
+        pass
+
+    def set_flows(self, flows):
+        pass
+
+    def run_sequence(self, sequence, override_checks=False):
+        raise OlfaException('Stimulus sequences are not supported by this olfactometer class')
+
+    def check_flows(self):
+        pass
+
+    def send_command(self, command, tries=1):
+        pass
+
+    def send_command_async(self, command, match=None):
+        pass
+
+    def stop_mfc_polling(self):
+        raise OlfaException('stop_mfc_polling must be defined by olfactometer class')
+
+    def restart_mfc_polling(self):
+        pass
+
+    def all_off(self):
+        """
+        Mandatory function to turn off all valves.
+        :return:
+        """
+        pass
+
+    def set_vial(self, val):
+        """
+        Mandatory function to open a valve.
+        :return:
+        """
+        pass
+
+    def close_serial(self):
+        """
+        Mandatory function to close physical devices so that the olfactometer can be deleted. Called during a restart.
+        :return:
+        """
+
+    def flow_history(self, start=None, end=None):
+        """
+        :return: dictionary of {name: history records} for the MFCs of the olfactometer and its dilutors.
+        """
+        return {}
+
+    def generate_tables_definition(self):
+        pass
+
+    def generate_stimulus_template_string(self):
+        pass
+
+
+class VialSet(object):
+    """
+    Identity of the vials on an olfactometer (ie odor and concentration), as specified by the "Vials" configuration.
+
+    The configuration is indexed by odor name when the vialset is built (a new vialset is built when the configuration
+    is reloaded), so find_odor() does not search the configuration.
+    """
+
+    def __init__(self, valve_config):
+        """
+
+        :param valve_config: "Vials" dictionary of a single olfactometer configuration.
+        """
+        self.valve_config = valve_config
+        self.valve_numbers = [int(s) for s in valve_config.keys()]
+        self.valve_numbers.sort()
+        self.dummyvial = self._config_dummy(valve_config)
+        self._build_index(valve_config)
+
+    @staticmethod
+    def _normalize_odor(odor):
+        return odor.strip().lower()
+
+    def _build_index(self, valve_config):
+        """
+        Builds the lookup tables:
+            self._odor_index: {normalized odor: ([sorted concentrations], [vials in the same order], [all vials])}
+            self._vial_index: {vial: (odor, concentration)}
+        """
+        odors = {}
+        self._vial_index = {}
+        for k, v in valve_config.iteritems():
+            vial = int(k)
+            odor = v.get('odor')
+            conc = v.get('conc')
+            self._vial_index[vial] = (odor, conc)
+            if odor is None:
+                continue
+            odors.setdefault(self._normalize_odor(odor), []).append((conc, vial))
+        self._odor_index = {}
+        for odor, entries in odors.iteritems():
+            with_conc = sorted((c, vial) for c, vial in entries if c is not None)
+            self._odor_index[odor] = ([c for c, _ in with_conc], [vial for _, vial in with_conc],
+                                      sorted(vial for _, vial in entries))
+        return
+
+    def odor_at(self, vial_num):
+        """
+        Reverse lookup of the vial contents.
+
+        :param vial_num: vial number.
+        :return: (odor, concentration) of the vial, (None, None) for vials not in the configuration.
+        :rtype: tuple
+        """
+        return self._vial_index.get(int(vial_num), (None, None))
+
+    def _config_dummy(self, valve_config):
+        dummys = []
+        for k, v in valve_config.iteritems():
+            if v.get('odor', '').lower() == 'dummy':
+                dummy = int(k)
+                dummys.append(dummy)
+        if len(dummys) > 1:
+            logging.error('Dummy vials: {0}'.format(dummys))
+            raise OlfaException("Configuration file must specify one dummy vial.")
+        elif len(dummys) < 1:
+            dummy = 4  # this is default for the teensy olfa.
+            logging.warning('Dummy not specified, using vial 4.')
+        return dummy
+
+    def status_string(self, valnum):
+        """
+        :param valnum: vial number.
+        :return: description of the vial contents, from "status_str" or from the odor and concentration.
+        :rtype: str
+        """
+        val = self.valve_config[str(valnum)]
+        try:
+            return val.get('status_str', "Vial: {0} [{1}]".format(val['odor'], val['conc']))
+        except KeyError:
+            return 'No odor+conc or status_str specified.'
+
+    def find_odor(self, odor, conc=None):
+        """
+        Finds the exact matches for a vial with the specified odor / concentration.  Concentration is optional if only
+        one vial with the odor is present in the configuration.
+
+        ** Raises exemption if no matches are found or if multiple matches are found. **
+
+        :param odor: string for odor.
+        :param conc: float concentration, optional.
+        :return: integer of the vial where odor/concentration found.
+        :rtype: int
+        """
+        concs, vials, all_vials = self._odor_index.get(self._normalize_odor(odor), ((), (), ()))
+        if conc:
+            tol = abs(conc) * 1e-6
+            odor_conc_matches = []
+            for i in xrange(bisect_left(concs, conc - tol), len(concs)):
+                if concs[i] - conc >= tol:
+                    break
+                if abs(concs[i] - conc) < tol:
+                    odor_conc_matches.append(vials[i])
+        else:
+            odor_conc_matches = all_vials
+
+        if not odor_conc_matches:
+            logging.debug('Vialset: {0}'.format(self.valve_config))
+            raise OlfaException('Cannot find specified odor/concentration in vialset (odor: {0}, conc: {1}).'.format(odor, conc))
+        elif len(odor_conc_matches) > 1:
+            logging.debug('Matching vials: {0}'.format(odor_conc_matches))
+            raise OlfaException('Multiple matches for odor/concentration found in vialset (odor: {0}, conc: {1}).'.format(odor, conc))
+        else:
+            return odor_conc_matches[0]
+
+
+class TeensyOlfaDevice(OlfactometerDevice):
+
+    def __init__(self, config_dict, mfc_polling_interval=2.):
+        """
+
+        :param config_dict: _Single_ olfactometer configuration dictionary (see readme for specs on configuration file)
+        :param mfc_polling_interval: MFC polling interval in seconds.
+        :return:
+        """
+        super(TeensyOlfaDevice, self).__init__()
+        self.config = config_dict
+        self.slaveindex = config_dict['slave_index']
+        self.polling_interval = mfc_polling_interval
+        self.com_port = config_dict.get('com_port')  # not needed for simulated olfactometers.
+
+        self.batch_mfc_poll = config_dict.get('batch_mfc_poll', True)  # set false for firmware without DMFCpoll.
+        self.vials = VialSet(config_dict['Vials'])
+        self.dummyvial = self.vials.dummyvial
+        self.checked_id = self.dummyvial
+        self.valve_lockout = 1.  # seconds to wait after closing a vial before another can be opened.
+        self._lockout_until = 0.
+
+        # CONFIGURE SERIAL
+        baudrate = 115200
+
+        if 'simulator' in config_dict:
+            logging.info('Starting simulated Teensy Olfactometer ({0})'.format(self.com_port))
+            self.serial = SimulatedTeensy.from_config(config_dict)
+        else:
+            logging.info('Starting Teensy Olfactometer on {0}'.format(self.com_port))
+            self.serial = connect_serial(self.com_port, baudrate=baudrate, timeout=1, writeTimeout=1)
+        if config_dict.get('binary_protocol', False):
+            self.transport = FramedTransport(self.serial, terminator='\r', echo=True, async_prefix='!',
+                                             name='Teensy {0}'.format(self.com_port))
+            self.transport.negotiate()  # falls back to ASCII with firmware that does not support framing.
+        else:
+            self.transport = SerialTransport(self.serial, terminator='\r', echo=True, async_prefix='!',
+                                             name='Teensy {0}'.format(self.com_port))
+        self._sequence_run = None
+        self.transport.add_async_listener(self._handle_async_line)
+
+        # CONFIGURE DEVICES
+        self.mfc_readings = ReadingCache(config_dict.get('flow_history_size', DEFAULT_HISTORY_SIZE))
+        self.mfc_lock = threading.RLock()  # held for MFC transactions so polling doesn't interleave with setpoints.
+        self.dilutors = self._config_dilutors(config_dict.get('Dilutors', {}))
+        self.mfcs = self._config_mfcs(config_dict['MFCs'])
+        self._poll_mfcs()
+        self._mfc_poller = self._start_mfc_polling(mfc_polling_interval)
+
+        self.all_off()
+
+    def set_stimulus(self, stimulus_dict, open_vials=True):
+        """
+        Sets stimulus based on stimulus dictionary defined in self.generate_stimulus_template()
+
+        :param stimulus_dict: dictionary conforming to stimulus template.
+        :type stimulus_dict: dict
+        :return: True if stimulus set successfully.
+        :rtype: bool
+        """
+        successes = []
+        dilspecs = stimulus_dict['dilutors']
+        odor = stimulus_dict['odor']
+        try:
+            vialconc = stimulus_dict['vialconc']
+        except KeyError:
+            vialconc = None
+        for i in xrange(len(dilspecs)):
+            dilutor = self.dilutors[i]
+            k = 'dilutor_{0}'.format(i)
+            success = dilutor.set_stimulus(dilspecs[k])
+            successes.append(success)
+        flows = []
+        for i in xrange(2):
+            k = 'mfc_{0}_flow'.format(i)
+            flows.append(stimulus_dict[k])
+        successes.append(self.set_flows(flows))
+        if open_vials:
+            successes.append(self.set_odor(odor, vialconc))
+        return all(successes)
+
+    def compile_stimulus(self, stimulus_dict):
+        """
+        Compiles a stimulus dictionary (as used by set_stimulus) into a plan that can be run many times with
+        run_stimulus_plan(). The vial is found and the MFC commands are formatted here, so an odor that is not in the
+        vialset raises an OlfaException when compiling rather than when running.
+
+        :param stimulus_dict: dictionary conforming to stimulus template.
+        :type stimulus_dict: dict
+        :return: immutable stimulus plan.
+        :rtype: plan.OlfactometerPlan
+        """
+        dilspecs = stimulus_dict['dilutors']
+        odor = stimulus_dict['odor']
+        vialconc = stimulus_dict.get('vialconc')
+        if isinstance(odor, str) and odor:
+            vial = self.vials.find_odor(odor, vialconc)
+        elif isinstance(odor, int):  # a valve was specified.
+            vial = odor
+        else:
+            vial = 0
+        dilutor_plans = []
+        for i in xrange(len(dilspecs)):
+            k = 'dilutor_{0}'.format(i)
+            dilutor_plans.append(self.dilutors[i].compile_stimulus(dilspecs[k]))
+        flows = [stimulus_dict['mfc_{0}_flow'.format(i)] for i in xrange(len(self.mfcs))]
+        setpoints = compile_setpoints(self.mfcs, flows, 'olfa')
+        return OlfactometerPlan(vial, setpoints, tuple(dilutor_plans))
+
+    def run_stimulus_plan(self, plan, open_vials=True):
+        """
+        Sets the stimulus of a plan from compile_stimulus(). Unlike set_stimulus, which toggles the vial, this only
+        opens the vial: if it is already open, it is left open. MFCs that are already at their setpoint are not set.
+
+        :param plan: OlfactometerPlan compiled by this olfactometer.
+        :param open_vials: set False to only set the flows.
+        :return: True if stimulus set successfully.
+        :rtype: bool
+        """
+        successes = []
+        for dilutor, dilutor_plan in zip(self.dilutors, plan.dilutors):
+            successes.append(dilutor.run_stimulus_plan(dilutor_plan))
+        with self.mfc_lock:
+            successes.append(run_setpoints(plan.setpoints))
+        if open_vials and plan.vial and plan.vial != self.checked_id:
+            successes.append(self.set_vial(plan.vial, 1))
+        return all(successes)
+
+    def set_odor(self, odor, conc=None, valvestate=None):
+        """
+        Finds the exact matches for a vial with the specified odor / concentration.  Concentration is optional if only
+        one vial with the odor is present in the configuration.
+
+        ** Raises exemption if no matches are found or if multiple matches are found. **
+
+        :param odor: String to specify odor.  None, False, or '' will open no vial and return True.
+        :param conc: Float concentration, optional.
+        :param valvestate: Optionally explicitly state whether to open or close valve. Pass True to open, False to close.
+        :return: True if setting appears to be successful.
+        :rtype: bool
+        """
+        if isinstance(odor, str) and odor:
+            vnum = self.vials.find_odor(odor, conc)
+            return self.set_vial(vnum, valvestate)
+        elif isinstance(odor, int):  # a valve was specified.
+            return self.set_vial(odor, valvestate)
+        else:  # no odor specified. Return true because you were asked to do nothing and complied.
+            return True
+
+    def set_vial(self, vial_num, valvestate=None, override_checks=False):
+        """
+        Sets a vial by number. This vial corresponds to the vial number in the teensy. It opens/closes a pair of valves
+        using the "vialOn"/"vialOff" commands. Teensy handles actuating the pair of valves for the vial.
+
+        :param vial_num: Vial number to actuate. None, False, or 0 will open no vial and return True.
+        :param valvestate: Optionally explicitly state whether to open or close valve. Pass True to open, False to close.
+        :param override_checks: Optionally override flow checks and lockout timing. Used for cleaning.
+        :return: True if setting appears to be successful.
+        :rtype: bool
+        """
+        if vial_num:
+            set_completed = False  # this is returned. Set to true if things go ok.
+
+            if valvestate is None:
+                if vial_num == self.checked_id:
+                    valvestate = 0
+                else:
+                    valvestate = 1
+
+            if vial_num == self.dummyvial:
+                return self.set_dummy_vial(valvestate)
+
+            if valvestate:  # we're opening a vial, so we have to check some conditions first.
+                if not self.check_flows() and not override_checks:
+                    logging.warning("MFCs reporting no flow. Cannot open valve.")
+                elif not self.checked_id == self.dummyvial and not override_checks:
+                    logging.warning('Operation not permitted: another valve is open and must be closed before opening another.')
+                elif vial_num == self.checked_id:
+                    logging.warning('Valve is already open.')
+                elif self.valve_locked_out() and not override_checks:
+                    logging.warning('Cannot open vial. Must wait 1 second after last valve closed to prevent cross=contamination.')
+                else:
+                    set_completed = self._set_valveset(vial_num, valvestate)
+                    if set_completed:
+                            logging.info('Opened vial {0} ({1}, {2}).'.format(vial_num, *self.vials.odor_at(vial_num)))
+                            self._lockout_until = float('inf')  # locked out until this vial is closed.
+                            self.checked_id = vial_num
+                            self._vial_changed(self.checked_id)
+
+            elif not valvestate:
+                if not vial_num == self.checked_id:
+                    logging.warning('Cannot close valve, it is not open.')
+                else:
+                    set_completed = self._set_valveset(vial_num, valvestate)
+                    if set_completed:
+                        logging.info('Closed vial {0} ({1}, {2}).'.format(vial_num, *self.vials.odor_at(vial_num)))
+                        self._start_lockout()
+                        self.checked_id = self.dummyvial
+                        self._vial_changed(self.checked_id)
+        else:  # no vial specified. Return true because you were asked to do nothing and complied.
+            set_completed = True
+        return set_completed
+
+    def run_sequence(self, sequence, override_checks=False):
+        """
+        Uploads a StimulusSequence and starts it. The steps are executed by the Teensy on its own clock, so the timing
+        of the steps does not depend on Python. The whole sequence is sent without waiting for replies in between.
+
+        The device state (open vial, lockout and MFC setpoints) is updated as the firmware reports each step.
+
+        :param sequence: core.sequence.StimulusSequence.
+        :param override_checks: Optionally override flow checks and lockout timing. Used for cleaning.
+        :return: SequenceRun to wait on and to get the step timing from, or None if the sequence cannot be run.
+        :rtype: SequenceRun
+        """
+        steps = sequence.sorted_steps()
+        if not steps:
+            raise OlfaException('Sequence has no steps.')
+        if len(steps) > MAX_SEQUENCE_STEPS:
+            raise OlfaException('Sequence has {0} steps, the olfactometer holds {1}.'.format(len(steps),
+                                                                                            MAX_SEQUENCE_STEPS))
+        commands = ['seqClear {0}'.format(self.slaveindex)]
+        commands.extend(self._sequence_command(s) for s in steps)
+        commands.append('seqRun {0}'.format(self.slaveindex))
+
+        if self._sequence_run is not None and not self._sequence_run.done():
+            logging.warning('Cannot run sequence, another sequence is running.')
+            return None
+        if any(s.action == 'vialOn' for s in steps) and not override_checks:
+            if not self.check_flows():
+                logging.warning("MFCs reporting no flow. Cannot run sequence.")
+                return None
+            elif not self.checked_id == self.dummyvial:
+                logging.warning('Cannot run sequence: a valve is open and must be closed first.')
+                return None
+            elif self.valve_locked_out():
+                logging.warning('Cannot run sequence. Must wait 1 second after last valve closed to prevent '
+                                'cross=contamination.')
+                return None
+
+        run = SequenceRun(steps, sequence.duration() + SEQUENCE_TIMEOUT_MARGIN)
+        self._sequence_run = run  # steps can be reported as soon as the seqRun reply is sent.
+        replies = [f.result() for f in self.transport.send_many(commands)]
+        for command, line in zip(commands[:-1], replies[:-1]):
+            if not line or line.startswith('Error'):
+                logging.error('Sequence upload failed: {0} -> {1}'.format(command, repr(line)))
+        line = replies[-1]
+        if line and line.startswith('seq started'):
+            logging.info('Started sequence of {0} steps ({1:0.3f} s).'.format(len(steps), sequence.duration()))
+        elif line:  # the firmware refused to run the sequence, ie because a step could not be added.
+            logging.error('Cannot run sequence: {0}'.format(line.strip()))
+            run._finish()
+        else:  # the reply was lost. The sequence may be running, so the step reports are collected until the deadline.
+            logging.warning('No reply to seqRun.')
+        return run
+
+    def _sequence_command(self, step):
+        """
+        :param step: SequenceStep.
+        :return: "seqAdd" command string for the step.
+        """
+        if step.action in ('vialOn', 'vialOff'):
+            command = '{0} {1:d}'.format(step.action, step.target)
+        elif step.action == 'dummy':
+            command = 'vial {0:d} {1}'.format(self.dummyvial, 'off' if step.value else 'on')  # see set_dummy_vial.
+        elif step.action == 'flow':
+            mfc = self.mfcs[step.target]
+            mfc_command = mfc.setpoint_command(step.value)
+            if mfc_command is None:
+                raise OlfaException('Cannot set MFC {0} to {1} in a sequence.'.format(step.target, step.value))
+            verb, _, args = mfc_command.split(' ', 2)  # remove the slave index, the firmware adds it.
+            command = '{0} {1}'.format(verb, args)
+        else:
+            raise OlfaException('Unknown sequence step: {0}'.format(step.action))
+        return 'seqAdd {0:d} {1:d} {2}'.format(self.slaveindex, int(round(step.time * 1000.)), command)
+
+    def _handle_async_line(self, line):
+        """
+        Handles the step reports of a running sequence ("!seq <index> <ms> <status>" and "!seqDone <n>"). This runs
+        on the transport's reader thread.
+        """
+        words = line.split()
+        run = self._sequence_run
+        if run is None:
+            logging.debug('Unexpected line from olfactometer: {0}'.format(line))
+        elif words[0] == '!seq' and len(words) == 4:
+            index, t_ms, status = [int(w) for w in words[1:]]
+            run._ack(SequenceAck(index, t_ms / 1000., status))
+            step = run.steps[index]
+            if status:
+                logging.error('Sequence step {0} ({1}) failed: Error {2}'.format(index, step.action, status))
+            else:
+                self._sequence_step_done(step)
+        elif words[0] == '!seqDone':
+            run._finish()
+        return
+
+    def _sequence_step_done(self, step):
+        """
+        Updates the device state after the firmware executed a sequence step.
+        """
+        if step.action == 'vialOn':
+            logging.info('Opened vial {0} ({1}, {2}).'.format(step.target, *self.vials.odor_at(step.target)))
+            self._lockout_until = float('inf')
+            self.checked_id = step.target
+            self._vial_changed(self.checked_id)
+        elif step.action == 'vialOff':
+            logging.info('Closed vial {0} ({1}, {2}).'.format(step.target, *self.vials.odor_at(step.target)))
+            self._start_lockout()
+            self.checked_id = self.dummyvial
+            self._vial_changed(self.checked_id)
+        elif step.action == 'dummy':
+            self.checked_id = self.dummyvial if step.value else 0
+            self._vial_changed(self.dummyvial)
+        elif step.action == 'flow':
+            self.mfcs[step.target].setpoint = step.value
+        return
+
+    def valve_locked_out(self):
+        """
+        :return: True if a vial cannot be opened yet because a vial is open or was closed less than
+        self.valve_lockout seconds ago.
+        :rtype: bool
+        """
+        return time.time() < self._lockout_until
+
+    def _start_lockout(self):
+        self._lockout_until = time.time() + self.valve_lockout
+        return
+
+    def set_flows(self, flows):
+        """
+        Sets flow rate for MFCs based on provided tuple. Specified flowrates should be in the units of the MFC.
+
+        i.e. (900, 100) will set the first MFC to 900 SCCM and the second to 100 SCCM.
+
+        :param flows:
+        :return: return bool if all sets are complete.
+        """
+
+        if not len(flows) == len(self.mfcs):
+            ex_str = 'Number of flows specified ({0}) not equal to number of MFCs in olfa ({1}).'.format(len(flows),
+                                                                                                         len(self.mfcs))
+            raise OlfaException(ex_str)
+        else:
+            with self.mfc_lock:
+                # send all setpoints before checking confirmations so that the commands are in flight together.
+                pending = [mfc.start_set_flowrate(flow) for mfc, flow in zip(self.mfcs, flows)]
+                successes = []
+                for mfc, p in zip(self.mfcs, pending):
+                    success = mfc.finish_set_flowrate(p)
+                    successes.append(success)
+            return all(successes)
+
+    def check_flows(self):
+        """
+        Checks all MFCs in olfa to see if they are reporting flow. This prevents opening a vial in a no-flow condition.
+        Readings come from the MFC reading cache (filled by the polling thread), so this does not use the serial port.
+
+        :return: True if all MFCs polling correctly and are reporting flow.
+        :rtype: bool
+        """
+
+        flows_on = True
+        if self.check_flows_before_opening:
+            for i, mfc in enumerate(self.mfcs):
+                reading = self.mfc_readings.get(mfc)
+                time_elapsed = time.time() - reading.timestamp
+                if time_elapsed > 2.1 * self.polling_interval:
+                    raise OlfaException('MFC polling is not ok.')
+                elif reading.flow <= 0.:
+                    logging.warning('MFC {0} reporting no flow.'.format(i))
+                    flows_on = False
+        else:
+            pass
+        return flows_on
+
+    def set_dilution(self, dilution_factor=None, flows=None):
+        """
+        Sets dilutors attached to the olfactometer.
+
+        :param dilution_factor: list of dilution factors, one for each dilutor on the olfactometer.
+        :param flows:  list of lists, one list per dilutor. Each list contains flowrates for each MFC in the dilutor (vac, air).
+        :return: True if setting appears to be successful.
+        :rtype: bool
+        """
+        successes = list()
+        if dilution_factor is not None:
+            pass
+        elif flows is not None:
+            for f, d in zip(flows, self.dilutors):
+                successes.append(d.set_flows(f))
+        return all(successes)
+
+    def _config_mfcs(self, mfc_config):
+        mfcs = []
+        for v in mfc_config:
+            mfc_type = v['MFC_type']
+            mfc = MFC_DEVICES[mfc_type](self, v)
+            mfcs.append(mfc)
+        return mfcs
+
+    def _config_dilutors(self, dilutor_config):
+        dilutors = []
+        for v in dilutor_config:
+            dilutor_type = v['dilutor_type']
+            logging.debug('Configuring {0} dilutor.'.format(dilutor_type))
+            dil = DILUTOR_DEVICES[dilutor_type](v)
+            dilutors.append(dil)
+        return dilutors
+
+    def send_command(self, command, tries=1):
+        """
+        Sends a command and blocks until the reply arrives.
+
+        :param command: command string (without end of line).
+        :param tries: number of times to send the command if no reply is received.
+        :return: reply line or None if no reply was received.
+        """
+        for i in xrange(tries):
+            line = self.transport.send(command).result()
+            if line:
+                return line
+
+    def send_command_async(self, command, match=None):
+        """
+        Queues a command without waiting for the reply. Use this to keep several commands in flight.
+
+        :param command: command string (without end of line).
+        :param match: optional function recognizing the reply line (see SerialTransport.send).
+        :return: future whose result() is the reply line (or None).
+        :rtype: transport.CommandFuture
+        """
+        return self.transport.send(command, match)
+
+    def _start_mfc_polling(self, polling_interval_sec=1.):
+        """
+        Starts polling MFCs on a background thread.
+
+        :return: polling worker thread.
+        :rtype: PollingWorker
+        """
+        logging.debug('Starting MFC polling.')
+        mfc_poller = PollingWorker(self._poll_mfcs, polling_interval_sec,
+                                   name='MFC poller (slave {0})'.format(self.slaveindex))
+        mfc_poller.start()
+        return mfc_poller
+
+    def close_serial(self):
+        """
+        Closes serial communication to olfactometer. Used before deleting object or reinitializing.
+        :return: None
+        """
+        self._mfc_poller.stop()
+        self.transport.close()
+        for dil in self.dilutors:
+            dil.close_serial()
+
+    def flow_history(self, start=None, end=None):
+        """
+        :param start: start time (time.time()), or None for the oldest reading kept.
+        :param end: end time, or None for the newest reading.
+        :return: dictionary of {name: history records} (see telemetry.py). The names are "mfc_<index>" and
+        "dilutor_<index>_mfc_<index>", like the keys of the stimulus dictionary.
+        :rtype: dict
+        """
+        histories = dict(('mfc_{0}'.format(i), mfc.history(start, end)) for i, mfc in enumerate(self.mfcs))
+        for i, dilutor in enumerate(self.dilutors):
+            for k, records in dilutor.flow_history(start, end).iteritems():
+                histories['dilutor_{0}_{1}'.format(i, k)] = records
+        return histories
+
+    def _poll_mfcs(self):
+        """
+        Polls all MFCs and stores the readings in the reading cache. This runs on the polling thread.
+        """
+        with self.mfc_lock:
+            return self._poll_mfcs_locked()
+
+    def _poll_mfcs_locked(self):
+        batched = self._poll_mfcs_batched()
+        individual = [mfc for mfc in self.mfcs if mfc not in batched]
+        # send the read requests for all MFCs before collecting any replies, so the MFCs are queried concurrently.
+        pending = [mfc.start_poll() for mfc in individual]
+        for mfc, p in zip(individual, pending):
+            batched[mfc] = mfc.finish_poll(p)
+        for i in xrange(len(self.mfcs)):
+            mfc = self.mfcs[i]
+            success = batched[mfc]
+            if mfc.flow < 0. and self.check_flows_before_opening:
+                # self.all_off()
+                # raise OlfaException('MFC is reporting no flow. Cannot continue.')
+                return False
+            if not success:
+                logging.error("Olfactometer cannot poll MFC {0}".format(i))
+        return
+
+    def _poll_mfcs_batched(self):
+        """
+        Polls all digital MFCs with a single "DMFCpoll" command, which returns the readings for every MFC on this
+        slave index in one reply. If the firmware does not support the command, batching is disabled and the MFCs
+        are polled individually from then on.
+
+        :return: dictionary of {mfc: poll success} for the MFCs that got a reading from the batched reply.
+        :rtype: dict
+        """
+        polled = {}
+        digital = [mfc for mfc in self.mfcs if isinstance(mfc, MFCAlicatDigArduinoDevice)]
+        if not self.batch_mfc_poll or not digital:
+            return polled
+        args = ' '.join('{0:d} {1}'.format(mfc.arduino_port, mfc.address) for mfc in digital)
+        line = self.send_command('DMFCpoll {0:d} {1}'.format(self.slaveindex, args))
+        if not line or not line.startswith('MFCpoll'):
+            logging.info('Olfactometer firmware does not support batched MFC polling. Polling MFCs individually.')
+            self.batch_mfc_poll = False
+            return polled
+        replies = {}
+        for entry in line[len('MFCpoll'):].strip().split(';'):
+            port, _, reply = entry.partition(':')
+            try:
+                replies[int(port)] = reply
+            except ValueError:
+                logging.debug('Cannot parse batched MFC reply: {0}'.format(repr(entry)))
+        for mfc in digital:
+            reply = replies.get(mfc.arduino_port, '')
+            if reply and not reply.startswith('Error'):  # MFCs that were not read are retried individually.
+                polled[mfc] = mfc.poll_reply(reply)
+        return polled
+
+    def stop_mfc_polling(self):
+        """
+        Stops MFC polling.
+        :return:
+        """
+        self._mfc_poller.pause()
+        return
+
+    def restart_mfc_polling(self):
+        """
+        Restarts MFC pooling after stop.
+        :return:
+        """
+        self._mfc_poller.resume()
+        return
+
+    def _valveset_command(self, valvenum, valvestate=1):
+        if valvestate:
+            command = "vialOn {0} {1}".format(self.slaveindex, valvenum)
+        else:
+            command = "vialOff {0} {1}".format(self.slaveindex, valvenum)
+        return command
+
+    def _set_valveset(self, valvenum, valvestate=1, suppress_errors=False):
+        line = self.send_command(self._valveset_command(valvenum, valvestate))
+        return self._check_valveset_reply(valvenum, line, suppress_errors)
+
+    def _check_valveset_reply(self, valvenum, line, suppress_errors=False):
+        if line and not line.split()[0] == 'Error':
+            return True
+        elif not suppress_errors:
+            logging.error('Cannot set valveset for vial {0}'.format(valvenum))
+            logging.error(repr(line))
+            return False
+
+    def set_dummy_vial(self, valvestate=1):
+        """
+        Sets the dummy vial.
+
+        Valvestate means the state of the valve. This is inversed from a normal valve!!
+
+        * A valvestate of 0 means to *close* the dummy by powering the solenoid.
+        * A valvestate of 1 means to *open* the dummy by closing other open valves (if any) and depower the dummy valves.
+
+        Usually, you want to pass valvestate with a 1 to close open valves and set the dummy open.
+
+        :param valvestate: Desired state of the dummy (0 closed, 1 open). Default is 1.
+        :return: True if successful setting.
+        :rtype : bool
+        """
+        success = False
+        if self.checked_id == self.dummyvial and not valvestate:  # dummy is "off" (this means open as it is normally open),
+            command = "vial {0} {1} on".format(self.slaveindex, self.dummyvial)
+            logging.debug(command)
+            line = self.send_command(command)
+            logging.debug(line)
+            if not line.split()[0] == "Error":
+                logging.info('Dummy ON.')
+                self._vial_changed(self.dummyvial)
+                self.checked_id = 0
+            else:
+                logging.error('Cannot set dummy vial.')
+                logging.error(line)
+        elif self.checked_id == self.dummyvial and valvestate:  # valve is already open, do nothing and return success!
+            success = True
+        elif self.checked_id == 0 and valvestate:  # dummy is already (closed)
+            command = "vial {0} {1} off".format(self.slaveindex, self.dummyvial)
+            logging.debug(command)
+            line = self.send_command(command)
+            logging.debug(line)
+            if not line.split()[0] == "Error":
+                logging.info("Dummy OFF.")
+                self._vial_changed(self.dummyvial)
+                self.checked_id = self.dummyvial
+                success = True
+                self._vial_changed(self.dummyvial)
+        elif self.checked_id != self.dummyvial and valvestate:  # another valve is open. close it.
+            success = self._set_valveset(self.checked_id, 0)  # close open vial.
+            if success:
+                self._vial_changed(self.dummyvial)
+                self._start_lockout()
+                self.checked_id = self.dummyvial
+        else:
+            logging.error("THIS SHOULDN'T HAPPEN!!!")
+        return success
+
+    def all_off(self):
+        """
+        Closes all valves on olfactometer. Called during startup.
+        """
+        logging.info('Setting all valves to OFF.')
+        vials = self.vials.valve_numbers
+        futures = [self.send_command_async(self._valveset_command(v, 0)) for v in vials]
+        for vial, future in zip(vials, futures):
+            self._check_valveset_reply(vial, future.result(), suppress_errors=True)
+        self._start_lockout()
+        self._vial_changed(self.dummyvial)
+        self.checked_id = self.dummyvial
+        return
+
+    def generate_stimulus_template_string(self):
+        stim_template_dict = {'odor': 'str (odorname) or int (vialnumber).',
+                              'vialconc': 'float concentration of odor to be presented (optional if using vialnumber)'}
+        dilutor_dict = dict()
+        for i in xrange(len(self.mfcs)):
+            k = 'mfc_{0}_flow'.format(i)
+            stim_template_dict[k] = 'numeric flowrate'
+
+        for i in xrange(len(self.dilutors)):
+            dilutor = self.dilutors[i]
+            k = 'dilutor_{0}'.format(i)
+            dilutor_dict[k] = dilutor.generate_stimulus_template_string()
+        stim_template_dict['dilutors'] = dilutor_dict
+        return stim_template_dict
+
+    def generate_tables_definition(self):
+        import tables
+        stim_template_dict = {'odor': tables.StringCol(32),
+                              'vialconc': tables.Float64Col()}
+        for i in xrange(len(self.mfcs)):
+            k = 'mfc_{0}_flow'.format(i)
+            stim_template_dict[k] = tables.Float64Col()
+        if self.dilutors:
+            stim_template_dict['dilutors'] = dict()
+            for i in xrange(len(self.dilutors)):
+                k = 'dilutor_{0}'.format(i)
+                dilutor = self.dilutors[i]
+                stim_template_dict['dilutors'][k] = dilutor.generate_tables_definition()
+        return flatten_dictionary(stim_template_dict)
+
+
+OLFACTOMETER_DEVICES = {'teensy': TeensyOlfaDevice}
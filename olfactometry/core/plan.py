@@ -0,0 +1,56 @@
+"""
+Compiled stimulus plans.
+
+set_stimulus() walks the stimulus dictionary, finds the vial for the odor and formats the MFC commands on every call.
+When the same stimuli are presented many times, compile each stimulus dictionary once with compile_stimulus() and run
+the plan on every trial:
+
+    plans = [rig.compile_stimulus(s) for s in stimuli]
+    for trial in trials:
+        rig.run_stimulus_plan(plans[trial.stimulus])
+
+Plans are immutable and are only valid for the devices that compiled them (recompile after reloading the
+configuration). Running a plan skips MFC setpoints that are already set and does not reopen a vial that is already
+open.
+"""
+
+from collections import namedtuple
+from olfactometry.utils import OlfaException
+
+# mfc: MFC device, flowrate: in units of the MFC capacity, command: preformatted setpoint command (or None).
+MFCSetpoint = namedtuple('MFCSetpoint', ['mfc', 'flowrate', 'command'])
+# setpoints: tuple of MFCSetpoints.
+DilutorPlan = namedtuple('DilutorPlan', ['setpoints'])
+# vial: vial number to open (0 opens no vial), setpoints: tuple of MFCSetpoints, dilutors: tuple of DilutorPlans.
+OlfactometerPlan = namedtuple('OlfactometerPlan', ['vial', 'setpoints', 'dilutors'])
+# olfas: tuple of OlfactometerPlans by olfactometer index, dilutors: tuple of DilutorPlans for the global dilutors.
+RigPlan = namedtuple('RigPlan', ['olfas', 'dilutors'])
+
+
+def compile_setpoints(mfcs, flows, device_name='device'):
+    """
+    :param mfcs: list of MFC devices.
+    :param flows: flowrates, one per MFC.
+    :param device_name: used in the exception message.
+    :return: tuple of MFCSetpoints.
+    :rtype: tuple
+    """
+    if not len(flows) == len(mfcs):
+        raise OlfaException('Number of flows specified ({0}) not equal to number of MFCs in {1} ({2}).'.format(
+            len(flows), device_name, len(mfcs)))
+    return tuple(MFCSetpoint(mfc, flow, mfc.setpoint_command(flow)) for mfc, flow in zip(mfcs, flows))
+
+
+def run_setpoints(setpoints):
+    """
+    Sends the setpoints that differ from the current MFC setpoints, then waits for the confirmations. The caller must
+    hold the lock of the device that owns the MFCs.
+
+    :param setpoints: tuple of MFCSetpoints.
+    :return: True if all setpoints are set.
+    :rtype: bool
+    """
+    changed = [s for s in setpoints if s.mfc.setpoint != s.flowrate]
+    pending = [s.mfc.start_set_flowrate(s.flowrate, s.command) for s in changed]
+    successes = [s.mfc.finish_set_flowrate(p) for s, p in zip(changed, pending)]
+    return all(successes)
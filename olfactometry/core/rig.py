@@ -0,0 +1,392 @@
+"""
+Headless container for all olfactometry devices in a configuration. The Olfactometers window in olfactometry.main is a
+view over an OlfactometerRig.
+"""
+
+import logging
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from pprint import pformat
+from olfactometry.utils import get_olfa_config, OlfaException, flatten_dictionary
+from olfactometer import OLFACTOMETER_DEVICES
+from dilutor import DILUTOR_DEVICES
+from plan import RigPlan
+from olfactometry.telemetry import export_hdf5
+
+
+def _call(fn):
+    return fn()
+
+
+class OlfactometerRig(object):
+    """
+    Container for olfactometer and dilutor devices.
+
+    Acts like a list of olfactometers (actual objects stored in self.olfas). So OlfactometerRig[0] returns the first
+    olfactometer in the configuration file.
+
+    Each olfactometer and global dilutor has its own serial port, so the set_* methods dispatch to the devices
+    concurrently and join the results: the latency of a call is that of the slowest device, not the sum over devices.
+    """
+
+    def __init__(self, config_obj=None):
+        """
+
+        :param config_obj: configuration dictionary, path to JSON configuration or None to use the default config.
+        """
+        self.config_fn = ''
+        if not config_obj:
+            self.config_fn, self.config_obj = get_olfa_config()
+        elif isinstance(config_obj, dict):
+            self.config_obj = config_obj
+        elif isinstance(config_obj, str):
+            self.config_fn, self.config_obj = get_olfa_config(config_obj)
+        else:
+            raise OlfaException("Passed config_obj is of unknown type. Can be a dict, path to JSON or None.")
+        self.check_flows_before_opening = True
+        self._pool = None
+        self._pool_size = 0
+        self.olfa_specs = self.config_obj['Olfactometers']
+        self.olfas = self.configure_olfactometers(self.olfa_specs)
+        try:
+            self.dilutor_specs = self.config_obj['Dilutors']  # configure *global* dilutors.
+            self.dilutors = self._config_dilutors(self.dilutor_specs)
+        except (TypeError, KeyError):  # no global Dilutors are specified, which is OK!
+            self.dilutors = []
+
+    def set_stimulus(self, stimulus_dictionary, open_vials=True):
+        """
+        This sets the stimulus for ALL olfactometers and attached devices using a single dictionary. This dictionary
+        format depends on the configuration of the attached devices. A template can be generated for the current
+        configuration with generate_stimulus_template().
+
+        :param stimulus_dictionary: Dictionary of stimulus parameters for olfactory stimulus.
+        :type stimulus_dictionary: dict
+        :return: True if all successes appear to be successful.
+        :rtype: bool
+        """
+        std = stimulus_dictionary
+        n_olfas = len(std['olfas'])
+        calls = []
+        for i in xrange(n_olfas):
+            k = 'olfa_{0}'.format(i)
+            o = std['olfas'][k]
+            olfa = self.olfas[i]
+            calls.append(partial(olfa.set_stimulus, o, open_vials=open_vials))
+        if 'dilutors' in std.keys():
+            for i in xrange(len(std['dilutors'])):
+                dil = self.dilutors[i]
+                k = 'dilutor_{0}'.format(i)
+                d = std['dilutors'][k]
+                calls.append(partial(dil.set_stimulus, d))
+        successes = self._fan_out(calls)
+        return all(successes)
+
+    def compile_stimulus(self, stimulus_dictionary):
+        """
+        Compiles a stimulus dictionary (as used by set_stimulus) into a plan for run_stimulus_plan(). Compile each
+        stimulus once and run the plan on every trial that presents it.
+
+        :param stimulus_dictionary: Dictionary of stimulus parameters for olfactory stimulus.
+        :type stimulus_dictionary: dict
+        :return: immutable stimulus plan.
+        :rtype: plan.RigPlan
+        """
+        std = stimulus_dictionary
+        olfa_plans = []
+        for i in xrange(len(std['olfas'])):
+            k = 'olfa_{0}'.format(i)
+            olfa_plans.append(self.olfas[i].compile_stimulus(std['olfas'][k]))
+        dilutor_plans = []
+        for i in xrange(len(std.get('dilutors', ()))):
+            k = 'dilutor_{0}'.format(i)
+            dilutor_plans.append(self.dilutors[i].compile_stimulus(std['dilutors'][k]))
+        return RigPlan(tuple(olfa_plans), tuple(dilutor_plans))
+
+    def run_stimulus_plan(self, plan, open_vials=True):
+        """
+        Sets the stimulus of a plan from compile_stimulus() on all olfactometers and global dilutors.
+
+        :param plan: RigPlan compiled by this rig.
+        :param open_vials: set False to only set the flows.
+        :return: True if all successes appear to be successful.
+        :rtype: bool
+        """
+        calls = []
+        for olfa, olfa_plan in zip(self.olfas, plan.olfas):
+            calls.append(partial(olfa.run_stimulus_plan, olfa_plan, open_vials=open_vials))
+        for dil, dilutor_plan in zip(self.dilutors, plan.dilutors):
+            calls.append(partial(dil.run_stimulus_plan, dilutor_plan))
+        successes = self._fan_out(calls)
+        return all(successes)
+
+    def set_vials(self, vials, valvestates=None):
+        """
+        Sets vials on all olfactometers based on list of vial numbers provided. 0 or None will open no vial for that
+        olfa.
+
+        :param vials: list or tuple of vials.
+        :param valvestates: (optional) list of valvestates (True opens, False closes)
+        :return: True if all setting appears successful.
+        :rtype: bool
+        """
+        calls = []
+        if not len(vials) == len(self.olfas):
+            raise OlfaException('Number of vials specified must be equal to the number of olfactometers.')
+        if not valvestates:
+            valvestates = [None] * len(vials)
+        for vial, olfa, valvestate in zip(vials, self.olfas, valvestates):
+            if vial:
+                calls.append(partial(olfa.set_vial, vial, valvestate))
+        successes = self._fan_out(calls)
+        return all(successes)
+
+    def set_odors(self, odors, concs=None, valvestates=None):
+        """
+        Sets odors on all olfactometers based on list of odor strings provided. Empty string or None will open no odor.
+
+        :param odors: list or tuple of strings specifying odors by olfactometer (one string per olfactometer).
+        :param valvestates: (optional) list of valvestates (True opens, False closes)
+        :return: True if all setting appears successful.
+        :rtype: bool
+        """
+
+        calls = []
+        if not hasattr(odors, '__iter__'):
+            if len(self.olfas) < 2:
+                odors = (odors, )  # make into tuple
+        if not hasattr(concs, '__iter__'):
+            if len(self.olfas) < 2:
+                concs = (concs, )  # make into tuple
+        if not len(odors) == len(self.olfas):
+            raise OlfaException('Number of odors specified must be equal to the number of olfactometers.')
+        if not valvestates:
+            valvestates = [None] * len(odors)  #just allows us to zip through this. Olfactometer will deal with Nones.
+        if not concs:
+            concs = [None] * len(odors)  # just allows us to zip through this. Olfactometer will deal with Nones.
+        for odor, conc, olfa, valvestate in zip(odors, concs, self.olfas, valvestates):
+            if odor:
+                calls.append(partial(olfa.set_odor, odor, conc, valvestate))
+        successes = self._fan_out(calls)
+        return all(successes)
+
+    def set_dummy_vials(self):
+        """
+        Call this to close all odorvials. Used after trial complete.
+
+        :return: True if all dummys set.
+        :rtype: bool
+        """
+        successes = self._fan_out([o.set_dummy_vial for o in self.olfas])
+        return all(successes)
+
+    def set_flows(self, flows):
+        """
+        Sets MFC flows for all olfactometers.
+
+        :param flows: List of flowrates (ie "[(olfa1_MFCflow1, olfa1_MFCflow2), (olfa2_MFCflow1,...),...]")
+        :return: True if sets appear to be successful as reported by olfas.
+        :rtype: bool
+        """
+        calls = []
+        if not len(self.olfas) == len(flows):
+            raise OlfaException('Number of flowrates specified must equal then number of olfactometers.')
+        for olfa, flow in zip(self.olfas, flows):
+            if flow:
+                calls.append(partial(olfa.set_flows, flow))
+        successes = self._fan_out(calls)
+        return all(successes)
+
+    def set_dilution_flows(self, olfa_dilution_flows=(), global_dilution_flows=()):
+        """
+        This sets dilution flows for dilutors attached to olfactometers or global dilutors attached to all olfactometers.
+        Each flow spec is specified by a list of flowrates: [vac, air].
+
+        :param olfa_dilution_flows: list of lists of lists specifying dilution flows for dilutors attached to
+        olfactometers: [[[olfa1_vac1, olfa1_air1], [olfa1_vac2, olfa1_air2], ...], [[olfa2_vac1, olfa2_vac2],... ], ...]
+        :param global_dilution_flows: sets flow for global dilutor (ie those attached to all olfactometers):
+        [[global1_vac, global1_air], [global2_vac,...], ...]
+        :return: True if all setting appears successful.
+        :rtype: bool
+        """
+
+        olfa_calls = []
+        global_calls = []
+        if not len(olfa_dilution_flows) == len(self.olfas):
+            raise OlfaException('Number of flowrate pairs for olfa_dilution_flows parameter '
+                                'must be consistent with number of olfactometers.\n\n'
+                                '\t\t( i.e. "[(olfa1_vac, olfa1_air), (olfa2_vac, olfa2_air), ...]" )')
+        if olfa_dilution_flows:
+            for olfa, flows in zip(self.olfas, olfa_dilution_flows):
+                olfa_calls.append(partial(olfa.set_dilution, flows=flows))
+        if not len(global_dilution_flows) == len(self.dilutors):
+            raise OlfaException('Number of flowrate pairs for global_dilution_flows parameter must be consistent with '
+                                'number of global dilutors present in configuration. \n\n'
+                                '\t\tThis does not include dilutors embedded in olfactometer objects!!!')
+        if global_dilution_flows:
+            for dilutor, flows in zip(self.dilutors, global_dilution_flows):
+                global_calls.append(partial(dilutor.set_flows, flows))
+        successes = self._fan_out(olfa_calls + global_calls)
+        olfa_success = all(successes[:len(olfa_calls)])
+        global_success = all(successes[len(olfa_calls):])
+        return all((olfa_success, global_success))
+
+    def _fan_out(self, calls):
+        """
+        Runs calls concurrently (one thread per device) and waits for all of them to return. If a call raises, the
+        exception is re-raised here.
+
+        :param calls: list of functions taking no arguments, each using a different device.
+        :return: list of return values, in the order of calls.
+        :rtype: list
+        """
+        if len(calls) < 2:
+            return [fn() for fn in calls]
+        if self._pool is None or self._pool_size < len(calls):
+            if self._pool is not None:
+                self._pool.close()
+            self._pool_size = max(len(calls), len(self.olfas) + len(self.dilutors))
+            self._pool = ThreadPool(self._pool_size)
+        return self._pool.map(_call, calls, chunksize=1)
+
+    def _close_pool(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+            self._pool_size = 0
+
+    def check_flows(self):
+        """
+        Check that all olfactometers' MFCs are reporting flow.
+        :return: True if all olfas' MFCs are flowing.
+        :rtype: bool
+        """
+        successes = []
+        for o in self.olfas:
+            successes.append(o.check_flows())
+        return all(successes)
+
+    def set_check_flows(self, checked):
+        """
+        Enables or disables the flow check performed by all olfactometers before opening a vial.
+
+        :param checked: True to check flows before opening vials.
+        """
+        self.check_flows_before_opening = checked
+        for o in self.olfas:
+            o.check_flows_before_opening = checked
+        return
+
+    def configure_olfactometers(self, olfa_specs):
+        """
+        Builds olfactometer devices from a list of specs. Used on startup and when reloading the configuration (after
+        close_serials()).
+
+        :param olfa_specs: tuple of olfactometer specs from olfa dict.
+        :return: list of olfactometer devices.
+        """
+        self._close_pool()  # the pool is sized for the devices, it is made again when needed.
+        olfas = list()
+        for o in olfa_specs:
+            olfatype = o.get('olfa_interface', 'teensy')
+            try:
+                olfa_class = OLFACTOMETER_DEVICES[olfatype]
+            except KeyError:
+                raise OlfaException('Unknown olfa_interface: {0}'.format(olfatype))
+            olfa = olfa_class(o)
+            olfa.check_flows_before_opening = self.check_flows_before_opening
+            olfas.append(olfa)
+        self.olfa_specs = olfa_specs
+        self.olfas = olfas
+        return olfas
+
+    def _config_dilutors(self, dilutor_config):
+        """
+        Add dilutor objects.
+
+        :param dilutor_config: list of dicts specifying dilutor configurations.
+        :return:
+        """
+        dilutors = []
+        for v in dilutor_config:
+            dilutor_type = v['dilutor_type']
+            logging.debug('Configuring {0} dilutor.'.format(dilutor_type))
+            dil = DILUTOR_DEVICES[dilutor_type](v)
+            dilutors.append(dil)
+        return dilutors
+
+    def generate_stimulus_template(self):
+        stimulus_template = {}
+        olfa_templates = {}
+        dilutor_templates = {}
+
+        for i in xrange(len(self.olfas)):
+            olfa = self.olfas[i]
+            k = 'olfa_{0}'.format(i)
+            olfa_templates[k] = olfa.generate_stimulus_template_string()
+        stimulus_template['olfas'] = olfa_templates
+        if self.dilutors:
+            for i in xrange(len(self.dilutors)):
+                dil = self.dilutors[i]
+                k = 'dilutor_{0}'.format(i)
+                dilutor_templates[k] = dil.generate_stimulus_template_string()
+            stimulus_template['dilutors'] = dilutor_templates
+        s = pformat(stimulus_template, width=120)
+        return s
+
+    def generate_tables_definition(self):
+        definition = dict()
+        dilutor_def = dict()
+        olfa_definition = dict()
+        for i, dilutor in enumerate(self.dilutors):
+            k = 'dilutor_{0}'.format(i)
+            dilutor_def[k] = dilutor.generate_tables_definition()
+        for i, olfa in enumerate(self.olfas):
+            k = 'olfa_{0}'.format(i)
+            olfa_definition[k] = olfa.generate_tables_definition()
+        definition['olfas'] = olfa_definition
+        definition['dilutors'] = dilutor_def
+        return flatten_dictionary(definition)
+
+    def flow_history(self, start=None, end=None):
+        """
+        Returns the MFC readings of all devices recorded between start and end, ie to check the flows during a trial.
+
+        :param start: start time (time.time()), or None for the oldest reading kept.
+        :param end: end time, or None for the newest reading.
+        :return: dictionary of {name: history records} (see telemetry.RECORD_DTYPE). Names are "olfa_0_mfc_0",
+        "olfa_0_dilutor_0_mfc_0" and "dilutor_0_mfc_0" for global dilutors.
+        :rtype: dict
+        """
+        histories = {}
+        for i, olfa in enumerate(self.olfas):
+            for k, records in olfa.flow_history(start, end).iteritems():
+                histories['olfa_{0}_{1}'.format(i, k)] = records
+        for i, dilutor in enumerate(self.dilutors):
+            for k, records in dilutor.flow_history(start, end).iteritems():
+                histories['dilutor_{0}_{1}'.format(i, k)] = records
+        return histories
+
+    def export_flow_history(self, h5, start=None, end=None, where='/flow_history'):
+        """
+        Writes the MFC readings recorded between start and end to an HDF5 file, one table per MFC. To save the flows
+        of a Voyeur trial with the trial, use the trial's group, ie where='/Trial0001/flow_history'.
+
+        :param h5: open tables.File or path to an HDF5 file.
+        :param where: group that the tables are written to.
+        """
+        export_hdf5(h5, self.flow_history(start, end), where)
+
+    def __getitem__(self, olfa_idx):
+        return self.olfas[olfa_idx]
+
+    def __len__(self):
+        return len(self.olfas)
+
+    def close_serials(self):
+        self._close_pool()
+        for o in self.olfas:
+            o.close_serial()
+        for d in self.dilutors:
+            d.close_serial()
@@ -0,0 +1,154 @@
+"""
+Stimulus sequences executed by the olfactometer firmware.
+
+Opening a vial with set_vial() and closing it later from Python makes the odor duration depend on Python timing. A
+StimulusSequence is a timed schedule of vial, dummy and MFC steps that is uploaded to the Teensy in one go and then
+executed on the Teensy clock:
+
+    seq = StimulusSequence()
+    seq.set_flow(0., 0, 900)
+    seq.open_vial(.5, 5)
+    seq.close_vial(2.5, 5)  # closing a vial restores the dummy.
+    run = olfa.run_sequence(seq)
+    run.wait()
+
+The firmware reports each step as it is executed, with its time on the Teensy clock. The reports are collected by the
+SequenceRun returned by run_sequence().
+"""
+
+import logging
+import threading
+import time
+from collections import namedtuple
+
+# time: seconds after the start of the sequence, action: 'vialOn', 'vialOff', 'dummy' or 'flow'.
+SequenceStep = namedtuple('SequenceStep', ['time', 'action', 'target', 'value'])
+# index: step index, time: seconds after the start of the sequence on the device clock, status: 0 or error code.
+SequenceAck = namedtuple('SequenceAck', ['index', 'time', 'status'])
+
+MAX_SEQUENCE_STEPS = 32  # SEQ_MAX_STEPS in Teensy_olfactometer.ino
+SEQUENCE_TIMEOUT_MARGIN = 2.  # seconds after the end of a sequence before a run without all reports is given up.
+
+
+class StimulusSequence(object):
+    """
+    Timed schedule of olfactometer steps. Steps can be added in any order, they are sorted by time when uploaded.
+    """
+
+    def __init__(self):
+        self.steps = []
+
+    def open_vial(self, t, vial_num):
+        """
+        Opens a vial (and closes the dummy) at time t (seconds after the start of the sequence).
+        """
+        self._add(t, 'vialOn', int(vial_num))
+
+    def close_vial(self, t, vial_num):
+        """
+        Closes a vial and opens the dummy at time t.
+        """
+        self._add(t, 'vialOff', int(vial_num))
+
+    def set_dummy(self, t, valvestate=1):
+        """
+        Sets the dummy vial at time t. As for set_dummy_vial(), a valvestate of 1 opens the dummy and 0 closes it.
+        """
+        self._add(t, 'dummy', None, valvestate)
+
+    def set_flow(self, t, mfc_index, flowrate):
+        """
+        Changes the setpoint of an MFC of the olfactometer at time t.
+
+        :param mfc_index: index of the MFC in the olfactometer's "MFCs" configuration.
+        :param flowrate: flowrate in units of the MFC capacity.
+        """
+        self._add(t, 'flow', int(mfc_index), flowrate)
+
+    def _add(self, t, action, target, value=None):
+        if t < 0:
+            raise ValueError('Sequence step times must be positive.')
+        self.steps.append(SequenceStep(float(t), action, target, value))
+
+    def sorted_steps(self):
+        """
+        :return: steps in the order they are executed.
+        :rtype: list
+        """
+        return sorted(self.steps, key=lambda s: s.time)  # sorted() is stable, so steps at the same time keep order.
+
+    def duration(self):
+        """
+        :return: time of the last step in seconds.
+        """
+        return max(s.time for s in self.steps) if self.steps else 0.
+
+
+class SequenceRun(object):
+    """
+    Progress of a sequence running on the olfactometer. The acknowledgements are added by the olfactometer's serial
+    reader thread as the firmware reports the steps.
+
+    If the run is not finished by its deadline (ie the seqRun reply was lost and the sequence never started), it is
+    finished as timed out and is not successful.
+    """
+
+    def __init__(self, steps, timeout=None):
+        """
+
+        :param steps: steps as uploaded (sorted by time).
+        :param timeout: seconds from now until the run is given up, or None to wait for the reports indefinitely.
+        """
+        self.steps = steps
+        self.acks = []
+        self.timed_out = False
+        self._deadline = None if timeout is None else time.time() + timeout
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+
+    def done(self):
+        if not self._done.is_set() and self._deadline is not None and time.time() >= self._deadline:
+            self._expire()
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Blocks until all steps are reported, the timeout passes or the deadline of the run passes.
+
+        :param timeout: seconds to wait, or None to wait for the whole sequence (until the deadline of the run).
+        :return: True if all steps were executed without error.
+        :rtype: bool
+        """
+        if self._deadline is not None:
+            remaining = max(self._deadline - time.time(), 0.)
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        self._done.wait(timeout)
+        return self.success()
+
+    def success(self):
+        done = self.done()
+        with self._lock:
+            return (done and not self.timed_out and len(self.acks) == len(self.steps) and
+                    all(a.status == 0 for a in self.acks))
+
+    def timing_errors(self):
+        """
+        :return: list of (step, device time - scheduled time) in seconds for the reported steps.
+        """
+        with self._lock:
+            return [(self.steps[a.index], a.time - self.steps[a.index].time) for a in self.acks]
+
+    def _ack(self, ack):
+        with self._lock:
+            self.acks.append(ack)
+
+    def _finish(self):
+        self._done.set()
+
+    def _expire(self):
+        with self._lock:
+            if self._done.is_set():
+                return
+            self.timed_out = True
+            self._done.set()
+        logging.warning('Sequence timed out with {0} of {1} steps reported.'.format(len(self.acks), len(self.steps)))
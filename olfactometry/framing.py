@@ -0,0 +1,218 @@
+"""
+Binary framing for the Teensy olfactometer protocol.
+
+The Teensy accepts frames as well as ASCII command lines (see Teensy_olfactometer.ino). A frame is:
+
+    0xA5 <LEN> <SEQ> <OPCODE> <LEN payload bytes> <CRC16 high> <CRC16 low>
+
+The CRC (CCITT, initial value 0xFFFF) covers LEN, SEQ, OPCODE and the payload. The reply has the same SEQ, OPCODE | 0x80
+and a payload of a 16 bit status (0 is OK, otherwise the error code printed as "Error <code>" in ASCII) followed by the
+reply data. Frames that fail the CRC check are answered with a NAK frame.
+
+Only the commands on the hot path have opcodes (vials, MFC setpoints and reads). encode_command() translates an ASCII
+command into a frame, and decode_reply() translates a reply frame back into the ASCII reply line, so the devices work
+the same with either protocol. Commands without an opcode return None from encode_command() and are sent as ASCII.
+"""
+
+import struct
+
+SYNC = '\xa5'
+REPLY = 0x80
+NAK = 0x7f
+MAX_PAYLOAD = 162  # FRAME_MAX in Teensy_olfactometer.ino, plus the reply status.
+
+# opcodes (the command definitions of the firmware).
+SET_VIAL = 2
+SET_MFC = 5
+READ_MFC = 6
+VIAL_ON = 7
+VIAL_OFF = 8
+SET_D_MFC = 14
+READ_D_MFC = 15
+POLL_D_MFC = 16
+
+# ASCII reply for opcodes that reply with a status only.
+_OK_REPLIES = {VIAL_ON: 'vial and dummy on',
+               VIAL_OFF: 'vial and dummy off',
+               SET_MFC: 'MFC set',
+               SET_D_MFC: 'MFC set'}
+
+
+def crc16(data, crc=0xffff):
+    """
+    CRC-16/CCITT of a byte string.
+    """
+    for c in data:
+        crc ^= ord(c) << 8
+        for _ in xrange(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xffff
+            else:
+                crc = (crc << 1) & 0xffff
+    return crc
+
+
+def encode_frame(seq, opcode, payload):
+    """
+    :param seq: sequence number (0-255).
+    :param opcode: opcode.
+    :param payload: payload byte string.
+    :return: frame byte string.
+    """
+    body = struct.pack('<BBB', len(payload), seq, opcode) + payload
+    return SYNC + body + struct.pack('>H', crc16(body))
+
+
+def encode_command(command, seq):
+    """
+    Translates an ASCII olfactometer command into a frame.
+
+    :param command: ASCII command (ie "vialOn 1 5").
+    :param seq: sequence number (0-255).
+    :return: (opcode, frame), or None if the command has no binary form.
+    """
+    argv = command.split()
+    if len(argv) < 3:
+        return None
+    verb = argv[0]
+    try:
+        device, n = int(argv[1]), int(argv[2])
+    except ValueError:
+        return None
+    if not (0 < device < 128 and 0 <= n < 256):
+        return None
+    args = argv[3:]
+    head = struct.pack('<BB', device, n)
+    if verb == 'vialOn' and not args:
+        opcode, payload = VIAL_ON, head
+    elif verb == 'vialOff' and not args:
+        opcode, payload = VIAL_OFF, head
+    elif verb == 'vial' and args in (['on'], ['off']):
+        opcode, payload = SET_VIAL, head + chr(args[0] == 'on')
+    elif verb == 'MFC' and not args:
+        opcode, payload = READ_MFC, head
+    elif verb == 'MFC' and len(args) == 1:
+        try:
+            value = float(args[0])
+        except ValueError:
+            return None
+        if not 0. <= value <= 1.:
+            return None
+        opcode, payload = SET_MFC, head + struct.pack('<H', int(value * 65535))
+    elif verb == 'DMFC' and not args:
+        opcode, payload = READ_D_MFC, head
+    elif verb == 'DMFC' and len(args) == 1 and len(args[0]) <= 32:
+        opcode, payload = SET_D_MFC, head + args[0]
+    elif verb == 'DMFCpoll' and len(argv) in (4, 6):
+        pairs = argv[2:]
+        payload = chr(device)
+        for i in xrange(0, len(pairs), 2):
+            if not pairs[i].isdigit() or len(pairs[i + 1]) != 1:
+                return None
+            payload += chr(int(pairs[i])) + pairs[i + 1]
+        opcode = POLL_D_MFC
+    else:
+        return None
+    return opcode, encode_frame(seq, opcode, payload)
+
+
+def decode_command(opcode, payload):
+    """
+    Translates a command frame back into the ASCII command (the inverse of encode_command).
+
+    :param opcode: opcode of the frame.
+    :param payload: payload of the frame.
+    :return: ASCII command, or None if the frame is not a valid command.
+    """
+    if len(payload) < 2:
+        return None
+    device, n = ord(payload[0]), ord(payload[1])
+    args = payload[2:]
+    if opcode == VIAL_ON and not args:
+        return 'vialOn {0} {1}'.format(device, n)
+    elif opcode == VIAL_OFF and not args:
+        return 'vialOff {0} {1}'.format(device, n)
+    elif opcode == SET_VIAL and len(args) == 1:
+        return 'vial {0} {1} {2}'.format(device, n, 'on' if args != '\x00' else 'off')
+    elif opcode == READ_MFC and not args:
+        return 'MFC {0} {1}'.format(device, n)
+    elif opcode == SET_MFC and len(args) == 2:
+        return 'MFC {0} {1} {2}'.format(device, n, struct.unpack('<H', args)[0] / 65535.)
+    elif opcode == READ_D_MFC and not args:
+        return 'DMFC {0} {1}'.format(device, n)
+    elif opcode == SET_D_MFC and args:
+        return 'DMFC {0} {1} {2}'.format(device, n, args)
+    elif opcode == POLL_D_MFC and len(payload) in (3, 5):
+        pairs = ' '.join('{0} {1}'.format(ord(payload[i]), payload[i + 1]) for i in xrange(1, len(payload), 2))
+        return 'DMFCpoll {0} {1}'.format(device, pairs)
+    return None
+
+
+def decode_reply(opcode, status, data):
+    """
+    Translates a reply frame into the ASCII reply line that the firmware prints for the same command.
+
+    :param opcode: opcode of the command (without the REPLY bit).
+    :param status: status from the reply.
+    :param data: reply data.
+    :return: reply line including the end of line.
+    :rtype: str
+    """
+    if status:
+        line = 'Error {0}'.format(status)
+    elif opcode in _OK_REPLIES:
+        line = _OK_REPLIES[opcode]
+    elif opcode == SET_VIAL:
+        line = 'vial set' if data[:1] != '\x00' else 'vial cleared'
+    elif opcode == READ_MFC:
+        line = '{0:.2f}'.format(struct.unpack('<H', data[:2])[0] / 65535.)
+    elif opcode == READ_D_MFC:
+        line = data + '\r'
+    elif opcode == POLL_D_MFC:
+        line = 'MFCpoll ' + data
+    else:
+        line = data
+    return line + '\r\n'
+
+
+class FrameDecoder(object):
+    """
+    Splits a byte stream into frames and text. Bytes outside of frames are returned as text, so ASCII lines (ie the
+    step reports of a sequence) can be mixed with frames.
+    """
+
+    def __init__(self):
+        self._buffer = ''
+
+    def feed(self, data):
+        """
+        :param data: bytes read from the device.
+        :return: list of ('frame', (seq, opcode, payload)), ('bad', seq) for frames that fail the CRC check, and
+        ('text', string) items, in the order they were received.
+        """
+        self._buffer += data
+        items = []
+        while self._buffer:
+            i = self._buffer.find(SYNC)
+            if i != 0:
+                text = self._buffer if i < 0 else self._buffer[:i]
+                self._buffer = '' if i < 0 else self._buffer[i:]
+                items.append(('text', text))
+                continue
+            if len(self._buffer) < 4:
+                break
+            n = ord(self._buffer[1])
+            if n > MAX_PAYLOAD:  # not a frame, ie a stray sync byte.
+                items.append(('text', self._buffer[0]))
+                self._buffer = self._buffer[1:]
+                continue
+            if len(self._buffer) < n + 6:
+                break
+            body, crc = self._buffer[1:n + 4], self._buffer[n + 4:n + 6]
+            self._buffer = self._buffer[n + 6:]
+            seq, opcode = ord(body[1]), ord(body[2])
+            if struct.unpack('>H', crc)[0] != crc16(body):
+                items.append(('bad', seq))
+            else:
+                items.append(('frame', (seq, opcode, body[3:])))
+        return items
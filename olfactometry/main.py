@@ -1,10 +1,10 @@
 __author__ = 'chris'
 
 from PyQt4 import QtCore, QtGui
-from utils import get_olfa_config, OlfaException, flatten_dictionary
+from utils import get_olfa_config, OlfaException
 from olfactometer import TeensyOlfa, Olfactometer
-from dilutor import DILUTORS
-from pprint import pformat
+from dilutor import Dilutor
+from core import OlfactometerRig, TeensyOlfaDevice
 import logging
 import os
 
@@ -15,27 +15,20 @@ class Olfactometers(QtGui.QMainWindow):
 
     Also, acts like a list of olfactometers (actual objects stored in self.olfas). So Olfactometers[0] returns the first
     olfactometer in the configuration file.
+
+    The devices themselves are held by an OlfactometerRig (self.rig), which can be used without the gui.
     """
 
     def __init__(self, parent=None, config_obj=None):
         super(Olfactometers, self).__init__()  # not sure if this will work.
-        if not config_obj:
-            self.config_fn, self.config_obj = get_olfa_config()
-        elif isinstance(config_obj, dict):
-            self.config_obj = config_obj
-        elif isinstance(config_obj, str):
-            self.config_fn, self.config_obj = get_olfa_config(config_obj)
-        else:
-            raise OlfaException("Passed config_obj is of unknown type. Can be a dict, path to JSON or None.")
+        self.rig = OlfactometerRig(config_obj)
+        self.config_fn = self.rig.config_fn
+        self.config_obj = self.rig.config_obj
         menubar = self.menuBar()
         self._buildmenubar(menubar)
-        self.olfa_specs = self.config_obj['Olfactometers']
-        self.olfas = self._config_olfas(self.olfa_specs)
-        try:
-            self.dilutor_specs = self.config_obj['Dilutors']  # configure *global* dilutors.
-            self.dilutors = self._config_dilutors(self.dilutor_specs)
-        except (TypeError, KeyError):  # no global Dilutors are specified, which is OK!
-            self.dilutors = []
+        self.olfa_specs = self.rig.olfa_specs
+        self.olfas = self._config_olfas(self.rig.olfas)
+        self.dilutors = self._config_dilutors(self.rig.dilutors)
         self.setWindowTitle("Olfactometry")
         layout = QtGui.QVBoxLayout()
         for olfa in self.olfas:
@@ -59,23 +52,41 @@ class Olfactometers(QtGui.QMainWindow):
         :return: True if all successes appear to be successful.
         :rtype: bool
         """
-        std = stimulus_dictionary
-        n_olfas = len(std['olfas'])
-        successes = []
-        for i in xrange(n_olfas):
-            k = 'olfa_{0}'.format(i)
-            o = std['olfas'][k]
-            olfa = self.olfas[i]
-            success = olfa.set_stimulus(o, open_vials=open_vials)
-            successes.append(success)
-        if 'dilutors' in std.keys():
-            for i in xrange(len(std['dilutors'])):
-                dil = self.dilutors[i]
-                k = 'dilutor_{0}'.format(i)
-                d = std['dilutors'][k]
-                success = dil.set_stimulus(d)
-                successes.append(success)
-        return all(successes)
+        return self.rig.set_stimulus(stimulus_dictionary, open_vials=open_vials)
+
+    def compile_stimulus(self, stimulus_dictionary):
+        """
+        Compiles a stimulus dictionary into a plan that can be run many times with run_stimulus_plan(). This is faster
+        than calling set_stimulus() for every trial when the same stimuli are repeated.
+
+        :param stimulus_dictionary: Dictionary of stimulus parameters for olfactory stimulus.
+        :type stimulus_dictionary: dict
+        :return: immutable stimulus plan.
+        """
+        return self.rig.compile_stimulus(stimulus_dictionary)
+
+    def run_stimulus_plan(self, plan, open_vials=True):
+        """
+        Sets the stimulus of a plan from compile_stimulus().
+
+        :return: True if all successes appear to be successful.
+        :rtype: bool
+        """
+        return self.rig.run_stimulus_plan(plan, open_vials=open_vials)
+
+    def flow_history(self, start=None, end=None):
+        """
+        Returns the MFC readings recorded between start and end (see OlfactometerRig.flow_history()).
+
+        :rtype: dict
+        """
+        return self.rig.flow_history(start, end)
+
+    def export_flow_history(self, h5, start=None, end=None, where='/flow_history'):
+        """
+        Writes the MFC readings recorded between start and end to an HDF5 file, ie a Voyeur data file.
+        """
+        return self.rig.export_flow_history(h5, start, end, where)
 
     def set_vials(self, vials, valvestates=None):
         """
@@ -87,16 +98,7 @@ class Olfactometers(QtGui.QMainWindow):
         :return: True if all setting appears successful.
         :rtype: bool
         """
-        successes = []
-        if not len(vials) == len(self.olfas):
-            raise OlfaException('Number of vials specified must be equal to the number of olfactometers.')
-        if not valvestates:
-            valvestates = [None] * len(vials)
-        for vial, olfa, valvestate in zip(vials, self.olfas, valvestates):
-            if vial:
-                success = olfa.set_vial(vial, valvestate)
-                successes.append(success)
-        return all(successes)
+        return self.rig.set_vials(vials, valvestates)
 
     def set_odors(self, odors, concs=None, valvestates=None):
         """
@@ -107,25 +109,7 @@ class Olfactometers(QtGui.QMainWindow):
         :return: True if all setting appears successful.
         :rtype: bool
         """
-
-        successes = []
-        if not hasattr(odors, '__iter__'):
-            if len(self.olfas) < 2:
-                odors = (odors, )  # make into tuple
-        if not hasattr(concs, '__iter__'):
-            if len(self.olfas) < 2:
-                concs = (concs, )  # make into tuple
-        if not len(odors) == len(self.olfas):
-            raise OlfaException('Number of odors specified must be equal to the number of olfactometers.')
-        if not valvestates:
-            valvestates = [None] * len(odors)  #just allows us to zip through this. Olfactometer will deal with Nones.
-        if not concs:
-            concs = [None] * len(odors)  # just allows us to zip through this. Olfactometer will deal with Nones.
-        for odor, conc, olfa, valvestate in zip(odors, concs, self.olfas, valvestates):
-            if odor:
-                success = olfa.set_odor(odor, conc, valvestate)
-                successes.append(success)
-        return all(successes)
+        return self.rig.set_odors(odors, concs, valvestates)
 
     def set_dummy_vials(self):
         """
@@ -134,11 +118,7 @@ class Olfactometers(QtGui.QMainWindow):
         :return: True if all dummys set.
         :rtype: bool
         """
-        successes = []
-        for o in self.olfas:
-            success = o.set_dummy_vial()
-            successes.append(success)
-        return all(successes)
+        return self.rig.set_dummy_vials()
 
     def set_flows(self, flows):
         """
@@ -148,49 +128,17 @@ class Olfactometers(QtGui.QMainWindow):
         :return: True if sets appear to be successful as reported by olfas.
         :rtype: bool
         """
-        successes = []
-        if not len(self.olfas) == len(flows):
-            raise OlfaException('Number of flowrates specified must equal then number of olfactometers.')
-        for olfa, flow in zip(self.olfas, flows):
-            if flow:
-                success = olfa.set_flows(flow)
-                successes.append(success)
-        return all(successes)
+        return self.rig.set_flows(flows)
 
     def set_dilution_flows(self, olfa_dilution_flows=(), global_dilution_flows=()):
         """
         This sets dilution flows for dilutors attached to olfactometers or global dilutors attached to all olfactometers.
-        Each flow spec is specified by a list of flowrates: [vac, air].
+        Each flow spec is specified by a list of flowrates: [vac, air]. See OlfactometerRig.set_dilution_flows.
 
-        :param olfa_dilution_flows: list of lists of lists specifying dilution flows for dilutors attached to
-        olfactometers: [[[olfa1_vac1, olfa1_air1], [olfa1_vac2, olfa1_air2], ...], [[olfa2_vac1, olfa2_vac2],... ], ...]
-        :param global_dilution_flows: sets flow for global dilutor (ie those attached to all olfactometers):
-        [[global1_vac, global1_air], [global2_vac,...], ...]
         :return: True if all setting appears successful.
         :rtype: bool
         """
-
-        olfa_succeses = []
-        global_successes = []
-        if not len(olfa_dilution_flows) == len(self.olfas):
-            raise OlfaException('Number of flowrate pairs for olfa_dilution_flows parameter '
-                                'must be consistent with number of olfactometers.\n\n'
-                                '\t\t( i.e. "[(olfa1_vac, olfa1_air), (olfa2_vac, olfa2_air), ...]" )')
-        if olfa_dilution_flows:
-            for olfa, flows in zip(self.olfas, olfa_dilution_flows):
-                success = olfa.set_dilution(flows=flows)
-                olfa_succeses.append(success)
-        olfa_success = all(olfa_succeses)
-        if not len(global_dilution_flows) == len(self.dilutors):
-            raise OlfaException('Number of flowrate pairs for global_dilution_flows parameter must be consistent with '
-                                'number of global dilutors present in configuration. \n\n'
-                                '\t\tThis does not include dilutors embedded in olfactometer objects!!!')
-        if global_dilution_flows:
-            for dilutor, flows in zip(self.dilutors, global_dilution_flows):
-                success = dilutor.set_flows(flows)
-                global_successes.append(success)
-        global_success = all(global_successes)
-        return all((olfa_success, global_success))
+        return self.rig.set_dilution_flows(olfa_dilution_flows, global_dilution_flows)
 
     def check_flows(self):
         """
@@ -198,10 +146,7 @@ class Olfactometers(QtGui.QMainWindow):
         :return: True if all olfas' MFCs are flowing.
         :rtype: bool
         """
-        successes = []
-        for o in self.olfas:
-            successes.append(o.check_flows())
-        return all(successes)
+        return self.rig.check_flows()
 
     def _buildmenubar(self, bar):
         assert isinstance(bar, QtGui.QMenuBar)
@@ -238,41 +183,33 @@ class Olfactometers(QtGui.QMainWindow):
         self.check_flows_before_opening_action.setStatusTip('Enable or disable flow check prior to opening valves.')
         self.check_flows_before_opening_action.setCheckable(True)
         self.check_flows_before_opening_action.setChecked(True)
+        self.check_flows_before_opening_action.toggled.connect(self.rig.set_check_flows)
         toolsmenu.addAction(self.check_flows_before_opening_action)
 
-    def _config_olfas(self, olfa_specs):
+    def _config_olfas(self, olfa_devices):
         """
 
-        :param olfa_specs: tuple of olfactometer specs from olfa dict.
-        :return:
+        :param olfa_devices: list of olfactometer devices from the rig.
+        :return: list of olfactometer widgets.
         """
         olfas = list()
-        for i in xrange(len(olfa_specs)):
-            o = olfa_specs[i]
-            try:
-                olfatype = o['olfa_interface']
-            except KeyError:
-                olfatype = 'teensy'
-            if olfatype == 'teensy':
-                olfa = TeensyOlfa(self, config_dict=o)
-                self.check_flows_before_opening_action.toggled.connect(olfa.check_flows_changed)
+        for i, device in enumerate(olfa_devices):
+            if isinstance(device, TeensyOlfaDevice):
+                olfa = TeensyOlfa(self, device=device)
                 olfa.setTitle(olfa.title() + ' ({0})'.format(i))
             olfas.append(olfa)
         return olfas
 
-    def _config_dilutors(self, dilutor_config):
+    def _config_dilutors(self, dilutor_devices):
         """
-        Add dilutor objects.
+        Add dilutor widgets.
 
-        :param dilutor_config: list of dicts specifying dilutor configurations.
+        :param dilutor_devices: list of global dilutor devices from the rig.
         :return:
         """
         dilutors = []
-        for i in xrange(len(dilutor_config)):
-            v = dilutor_config[i]
-            dilutor_type = v['dilutor_type']
-            logging.debug('Configuring {0} dilutor.'.format(dilutor_type))
-            dil = DILUTORS[dilutor_type](self, v)
+        for i, device in enumerate(dilutor_devices):
+            dil = Dilutor(device)
             dilutors.append(dil)
             dil.setTitle(dil.title() + " ({0})".format(i))
         return dilutors
@@ -293,7 +230,8 @@ class Olfactometers(QtGui.QMainWindow):
         self.olfas = []
         _, config_obj = get_olfa_config(self.config_fn)
         self.olfa_specs = config_obj['Olfactometers']
-        self.olfas = self._config_olfas(self.olfa_specs)
+        self.rig.configure_olfactometers(self.olfa_specs)
+        self.olfas = self._config_olfas(self.rig.olfas)
         for o in self.olfas:
             self.centralWidget().layout().addWidget(o)
         return
@@ -323,39 +261,10 @@ class Olfactometers(QtGui.QMainWindow):
         self.stimulus_template_dialog.show()
 
     def generate_stimulus_template(self):
-        stimulus_template = {}
-        olfa_templates = {}
-        dilutor_templates = {}
-
-        for i in xrange(len(self.olfas)):
-            olfa = self.olfas[i]
-            k = 'olfa_{0}'.format(i)
-            olfa_templates[k] = olfa.generate_stimulus_template_string()
-        stimulus_template['olfas'] = olfa_templates
-        if self.dilutors:
-            for i in xrange(len(self.dilutors)):
-                dil = self.dilutors[i]
-                k = 'dilutor_{0}'.format(i)
-                dilutor_templates[k] = dil.generate_stimulus_templates()
-            stimulus_template['dilutors'] = dilutor_templates
-        s = pformat(stimulus_template, width=120)
-        return s
+        return self.rig.generate_stimulus_template()
 
     def generate_tables_definition(self):
-        definition = dict()
-        dilutor_def = dict()
-        olfa_definition = dict()
-        for i, dilutor in enumerate(self.dilutors):
-            assert isinstance(dilutor, Dilutor)
-            k = 'dilutor_{0}'.format(i)
-            dilutor_def[k] = dilutor.generate_tables_definition()
-        for i, olfa in enumerate(self.olfas):
-            assert isinstance(olfa, Olfactometer)
-            k = 'olfa_{0}'.format(i)
-            olfa_definition[k] = olfa.generate_tables_definition()
-        definition['olfas'] = olfa_definition
-        definition['dilutors'] = dilutor_def
-        return flatten_dictionary(definition)
+        return self.rig.generate_tables_definition()
 
     @QtCore.pyqtSlot()
     def _open_config(self):
@@ -385,9 +294,10 @@ class Olfactometers(QtGui.QMainWindow):
 
     def close_serials(self):
         for o in self.olfas:
-            o.close_serial()
+            o.close_serial()  # stops the display timers and closes the devices.
         for d in self.dilutors:
             d.close_serial()
+        self.rig.close_serials()  # also shuts down the rig's thread pool.
 
 
 def main(config_path=''):
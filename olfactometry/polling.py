@@ -0,0 +1,145 @@
+"""
+Background MFC polling.
+
+MFC readings are taken on a PollingWorker thread and stored in a ReadingCache. Anything that needs the current flow
+(LCD displays, flow checks before opening a vial) reads the cache instead of talking to the serial port. The cache also
+records every reading in a FlowHistory (see telemetry.py).
+"""
+
+import threading
+import time
+import logging
+from collections import namedtuple
+from telemetry import FlowHistory, DEFAULT_HISTORY_SIZE, empty_records
+
+
+# Latest reading for an MFC:
+#   flow: flow normalized to the MFC capacity (0.0 to 1.0).
+#   timestamp: time.time() of the last successful reading, 0. if the MFC has never been read.
+#   status: 'ok', 'no reading' (last poll failed), 'negative flow' or 'not polled'.
+FlowReading = namedtuple('FlowReading', ('flow', 'timestamp', 'status'))
+
+NO_READING = FlowReading(0., 0., 'not polled')
+
+
+class ReadingCache(object):
+    """
+    Thread-safe store of the latest FlowReading for each MFC, and of the history of readings.
+    """
+
+    def __init__(self, history_size=DEFAULT_HISTORY_SIZE):
+        """
+
+        :param history_size: number of readings kept in the history of each MFC.
+        """
+        self._lock = threading.Lock()
+        self._readings = {}
+        self._histories = {}
+        self.history_size = history_size
+
+    def update(self, key, flow, setpoint=None):
+        """
+        Records the result of a poll. If the poll failed (flow is None), the last good flow and timestamp are kept so
+        that stale readings can be detected from the timestamp. The history records the failed reading with the time
+        of the poll and a NaN flow.
+
+        :param key: MFC the reading belongs to.
+        :param flow: normalized flow, or None if the poll failed.
+        :param setpoint: normalized setpoint of the MFC at the time of the reading (recorded in the history).
+        :return: the new reading.
+        :rtype: FlowReading
+        """
+        with self._lock:
+            now = time.time()  # taken under the lock, so that the history is appended in time order.
+            last = self._readings.get(key, NO_READING)
+            if flow is None:
+                reading = FlowReading(last.flow, last.timestamp, 'no reading')
+            elif flow < 0.:
+                reading = FlowReading(flow, now, 'negative flow')
+            else:
+                reading = FlowReading(flow, now, 'ok')
+            self._readings[key] = reading
+            history = self._histories.get(key)
+            if history is None:
+                history = self._histories[key] = FlowHistory(self.history_size)
+            history.append(now, setpoint, flow, reading.status)
+        return reading
+
+    def get(self, key):
+        """
+        :param key: MFC to look up.
+        :return: latest reading for the MFC.
+        :rtype: FlowReading
+        """
+        with self._lock:
+            return self._readings.get(key, NO_READING)
+
+    def history(self, key, start=None, end=None):
+        """
+        :param key: MFC to look up.
+        :param start: start time (time.time()), or None for the oldest reading.
+        :param end: end time, or None for the newest reading.
+        :return: copy of the MFC's history records with start <= timestamp < end (see telemetry.RECORD_DTYPE).
+        :rtype: numpy.ndarray
+        """
+        with self._lock:
+            history = self._histories.get(key)
+            if history is None:
+                return empty_records()
+            return history.window(start, end)
+
+
+class PollingWorker(threading.Thread):
+    """
+    Daemon thread that calls a polling function at a fixed interval. Polling can be paused and resumed (ie while a
+    user is dragging an MFC slider).
+    """
+
+    def __init__(self, poll_function, interval, name='MFC poller'):
+        """
+
+        :param poll_function: function called on each polling tick. Exceptions are logged and polling continues.
+        :param interval: polling interval in seconds.
+        :param name: thread name.
+        """
+        super(PollingWorker, self).__init__(name=name)
+        self.daemon = True
+        self.poll_function = poll_function
+        self.interval = interval
+        self._wake = threading.Event()
+        self._paused = False
+        self._stopped = False
+
+    def run(self):
+        while not self._stopped:
+            if not self._paused:
+                try:
+                    self.poll_function()
+                except Exception:
+                    logging.exception('{0}: error while polling.'.format(self.name))
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def pause(self):
+        self._paused = True
+
+    def resume(self):
+        if self._paused:
+            self._paused = False
+            self._wake.set()  # poll right away rather than waiting for the rest of the interval.
+
+    def is_active(self):
+        """
+        :return: True if the worker is running and not paused.
+        :rtype: bool
+        """
+        return self.is_alive() and not self._paused and not self._stopped
+
+    def stop(self):
+        """
+        Stops polling and waits for the polling in progress (if any) to finish.
+        """
+        self._stopped = True
+        self._wake.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
@@ -0,0 +1,585 @@
+"""
+Simulated hardware for running the olfactometry stack without devices attached.
+
+The simulated devices replace the serial.Serial object of a device. They implement the parts of the pyserial interface
+used by SerialTransport (write, read, inWaiting, timeout, close) and answer with the same text protocol as the real
+hardware:
+
+* SimulatedTeensy speaks the Teensy_olfactometer.ino protocol (echo and ">" prompt, valve, vial, vialOn, vialOff, MFC,
+  DMFC, DMFCpoll and the seqClear/seqAdd/seqRun stimulus sequences), as well as the binary frames of framing.py. Alicat
+  MFCs behind it reply after a delay, and reads return "Error -2" until the data frame is available, like the real
+  controller.
+* SimulatedAlicatBus speaks the raw Alicat address protocol used by dilutors (ie "A\r" and "A32000\r").
+
+A device is simulated when its configuration has a "simulator" object (see docs/json_specs.md), ie:
+    "simulator": {"latency": 0.002, "jitter": 0.001, "drop_rate": 0.01, "alicat_latency": 0.01}
+
+The MFCs are built from the device's "MFCs" configuration, so no other configuration is needed.
+"""
+
+import threading
+import time
+import math
+import random
+import struct
+import logging
+from collections import deque
+import framing
+
+
+class SimulatedAlicat(object):
+    """
+    Alicat mass flow controller. The flow follows the setpoint with a first order response.
+    """
+
+    def __init__(self, address='A', capacity=1000, gas='Air', setpoint=0., settle_time=0., noise=0., rng=None):
+        """
+
+        :param address: Alicat unit ID.
+        :param capacity: capacity in SCCM. Alicats above 1000 SCCM report in SLPM, like the real devices.
+        :param gas: gas name shown at the end of the data frame.
+        :param setpoint: initial setpoint normalized to capacity (0.0 to 1.0).
+        :param settle_time: time constant of the flow response in seconds. 0 sets the flow immediately.
+        :param noise: standard deviation of the reported flow, normalized to capacity.
+        :param rng: random.Random instance.
+        """
+        self.address = address
+        self.capacity = float(capacity)
+        self.gas = gas
+        self.units_per_sccm = .001 if capacity > 1000 else 1.
+        self.settle_time = settle_time
+        self.noise = noise
+        self.rng = rng or random.Random()
+        self.setpoint = setpoint
+        self._flow = setpoint
+        self._flow_time = 0.
+
+    def flow(self, t):
+        """
+        :param t: simulated time.
+        :return: flow normalized to capacity at time t.
+        """
+        if self.settle_time > 0. and t > self._flow_time:
+            a = 1. - math.exp(-(t - self._flow_time) / self.settle_time)
+            self._flow += (self.setpoint - self._flow) * a
+        else:
+            self._flow = self.setpoint
+        self._flow_time = t
+        return self._flow + (self.rng.gauss(0., self.noise) if self.noise else 0.)
+
+    def command(self, command, t):
+        """
+        Handles an ASCII command sent to the Alicat.
+
+        :param command: command without the '\r' terminator.
+        :param t: simulated time at which the command is received.
+        :return: data frame without terminator, or None if the command is not addressed to this unit.
+        """
+        if not command.startswith(self.address):
+            return None
+        arg = command[len(self.address):].strip()
+        if arg:
+            try:
+                self.setpoint = min(max(int(arg) / 64000., 0.), 1.)
+            except ValueError:
+                return '?'
+        return self.frame(t)
+
+    def frame(self, t):
+        full_scale = self.capacity * self.units_per_sccm
+        mass = self.flow(t) * full_scale
+        setpoint = self.setpoint * full_scale
+        return '{0} +014.70 +025.00 {1:+07.3f} {1:+07.3f} {2:+07.3f} {3}'.format(self.address, mass, setpoint,
+                                                                                  self.gas)
+
+
+class SimulatedSerial(object):
+    """
+    Base class for simulated serial devices.
+
+    Replies are delivered after a configurable latency plus uniformly distributed jitter, in the order the commands
+    were written. The device processes one command at a time, so a burst of commands queues up behind the slowest
+    one, like on the real hardware. A fraction of replies can be dropped (drop_rate) to exercise timeouts.
+    """
+    terminator = '\r'
+
+    def __init__(self, latency=.001, jitter=0., drop_rate=0., seed=None, timeout=1., name='simulator'):
+        """
+
+        :param latency: time for the device to process a command and reply, in seconds.
+        :param jitter: maximum random delay added to the latency, in seconds.
+        :param drop_rate: probability that a reply is lost (0.0 to 1.0).
+        :param seed: random seed, to make simulations reproducible.
+        :param timeout: read timeout in seconds (as for serial.Serial).
+        :param name: port name.
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.rng = random.Random(seed)
+        self.timeout = timeout
+        self.port = name
+        self.isOpen = True
+        self.commands_received = 0
+        self.replies_dropped = 0
+        self._in_buffer = ''
+        self._output = deque()  # (delivery time, data), in delivery order.
+        self._busy_until = 0.  # simulated time at which the device finishes the commands it has received.
+        self._lock = threading.Condition()
+
+    def write(self, data):
+        with self._lock:
+            self._receive(data)
+            self._lock.notify_all()
+        return len(data)
+
+    def _receive(self, data):
+        self._in_buffer += data
+        while self.terminator in self._in_buffer:
+            command, self._in_buffer = self._in_buffer.split(self.terminator, 1)
+            self._process(command, self._start_command())
+
+    def _start_command(self):
+        """
+        :return: simulated time at which the device has processed a command received now.
+        """
+        self.commands_received += 1
+        t = max(time.time(), self._busy_until)
+        self._advance(t)
+        self._busy_until = t + self.latency + self.rng.uniform(0., self.jitter)
+        return self._busy_until
+
+    def read(self, size=1):
+        deadline = time.time() + (self.timeout if self.timeout is not None else 1e9)
+        with self._lock:
+            while True:
+                self._advance(time.time())
+                data = self._take(size)
+                now = time.time()
+                if data or now >= deadline or not self.isOpen:
+                    return data
+                wait = deadline - now
+                if self._output:
+                    wait = min(wait, max(self._output[0][0] - now, 0.))
+                event = self._next_event()
+                if event is not None:
+                    wait = min(wait, max(event - now, 0.))
+                self._lock.wait(wait)
+
+    def inWaiting(self):
+        now = time.time()
+        with self._lock:
+            self._advance(now)
+            return sum(len(d) for t, d in self._output if t <= now)
+
+    def flushInput(self):
+        with self._lock:
+            self._output.clear()
+
+    def close(self):
+        with self._lock:
+            self.isOpen = False
+            self._lock.notify_all()
+
+    def _take(self, size):
+        now = time.time()
+        data = ''
+        while self._output and self._output[0][0] <= now and len(data) < size:
+            t, chunk = self._output.popleft()
+            n = size - len(data)
+            if len(chunk) > n:
+                self._output.appendleft((t, chunk[n:]))
+                chunk = chunk[:n]
+            data += chunk
+        return data
+
+    def _send(self, data, t):
+        """
+        Queues output from the device to be delivered at simulated time t.
+        """
+        if self._output and self._output[-1][0] > t:
+            t = self._output[-1][0]
+        self._output.append((t, data))
+
+    def _drop(self):
+        if self.drop_rate and self.rng.random() < self.drop_rate:
+            self.replies_dropped += 1
+            return True
+        return False
+
+    def _process(self, command, t):
+        """
+        Handles one command received by the device, replying with _send().
+
+        :param command: command without terminator.
+        :param t: simulated time at which the device has processed the command.
+        """
+        raise NotImplementedError
+
+    def _advance(self, t):
+        """
+        Runs the work that the device does on its own (without a command) up to simulated time t.
+        """
+        return
+
+    def _next_event(self):
+        """
+        :return: simulated time of the next work done by the device on its own, or None.
+        """
+        return None
+
+
+class SimulatedTeensy(SimulatedSerial):
+    """
+    Teensy olfactometer controller with its slave boards and digital (Alicat) or analog MFCs.
+    """
+
+    def __init__(self, slave_index=1, mfcs=(), alicat_latency=.005, poll_tries=50, binary_protocol=True,
+                 **kwargs):
+        """
+
+        :param slave_index: I2C address of the olfactometer slave board. Other addresses reply with "Error -1".
+        :param mfcs: list of MFC configuration dictionaries from the olfactometer configuration.
+        :param alicat_latency: time for an Alicat to reply to a forwarded command, in seconds.
+        :param poll_tries: number of 2 ms read attempts made by DMFCpoll before giving up on an MFC.
+        :param binary_protocol: set False to simulate firmware without binary framing (see framing.py).
+        :param kwargs: SimulatedSerial parameters.
+        """
+        super(SimulatedTeensy, self).__init__(**kwargs)
+        self.binary_protocol = binary_protocol
+        self._frames = framing.FrameDecoder()
+        self.slave_index = slave_index
+        self.alicat_latency = alicat_latency
+        self.poll_tries = poll_tries
+        self.valves = set()
+        self.vials = set()
+        self.analog = {}  # {mfc port: setpoint}
+        self.alicats = {}  # {mfc port: SimulatedAlicat}
+        self._alicat_replies = {}  # {mfc port: (ready time, frame)}
+        self.sequence = []  # uploaded sequence steps: (time in ms, argv of the command with the device address).
+        self._sequence_start = None
+        self._sequence_next = 0
+        self._sequence_error = False
+        for spec in mfcs:
+            port = int(spec.get('arduino_port_num', 0))
+            if spec['MFC_type'] == 'alicat_digital':
+                self.alicats[port] = SimulatedAlicat(spec.get('address', 'A'), spec['capacity'], spec.get('gas', ''),
+                                                     rng=self.rng)
+            else:
+                self.analog[port] = 0.
+        self._send('\r\n>', 0.)
+
+    @classmethod
+    def from_config(cls, config_dict):
+        """
+        Builds a simulated Teensy from a single olfactometer configuration with a "simulator" object.
+        """
+        sim = dict(config_dict.get('simulator') or {})
+        flow_params = dict((k, sim.pop(k)) for k in ('settle_time', 'noise', 'initial_flow') if k in sim)
+        teensy = cls(slave_index=config_dict['slave_index'], mfcs=config_dict.get('MFCs', ()),
+                     name='SIM:{0}'.format(config_dict.get('com_port', '')), **sim)
+        for alicat in teensy.alicats.values():
+            alicat.settle_time = flow_params.get('settle_time', 0.)
+            alicat.noise = flow_params.get('noise', 0.)
+            alicat.setpoint = alicat._flow = flow_params.get('initial_flow', 0.)
+        return teensy
+
+    def _receive(self, data):
+        if not self.binary_protocol:
+            return super(SimulatedTeensy, self)._receive(data)
+        for kind, item in self._frames.feed(data):
+            if kind == 'text':
+                super(SimulatedTeensy, self)._receive(item)
+            elif kind == 'bad':
+                t = self._start_command()
+                self._send(framing.encode_frame(item, framing.NAK, struct.pack('<h', -4)), t)
+            else:
+                self._process_frame(item, self._start_command())
+
+    def _process_frame(self, frame, t):
+        """
+        Handles a command frame like the firmware, by running the equivalent ASCII command.
+        """
+        seq, opcode, payload = frame
+        command = framing.decode_command(opcode, payload)
+        reply = self._reply(command.split(), t) if command else None
+        if reply is not None and self._drop():
+            return
+        status, data = -1, ''
+        if reply is not None and reply.startswith('Error'):
+            status = self._int(reply.split()[1])
+        elif reply is not None:
+            status = 0
+            if opcode == framing.SET_VIAL:
+                data = payload[2]
+            elif opcode == framing.READ_MFC:
+                data = struct.pack('<H', int(float(reply) * 65535))
+            elif opcode == framing.READ_D_MFC:
+                data = reply.rstrip('\r')
+            elif opcode == framing.POLL_D_MFC:
+                data = reply[len('MFCpoll '):]
+        reply_frame = framing.encode_frame(seq, opcode | framing.REPLY, struct.pack('<h', status) + data)
+        self._send(reply_frame, self._busy_until)
+
+    def _cmd_protocol(self, device, args, t):
+        if self.binary_protocol:
+            return 'protocol binary 1'
+
+    def _process(self, command, t):
+        argv = command.split()
+        reply = self._reply(argv, t) if argv else None
+        if reply is not None and self._drop():
+            reply = None
+        out = command + '\r\n'
+        if reply is not None:
+            out += reply + '\r\n'
+        self._send(out + '>', self._busy_until)
+
+    def _reply(self, argv, t):
+        """
+        :return: reply line without end of line, or None if the firmware prints no reply.
+        """
+        verb = argv[0]
+        args = argv[1:] + [''] * 4
+        handler = getattr(self, '_cmd_' + verb, None)
+        if handler is None:
+            return None
+        try:
+            device = int(args[0])
+        except ValueError:
+            device = 0
+        return handler(device, args, t)
+
+    def _cmd_seqClear(self, device, args, t):
+        if not args[0]:
+            return 'seqClear <DEVICE>'
+        self.sequence = []
+        self._sequence_start = None
+        self._sequence_error = False
+        return 'seq cleared'
+
+    def _cmd_seqAdd(self, device, args, t):
+        if not args[0] or not args[1]:
+            return 'seqAdd <DEVICE> <T> <COMMAND> <N> [<ARG>]'
+        step_time = self._int(args[1])
+        verb, n, arg = args[2], self._int(args[3]), args[4]
+        if self._sequence_start is not None or len(self.sequence) >= 32 or not 0 <= device < 128:
+            self._sequence_error = True
+            return 'Error -1'
+        if self.sequence and step_time < self.sequence[-1][0]:
+            self._sequence_error = True
+            return 'Error -1'
+        if verb in ('vialOn', 'vialOff') or (verb == 'vial' and arg in ('on', 'off')):
+            valid = 0 < n < 17
+        elif verb in ('MFC', 'DMFC') and arg:
+            valid = 0 < n < 3
+        else:
+            valid = False
+        if not valid:
+            self._sequence_error = True
+            return 'Error -1'
+        self.sequence.append((step_time, [verb, str(device), str(n)] + ([arg] if arg else [])))
+        return 'seq step {0}'.format(len(self.sequence) - 1)
+
+    def _cmd_seqRun(self, device, args, t):
+        if not args[0]:
+            return 'seqRun <DEVICE>'
+        if self._sequence_start is not None or self._sequence_error or not self.sequence:
+            return 'Error -1'
+        self._sequence_start = t
+        self._sequence_next = 0
+        return 'seq started {0}'.format(len(self.sequence))
+
+    def _next_event(self):
+        if self._sequence_start is None:
+            return None
+        return self._sequence_start + self.sequence[self._sequence_next][0] / 1000.
+
+    def _advance(self, t):
+        """
+        Executes the sequence steps that are due at simulated time t and reports them like the firmware.
+        """
+        while self._sequence_start is not None:
+            due = self._next_event()
+            if due > t:
+                return
+            step_time, argv = self.sequence[self._sequence_next]
+            reply = self._reply(argv, due) or ''
+            status = self._int(reply.split()[1]) if reply.startswith('Error') else 0
+            out = '!seq {0} {1} {2}\r\n'.format(self._sequence_next, step_time, status)
+            self._sequence_next += 1
+            if self._sequence_next >= len(self.sequence):
+                out += '!seqDone {0}\r\n'.format(len(self.sequence))
+                self._sequence_start = None
+            self._send(out + '>', due)
+        return
+
+    def _slave_error(self, device):
+        if device != self.slave_index:
+            return 'Error -1'  # no I2C slave at this address.
+
+    def _int(self, s):
+        try:
+            return int(s)
+        except ValueError:
+            return 0
+
+    def _cmd_valve(self, device, args, t):
+        n = self._int(args[1])
+        if not (0 < device < 128 and 0 < n < 33):
+            return 'valve <DEVICE> <N> {on,off}, N = {1..32}'
+        return self._slave_error(device) or self._set_state(self.valves, n, args[2], 'valve set', 'valve cleared',
+                                                            'valve <DEVICE> <N> {on,off}')
+
+    def _cmd_vial(self, device, args, t):
+        n = self._int(args[1])
+        if not (0 < device < 128 and 0 < n < 17):
+            return 'vial <DEVICE> <N> {on,off}, N = {1..16}'
+        return self._slave_error(device) or self._set_state(self.vials, n, args[2], 'vial set', 'vial cleared',
+                                                            'vial <DEVICE> <N> {on,off}')
+
+    def _set_state(self, states, n, arg, set_reply, cleared_reply, usage):
+        if not arg:
+            return 'on' if n in states else 'off'
+        elif arg == 'on':
+            states.add(n)
+            return set_reply
+        elif arg == 'off':
+            states.discard(n)
+            return cleared_reply
+        return usage
+
+    def _cmd_vialOn(self, device, args, t):
+        n = self._int(args[1])
+        if not (0 < device < 128 and 0 < n < 17):
+            return 'vialOn <DEVICE> <N>, N = {1..16}'
+        error = self._slave_error(device)
+        if error:
+            return error
+        self.vials.add(n)
+        return 'vial and dummy on'
+
+    def _cmd_vialOff(self, device, args, t):
+        n = self._int(args[1])
+        if not (0 < device < 128 and 0 < n < 17):
+            return 'vialOff <DEVICE> <N>, N = {1..16}'
+        error = self._slave_error(device)
+        if error:
+            return error
+        self.vials.discard(n)
+        return 'vial and dummy off'
+
+    def _cmd_MFC(self, device, args, t):
+        n = self._int(args[1])
+        if not (0 < device < 128 and 0 < n < 3):
+            return 'MFC <DEVICE> <N> {value}, N = {1..2}'
+        error = self._slave_error(device)
+        if error:
+            return error
+        if not args[2]:
+            return '{0:.2f}'.format(self.analog.get(n, 0.))
+        try:
+            self.analog[n] = float(args[2])
+        except ValueError:
+            self.analog[n] = 0.
+        return 'MFC set'
+
+    def _cmd_DMFC(self, device, args, t):
+        n = self._int(args[1])
+        if not (0 < device < 128 and 0 < n < 3):
+            return 'DMFC <DEVICE> <N> {string}, N = {1..2}'
+        error = self._slave_error(device)
+        if error:
+            return error
+        if not args[2]:
+            resp, frame = self._read_dmfc(n, t)
+            return frame + '\r' if resp == 0 else 'Error {0}'.format(resp)
+        self._set_dmfc(n, args[2], t)
+        return 'MFC set'
+
+    def _cmd_DMFCpoll(self, device, args, t):
+        if not 0 < device < 128:
+            return 'DMFCpoll <DEVICE> <N> <ADDRESS> [<N> <ADDRESS>], N = {1..2}'
+        pairs = []
+        for i in (1, 3):
+            if args[i] and args[i + 1]:
+                pairs.append((self._int(args[i]), args[i + 1]))
+        if not pairs or any(not 0 < n < 3 for n, a in pairs):
+            return 'Error -1'
+        error = self._slave_error(device)
+        if error:
+            return error
+        for n, address in pairs:  # flush and forward all the requests first, like the firmware.
+            self._read_dmfc(n, t)
+            self._set_dmfc(n, address, t)
+        replies = []
+        for n, address in pairs:
+            resp, frame = self._read_dmfc(n, t)
+            tries = 0
+            while resp == -2 and tries < self.poll_tries:
+                t += .002  # the firmware waits 2 ms between reads, which keeps the device busy.
+                resp, frame = self._read_dmfc(n, t)
+                tries += 1
+            replies.append('{0}:{1}'.format(n, frame if resp == 0 else 'Error {0}'.format(resp)))
+        self._busy_until = max(self._busy_until, t)
+        return 'MFCpoll ' + ';'.join(replies)
+
+    def _set_dmfc(self, n, command, t):
+        alicat = self.alicats.get(n)
+        if alicat is None:
+            return
+        frame = alicat.command(command, t)
+        if frame is not None:
+            self._alicat_replies[n] = (t + self.alicat_latency, frame)
+
+    def _read_dmfc(self, n, t):
+        """
+        :return: (response code, data frame). -2 means that the Alicat has not replied (yet).
+        """
+        ready, frame = self._alicat_replies.get(n, (None, ''))
+        if ready is None or t < ready:
+            return -2, ''
+        del self._alicat_replies[n]
+        return 0, frame
+
+
+class SimulatedAlicatBus(SimulatedSerial):
+    """
+    Serial line shared by Alicat MFCs addressed by unit ID (ie the MFCs of a serial forwarding dilutor). Commands and
+    replies are terminated by '\r' and are not echoed.
+    """
+
+    def __init__(self, mfcs=(), **kwargs):
+        """
+
+        :param mfcs: list of MFC configuration dictionaries (with "address", "capacity" and "gas").
+        :param kwargs: SimulatedSerial parameters.
+        """
+        super(SimulatedAlicatBus, self).__init__(**kwargs)
+        self.alicats = [SimulatedAlicat(spec['address'], spec['capacity'], spec.get('gas', ''), rng=self.rng)
+                        for spec in mfcs]
+
+    @classmethod
+    def from_config(cls, config_dict):
+        """
+        Builds a simulated Alicat bus from a dilutor configuration with a "simulator" object.
+        """
+        sim = dict(config_dict.get('simulator') or {})
+        flow_params = dict((k, sim.pop(k)) for k in ('settle_time', 'noise', 'initial_flow') if k in sim)
+        sim.pop('alicat_latency', None)  # the Alicat reply time is the bus latency here.
+        bus = cls(mfcs=config_dict.get('MFCs', ()), name='SIM:{0}'.format(config_dict.get('com_port', '')), **sim)
+        for alicat in bus.alicats:
+            alicat.settle_time = flow_params.get('settle_time', 0.)
+            alicat.noise = flow_params.get('noise', 0.)
+            alicat.setpoint = alicat._flow = flow_params.get('initial_flow', 0.)
+        return bus
+
+    def _process(self, command, t):
+        command = command.strip()
+        for alicat in self.alicats:
+            if command and command[0] == alicat.address and not command[1:2].isalpha():
+                frame = alicat.command(command, t)
+                if frame is not None and not self._drop():
+                    self._send(frame + '\r', t)
+                return
+        logging.debug('{0}: no simulated Alicat for {1}'.format(self.port, repr(command)))
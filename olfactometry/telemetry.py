@@ -0,0 +1,150 @@
+"""
+MFC flow telemetry.
+
+Every reading stored in a ReadingCache (see polling.py) is also recorded in a FlowHistory: a preallocated NumPy ring
+buffer of timestamp, setpoint, measured flow and status for one MFC. The buffer has a fixed size, so the oldest records
+are overwritten once it is full and recording does not allocate memory.
+
+Windows of the history can be queried by time, ie to check the flows during a trial:
+
+    t_start = time.time()
+    rig.set_stimulus(stim)
+    ...
+    histories = rig.flow_history(t_start, time.time())  # {'olfa_0_mfc_0': records, ...}
+
+and written to an HDF5 file (ie next to a Voyeur trial) with rig.export_flow_history().
+"""
+
+import numpy as np
+
+DEFAULT_HISTORY_SIZE = 4096  # records per MFC, a bit over an hour at the default polling interval.
+
+# flow and setpoint are normalized to the MFC capacity. setpoint is NaN if unknown, status is an index in STATUSES.
+RECORD_DTYPE = np.dtype([('timestamp', np.float64),
+                         ('setpoint', np.float32),
+                         ('flow', np.float32),
+                         ('status', np.uint8)])
+
+# FlowReading statuses (see polling.py), in the order they are coded in the status column.
+STATUSES = ('ok', 'no reading', 'negative flow', 'not polled')
+_STATUS_CODES = dict((s, i) for i, s in enumerate(STATUSES))
+
+
+class FlowHistory(object):
+    """
+    Fixed size ring buffer of flow records for one MFC. Records are assumed to be appended in time order. This is not
+    thread-safe, the owner (ie the ReadingCache) must serialize access.
+    """
+
+    def __init__(self, size=DEFAULT_HISTORY_SIZE):
+        """
+
+        :param size: maximum number of records kept.
+        """
+        if size < 1:
+            raise ValueError('History size must be at least 1.')
+        self._data = np.zeros(size, dtype=RECORD_DTYPE)
+        # column views are made once, so that append() only writes scalars.
+        self._timestamp = self._data['timestamp']
+        self._setpoint = self._data['setpoint']
+        self._flow = self._data['flow']
+        self._status = self._data['status']
+        self._next = 0
+        self._count = 0
+
+    @property
+    def size(self):
+        return len(self._data)
+
+    def __len__(self):
+        return self._count
+
+    def append(self, timestamp, setpoint, flow, status):
+        """
+        :param timestamp: time.time() of the record.
+        :param setpoint: setpoint normalized to capacity, or None if unknown.
+        :param flow: measured flow normalized to capacity, or None if the reading failed.
+        :param status: FlowReading status.
+        """
+        i = self._next
+        self._timestamp[i] = timestamp
+        self._setpoint[i] = setpoint if setpoint is not None else np.nan
+        self._flow[i] = flow if flow is not None else np.nan
+        self._status[i] = _STATUS_CODES.get(status, len(STATUSES))
+        self._next = (i + 1) % len(self._data)
+        if self._count < len(self._data):
+            self._count += 1
+
+    def window(self, start=None, end=None):
+        """
+        Returns the records with start <= timestamp < end.
+
+        :param start: start time (time.time()), or None for the oldest record.
+        :param end: end time, or None for the newest record.
+        :return: copy of the records in the window, oldest first.
+        :rtype: np.ndarray
+        """
+        # the two halves of the ring are each sorted by time, so the window is found without copying the buffer.
+        n = len(self._data)
+        if self._count < n:
+            parts = (self._data[:self._count],)
+        else:
+            parts = (self._data[self._next:], self._data[:self._next])
+        windows = []
+        for part in parts:
+            t = part['timestamp']
+            lo = 0 if start is None else np.searchsorted(t, start, 'left')
+            hi = len(part) if end is None else np.searchsorted(t, end, 'left')
+            if hi > lo:
+                windows.append(part[lo:hi])
+        if not windows:
+            return empty_records()
+        return np.concatenate(windows)
+
+    def latest(self):
+        """
+        :return: the newest record, or None if the history is empty.
+        """
+        if not self._count:
+            return None
+        return self._data[self._next - 1].copy()
+
+
+def empty_records():
+    return np.zeros(0, dtype=RECORD_DTYPE)
+
+
+def status_names(records):
+    """
+    :param records: records from FlowHistory.window().
+    :return: list of status strings for the records.
+    """
+    return [STATUSES[s] if s < len(STATUSES) else 'unknown' for s in records['status']]
+
+
+def export_hdf5(h5, histories, where='/flow_history', title=''):
+    """
+    Writes flow histories to an HDF5 file as one table per MFC. Existing tables with the same name are replaced.
+
+    :param h5: open tables.File (ie a Voyeur data file) or path to a file, which is opened in append mode.
+    :param histories: dictionary of {name: records}, ie from OlfactometerRig.flow_history().
+    :param where: path of the group the tables are created in. It is created if needed.
+    :param title: title of the group.
+    :return: None
+    """
+    import tables  # only needed for export.
+    if isinstance(h5, basestring):
+        with tables.open_file(h5, 'a') as f:
+            return export_hdf5(f, histories, where, title)
+    parent, _, name = where.rstrip('/').rpartition('/')
+    if where in h5:
+        group = h5.get_node(where)
+    else:
+        group = h5.create_group(parent or '/', name, title, createparents=True)
+    for key in sorted(histories.keys()):
+        records = histories[key]
+        if key in group:
+            h5.remove_node(group, key)
+        table = h5.create_table(group, key, obj=records, title=key)
+        table.attrs.statuses = STATUSES
+    h5.flush()
@@ -0,0 +1,400 @@
+"""
+Threaded serial transport used by olfactometry devices.
+
+The transport owns a serial port and services it from dedicated writer and reader threads. Commands are queued with
+SerialTransport.send(), which returns immediately with a CommandFuture. Replies are matched to commands in the order
+they were sent, so several commands can be in flight at once without blocking the caller (or the Qt event loop).
+"""
+
+import threading
+import time
+import struct
+import logging
+from collections import deque
+from Queue import Queue
+from serial import SerialException
+import framing
+
+
+class CommandFuture(object):
+    """
+    Placeholder for the reply to a command queued on a SerialTransport. The transport's reader thread fills in the
+    reply when it arrives (or None if the command times out).
+    """
+
+    def __init__(self, command, match=None):
+        self.command = command
+        self.match = match  # optional function taking a reply line and returning False if it is not the reply.
+        self.sent_time = None
+        self.echoed = False  # set by the transport when the device echo of this command is seen.
+        self.seq = None  # sequence number if the command was sent as a binary frame (FramedTransport).
+        self._reply = None
+        self._done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        """
+        :return: True if the reply has arrived or the command has timed out.
+        :rtype: bool
+        """
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Blocks until the command is resolved by the transport.
+
+        :param timeout: optional maximum time to wait in seconds. The transport resolves every command within its
+        reply timeout, so this is usually not needed.
+        :return: reply line (including end of line characters), or None if no reply was received.
+        :rtype: str
+        """
+        self._done.wait(timeout)
+        return self._reply
+
+    def add_done_callback(self, fn):
+        """
+        Calls fn(future) once the command is resolved. If it is already resolved, fn is called immediately.
+
+        Callbacks run on the transport's reader thread, so they must not touch Qt widgets directly.
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _resolve(self, reply):
+        with self._lock:
+            if self._done.is_set():
+                return
+            self._reply = reply
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                logging.exception('Error in callback for command {0}'.format(repr(self.command)))
+
+
+class SerialTransport(object):
+    """
+    Owns a serial port and exchanges line based commands and replies with the device on background threads.
+
+    Devices that echo commands (like the Teensy olfactometer) are handled by matching the echoed line to the command
+    that is waiting for a reply. Lines that do not belong to any outstanding command (ie stale replies from a timed out
+    command) are discarded, so there is no need to flush the input buffer before each command.
+
+    Devices that do not echo cannot be matched by echo: the next line is taken as the reply to the oldest outstanding
+    command. Commands can be sent with a match function (see send()) to recognize their replies, in which case lines
+    that the oldest command does not accept (ie the late reply to a command that timed out) are discarded.
+
+    Devices can also send unsolicited lines that are not replies (ie the step reports of a running stimulus sequence).
+    If async_prefix is set, lines starting with it (after the prompt) are passed to the functions registered with
+    add_async_listener() instead of being matched to commands.
+    """
+
+    def __init__(self, serial_port, terminator='\r', eol='\n', echo=False, prompt='>', reply_timeout=1.,
+                 max_in_flight=8, read_timeout=.05, async_prefix=None, name=''):
+        """
+
+        :param serial_port: open serial.Serial (or compatible) object. The transport takes ownership of the port.
+        :param terminator: string appended to each command when it is written.
+        :param eol: end of line character for replies from the device.
+        :param echo: True if the device echoes each command line before replying (Teensy olfactometer).
+        :param prompt: prompt character that the device prints before echoing a command.
+        :param reply_timeout: seconds to wait for a reply before resolving a command with None.
+        :param max_in_flight: maximum number of commands written to the device that have not been replied to.
+        :param read_timeout: serial read timeout used by the reader thread. This sets how quickly timeouts are noticed.
+        :param async_prefix: prefix of unsolicited lines from the device (ie '!'), or None.
+        :param name: name used for logging and for the transport threads.
+        """
+        self.serial = serial_port
+        self.terminator = terminator
+        self.eol = eol
+        self.echo = echo
+        self.prompt = prompt
+        self.reply_timeout = reply_timeout
+        self.name = name
+        self.serial.timeout = read_timeout
+        self.commands_sent = 0  # number of commands written to the device, for benchmarking.
+        self.async_prefix = async_prefix
+        self._async_listeners = []
+
+        self._send_queue = Queue()
+        self._in_flight = deque()  # futures that have been written to the device, in the order they were written.
+        self._in_flight_lock = threading.Lock()
+        self._window = threading.Semaphore(max_in_flight)
+        self._buffer = ''
+        self._running = True
+
+        self._writer = threading.Thread(target=self._write_loop, name='{0} writer'.format(name))
+        self._writer.daemon = True
+        self._reader = threading.Thread(target=self._read_loop, name='{0} reader'.format(name))
+        self._reader.daemon = True
+        self._writer.start()
+        self._reader.start()
+
+    def send(self, command, match=None):
+        """
+        Queues a command to be written to the device.
+
+        :param command: command string without terminator.
+        :param match: optional function taking a line and returning True if it is the reply to this command. Lines it
+        rejects are discarded while this is the oldest command waiting for a reply.
+        :return: future that is resolved with the reply line.
+        :rtype: CommandFuture
+        """
+        future = CommandFuture(command, match)
+        if self._running:
+            self._send_queue.put(future)
+        else:
+            logging.error('{0}: cannot send {1}, transport is closed.'.format(self.name, repr(command)))
+            future._resolve(None)
+        return future
+
+    def send_many(self, commands):
+        """
+        Queues several commands at once. They are written back to back, without waiting for the replies in between.
+
+        :param commands: iterable of command strings.
+        :return: list of futures in the same order as the commands.
+        :rtype: list of CommandFuture
+        """
+        return [self.send(c) for c in commands]
+
+    def add_async_listener(self, fn):
+        """
+        Registers fn(line) to be called with each unsolicited line (without prompt and end of line). It is called on
+        the reader thread, so it must not block or touch widgets.
+        """
+        self._async_listeners.append(fn)
+
+    def remove_async_listener(self, fn):
+        self._async_listeners.remove(fn)
+
+    def close(self):
+        """
+        Stops the transport threads, resolves outstanding commands with None and closes the serial port.
+        """
+        if not self._running:
+            return
+        self._running = False
+        self._send_queue.put(None)
+        self._window.release()  # unblocks the writer if it is waiting for the window.
+        self._writer.join()
+        self._reader.join()
+        with self._in_flight_lock:
+            outstanding = list(self._in_flight)
+            self._in_flight.clear()
+        while not self._send_queue.empty():
+            f = self._send_queue.get()
+            if f is not None:
+                outstanding.append(f)
+        for f in outstanding:
+            f._resolve(None)
+        self.serial.close()
+
+    def _write_loop(self):
+        while True:
+            future = self._send_queue.get()
+            if future is None:
+                break
+            self._window.acquire()
+            if not self._running:
+                future._resolve(None)
+                break
+            with self._in_flight_lock:
+                future.sent_time = time.time()
+                self._in_flight.append(future)
+            try:
+                self.serial.write(self._encode(future))
+                self.commands_sent += 1
+            except SerialException as e:
+                logging.error('{0}: cannot write {1}: {2}'.format(self.name, repr(future.command), e))
+                self._complete(future, None)
+
+    def _read_loop(self):
+        while self._running:
+            try:
+                n = self.serial.inWaiting()
+                data = self.serial.read(n or 1)  # blocks for up to the read timeout when the device is quiet.
+            except SerialException as e:
+                logging.error('{0}: serial read error: {1}'.format(self.name, e))
+                data = ''
+                time.sleep(self.serial.timeout)
+            if data:
+                self._feed(data)
+            self._expire()
+
+    def _encode(self, future):
+        """
+        :return: bytes to write to the device for the command of future.
+        """
+        return '{0}{1}'.format(future.command, self.terminator)
+
+    def _feed(self, data):
+        self._buffer += data
+        while self.eol in self._buffer:
+            line, self._buffer = self._buffer.split(self.eol, 1)
+            self._handle_line(line + self.eol)
+
+    def _handle_line(self, line):
+        if self.async_prefix and line.lstrip(self.prompt).startswith(self.async_prefix):
+            self._handle_async(line.lstrip(self.prompt).rstrip())
+            return
+        with self._in_flight_lock:
+            head = self._in_flight[0] if self._in_flight else None
+        if head is None:
+            logging.debug('{0}: discarding unsolicited line {1}'.format(self.name, repr(line)))
+            return
+        self._handle_text_line(head, line)
+
+    def _handle_text_line(self, head, line):
+        """
+        Matches a line to head, the oldest command waiting for a reply.
+        """
+        if not self.echo:
+            if head.match is None or head.match(line):
+                self._complete(head, line)
+            else:
+                self._discard(head, line)
+        elif not head.echoed:
+            if line.strip().lstrip(self.prompt) == head.command.strip():
+                head.echoed = True
+            else:
+                logging.debug('{0}: discarding stale line {1}'.format(self.name, repr(line)))
+        elif line.startswith(self.prompt):
+            # The device moved on to the next command without replying to this one.
+            self._complete(head, None)
+            self._handle_line(line)
+        elif head.match is not None and not head.match(line):
+            self._discard(head, line)
+        else:
+            self._complete(head, line)
+
+    def _discard(self, head, line):
+        logging.debug('{0}: discarding line {1}, not a reply to {2}'.format(self.name, repr(line), repr(head.command)))
+
+    def _handle_async(self, line):
+        if not self._async_listeners:
+            logging.debug('{0}: discarding unsolicited line {1}'.format(self.name, repr(line)))
+        for fn in self._async_listeners:
+            try:
+                fn(line)
+            except Exception:
+                logging.exception('{0}: error handling unsolicited line {1}'.format(self.name, repr(line)))
+
+    def _expire(self):
+        now = time.time()
+        while True:
+            with self._in_flight_lock:
+                head = self._in_flight[0] if self._in_flight else None
+            if head is None or now - head.sent_time <= self.reply_timeout:
+                return
+            logging.debug('{0}: no reply to {1}'.format(self.name, repr(head.command)))
+            self._complete(head, None)
+
+    def _complete(self, future, reply):
+        with self._in_flight_lock:
+            try:
+                self._in_flight.remove(future)
+            except ValueError:
+                return
+        self._window.release()
+        future._resolve(reply)
+
+
+class FramedTransport(SerialTransport):
+    """
+    Transport for the Teensy olfactometer that sends commands as binary frames (see framing.py) when the firmware
+    supports them. Replies to frames are matched by sequence number and checked by CRC, so a stale or corrupted reply
+    cannot be taken for the reply to another command. Commands that have no binary form are sent as ASCII lines and
+    matched by their echo, as with SerialTransport.
+
+    Framing is off until negotiate() confirms that the firmware supports it, so this falls back to the ASCII protocol
+    with older firmware.
+    """
+
+    def __init__(self, serial_port, **kwargs):
+        self.framing = False
+        self._decoder = framing.FrameDecoder()
+        self._seq = 0
+        super(FramedTransport, self).__init__(serial_port, **kwargs)  # starts the reader and writer threads.
+
+    def negotiate(self):
+        """
+        Asks the firmware which protocols it supports and enables framing if it can.
+
+        :return: True if framing is enabled.
+        :rtype: bool
+        """
+        line = self.send('protocol').result()
+        self.framing = bool(line) and line.split()[:2] == ['protocol', 'binary']
+        if self.framing:
+            logging.info('{0}: using binary framing.'.format(self.name))
+        else:
+            logging.info('{0}: firmware does not support binary framing, using ASCII.'.format(self.name))
+        return self.framing
+
+    def _encode(self, future):
+        if self.framing:
+            encoded = framing.encode_command(future.command, self._seq)
+            if encoded is not None:
+                future.seq = self._seq
+                future.opcode, data = encoded
+                self._seq = (self._seq + 1) % 256
+                return data
+        return super(FramedTransport, self)._encode(future)
+
+    def _feed(self, data):
+        for kind, item in self._decoder.feed(data):
+            if kind == 'text':
+                super(FramedTransport, self)._feed(item)
+            elif kind == 'bad':
+                logging.warning('{0}: reply frame failed CRC check.'.format(self.name))
+                self._frame_reply(item, None)
+            else:
+                seq, opcode, payload = item
+                if opcode == framing.NAK:
+                    logging.warning('{0}: olfactometer rejected frame {1} (CRC).'.format(self.name, seq))
+                    self._frame_reply(seq, None)
+                elif len(payload) < 2:
+                    self._frame_reply(seq, None)
+                else:
+                    status = struct.unpack('<h', payload[:2])[0]
+                    self._frame_reply(seq, (opcode & ~framing.REPLY, status, payload[2:]))
+
+    def _frame_reply(self, seq, reply):
+        """
+        Completes the framed command with sequence number seq. The firmware handles commands in order, so framed
+        commands sent before it that are still waiting will not get a reply and are completed with None.
+
+        :param reply: (opcode, status, data) or None.
+        """
+        with self._in_flight_lock:
+            framed = [f for f in self._in_flight if f.seq is not None]
+        for i, future in enumerate(framed):
+            if future.seq == seq:
+                for lost in framed[:i]:
+                    logging.debug('{0}: no reply to {1}'.format(self.name, repr(lost.command)))
+                    self._complete(lost, None)
+                line = None
+                if reply is not None:
+                    line = framing.decode_reply(*reply)
+                self._complete(future, line)
+                return
+        logging.debug('{0}: discarding stale reply frame {1}'.format(self.name, seq))
+
+    def _handle_line(self, line):
+        # text lines are replies to ASCII commands only, so framed commands are skipped when matching them.
+        if self.async_prefix and line.lstrip(self.prompt).startswith(self.async_prefix):
+            return super(FramedTransport, self)._handle_line(line)
+        with self._in_flight_lock:
+            text = [f for f in self._in_flight if f.seq is None]
+        if not text:
+            if line.strip(self.prompt + '\r\n'):
+                logging.debug('{0}: discarding unsolicited line {1}'.format(self.name, repr(line)))
+            return
+        self._handle_text_line(text[0], line)
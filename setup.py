@@ -11,5 +11,5 @@ setup(name='olfactometry',
       version='0.1dev',
       description="runs olfactometer devices from rinberg lab",
       author='Rinberg Lab',
-      packages=['olfactometry'], requires=['matplotlib', 'PyQt4', 'scipy', 'numpy']
+      packages=['olfactometry', 'olfactometry.core'], requires=['matplotlib', 'PyQt4', 'scipy', 'numpy']
       )
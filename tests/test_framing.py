@@ -0,0 +1,170 @@
+"""
+Tests for the binary framing of the Teensy protocol (olfactometry/framing.py) and for FramedTransport, which uses it.
+
+    python -m unittest discover tests
+"""
+
+import struct
+import unittest
+
+from olfactometry import framing
+from olfactometry.simulator import SimulatedTeensy
+from olfactometry.transport import FramedTransport
+
+COMMANDS = ['vialOn 1 5',
+            'vialOff 1 5',
+            'vial 1 4 on',
+            'vial 1 4 off',
+            'MFC 1 2',
+            'DMFC 1 1',
+            'DMFC 1 1 A32000',
+            'DMFCpoll 1 1 A',
+            'DMFCpoll 1 1 A 2 B']
+
+MFCS = [{'MFC_type': 'alicat_digital', 'capacity': 1000, 'gas': 'Air', 'address': 'A', 'arduino_port_num': 1}]
+
+
+def decode_frames(data):
+    return [item for kind, item in framing.FrameDecoder().feed(data) if kind == 'frame']
+
+
+class CrcTest(unittest.TestCase):
+
+    def test_check_value(self):
+        self.assertEqual(framing.crc16('123456789'), 0x29b1)  # CRC-16/CCITT-FALSE check value.
+
+    def test_empty(self):
+        self.assertEqual(framing.crc16(''), 0xffff)
+
+
+class CommandTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for seq, command in enumerate(COMMANDS):
+            opcode, frame = framing.encode_command(command, seq)
+            frames = decode_frames(frame)
+            self.assertEqual(frames, [(seq, opcode, frames[0][2])])
+            self.assertEqual(framing.decode_command(opcode, frames[0][2]), command)
+
+    def test_setpoint_round_trip(self):
+        opcode, frame = framing.encode_command('MFC 1 2 0.5', 7)
+        self.assertEqual(opcode, framing.SET_MFC)
+        (seq, opcode, payload), = decode_frames(frame)
+        verb, device, n, value = framing.decode_command(opcode, payload).split()
+        self.assertEqual((verb, device, n), ('MFC', '1', '2'))
+        self.assertAlmostEqual(float(value), .5, places=4)
+
+    def test_ascii_only_commands(self):
+        for command in ('seqRun 1', 'protocol', 'vialOn 1', 'vialOn x 5', 'MFC 1 2 1.5', 'MFC 1 2 -0.1',
+                        'vialOn 1 5 extra', 'vialOn 200 5', 'DMFC 1 1 ' + 'A' * 33):
+            self.assertIsNone(framing.encode_command(command, 0), command)
+
+    def test_invalid_payload(self):
+        self.assertIsNone(framing.decode_command(framing.VIAL_ON, '\x01'))
+        self.assertIsNone(framing.decode_command(framing.SET_MFC, '\x01\x02\x03'))
+        self.assertIsNone(framing.decode_command(0x3f, '\x01\x02'))
+
+
+class ReplyTest(unittest.TestCase):
+
+    def test_status_replies(self):
+        self.assertEqual(framing.decode_reply(framing.VIAL_ON, 0, ''), 'vial and dummy on\r\n')
+        self.assertEqual(framing.decode_reply(framing.SET_MFC, 0, ''), 'MFC set\r\n')
+        self.assertEqual(framing.decode_reply(framing.VIAL_ON, 3, ''), 'Error 3\r\n')
+
+    def test_data_replies(self):
+        self.assertEqual(framing.decode_reply(framing.SET_VIAL, 0, '\x01'), 'vial set\r\n')
+        self.assertEqual(framing.decode_reply(framing.SET_VIAL, 0, '\x00'), 'vial cleared\r\n')
+        self.assertEqual(framing.decode_reply(framing.READ_MFC, 0, struct.pack('<H', 65535)), '1.00\r\n')
+        self.assertEqual(framing.decode_reply(framing.POLL_D_MFC, 0, '1 A 0.5'), 'MFCpoll 1 A 0.5\r\n')
+
+
+class FrameDecoderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.frame = framing.encode_frame(12, framing.READ_MFC, '\x01\x02')
+
+    def test_frame(self):
+        self.assertEqual(framing.FrameDecoder().feed(self.frame), [('frame', (12, framing.READ_MFC, '\x01\x02'))])
+
+    def test_bad_crc(self):
+        corrupt = self.frame[:-1] + chr(ord(self.frame[-1]) ^ 0xff)
+        self.assertEqual(framing.FrameDecoder().feed(corrupt), [('bad', 12)])
+
+    def test_corrupt_payload(self):
+        corrupt = self.frame[:4] + '\x09' + self.frame[5:]
+        self.assertEqual(framing.FrameDecoder().feed(corrupt), [('bad', 12)])
+
+    def test_split_bytes(self):
+        decoder = framing.FrameDecoder()
+        items = []
+        for c in self.frame:
+            items.extend(decoder.feed(c))
+        self.assertEqual(items, [('frame', (12, framing.READ_MFC, '\x01\x02'))])
+
+    def test_text_around_frames(self):
+        items = framing.FrameDecoder().feed('!seq 0 50 0\r\n' + self.frame + 'ok\r\n' + self.frame)
+        self.assertEqual(items, [('text', '!seq 0 50 0\r\n'),
+                                 ('frame', (12, framing.READ_MFC, '\x01\x02')),
+                                 ('text', 'ok\r\n'),
+                                 ('frame', (12, framing.READ_MFC, '\x01\x02'))])
+
+    def test_stray_sync_byte(self):
+        # a sync byte followed by an impossible length is text, and the decoder resynchronizes on the next frame.
+        items = framing.FrameDecoder().feed(framing.SYNC + '\xff\x00\x00' + self.frame)
+        self.assertEqual(items, [('text', framing.SYNC), ('text', '\xff\x00\x00'),
+                                 ('frame', (12, framing.READ_MFC, '\x01\x02'))])
+
+    def test_incomplete_frame(self):
+        decoder = framing.FrameDecoder()
+        self.assertEqual(decoder.feed(self.frame[:-2]), [])
+        self.assertEqual(decoder.feed(self.frame[-2:]), [('frame', (12, framing.READ_MFC, '\x01\x02'))])
+
+    def test_seq_range(self):
+        for seq in (0, 1, 254, 255):
+            self.assertEqual(decode_frames(framing.encode_frame(seq, framing.VIAL_ON, '\x01\x05'))[0][0], seq)
+
+
+class FramedTransportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.teensy = SimulatedTeensy(slave_index=1, mfcs=MFCS, latency=0., alicat_latency=0.)
+        self.transport = FramedTransport(self.teensy, terminator='\r', echo=True, async_prefix='!', name='test')
+
+    def tearDown(self):
+        self.transport.close()
+
+    def test_negotiate(self):
+        self.assertTrue(self.transport.negotiate())
+
+    def test_ascii_firmware(self):
+        self.transport.close()
+        self.teensy = SimulatedTeensy(slave_index=1, mfcs=MFCS, latency=0., binary_protocol=False)
+        self.transport = FramedTransport(self.teensy, terminator='\r', echo=True, async_prefix='!', name='test')
+        self.assertFalse(self.transport.negotiate())
+        self.assertEqual(self.transport.send('vialOn 1 5').result(), 'vial and dummy on\r\n')
+
+    def test_seq_wrap(self):
+        self.transport.negotiate()
+        commands = ['vialOn 1 5', 'vialOff 1 5'] * 150  # more than 256 frames, so the sequence number wraps.
+        replies = [f.result() for f in self.transport.send_many(commands)]
+        self.assertEqual(replies, ['vial and dummy on\r\n', 'vial and dummy off\r\n'] * 150)
+        self.assertEqual(self.transport._seq, 300 % 256)
+
+    def test_mixed_ascii_and_frames(self):
+        self.transport.negotiate()
+        futures = self.transport.send_many(['vialOn 1 5', 'protocol', 'vialOff 1 5'])
+        replies = [f.result() for f in futures]
+        self.assertEqual(replies[0], 'vial and dummy on\r\n')
+        self.assertTrue(replies[1].startswith('protocol binary'))
+        self.assertEqual(replies[2], 'vial and dummy off\r\n')
+        self.assertIsNone(futures[1].seq)
+
+    def test_stale_frame_is_discarded(self):
+        self.transport.negotiate()
+        self.transport._frame_reply(99, (framing.VIAL_ON, 0, ''))  # no command was sent with this number.
+        self.assertEqual(self.transport.send('vialOn 1 5').result(), 'vial and dummy on\r\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,217 @@
+"""
+Tests for the threaded serial transport (olfactometry/transport.py), driven by a fake serial port.
+
+    python -m unittest discover tests
+"""
+
+import threading
+import time
+import unittest
+
+from olfactometry.transport import SerialTransport
+
+
+class FakePort(object):
+    """
+    Serial port whose input is written by the test with feed(). Written commands are recorded in writes.
+    """
+
+    def __init__(self):
+        self.timeout = None
+        self.writes = []
+        self.closed = False
+        self._input = ''
+        self._cond = threading.Condition()
+
+    def feed(self, data):
+        with self._cond:
+            self._input += data
+            self._cond.notify_all()
+
+    def write(self, data):
+        with self._cond:
+            self.writes.append(data)
+            self._cond.notify_all()
+
+    def wait_for_writes(self, n, timeout=1.):
+        deadline = time.time() + timeout
+        with self._cond:
+            while len(self.writes) < n and time.time() < deadline:
+                self._cond.wait(deadline - time.time())
+            return len(self.writes)
+
+    def inWaiting(self):
+        with self._cond:
+            return len(self._input)
+
+    def read(self, n=1):
+        with self._cond:
+            if not self._input:
+                self._cond.wait(self.timeout)
+            data, self._input = self._input[:n], self._input[n:]
+            return data
+
+    def close(self):
+        self.closed = True
+
+
+def frame(address):
+    return '{0} +014.70 +025.00 +011.000 +011.000 +010.000 Air\r'.format(address)
+
+
+def unit(address):
+    return lambda line: line.split()[:1] == [address]
+
+
+class TransportTestCase(unittest.TestCase):
+    echo = False
+    eol = '\n'
+    terminator = '\r'
+
+    def setUp(self):
+        self.port = FakePort()
+        self.transport = self.make_transport()
+
+    def make_transport(self, **kwargs):
+        params = dict(terminator=self.terminator, eol=self.eol, echo=self.echo, reply_timeout=.2,
+                      read_timeout=.01, name='test')
+        params.update(kwargs)
+        return SerialTransport(self.port, **params)
+
+    def tearDown(self):
+        self.transport.close()
+
+
+class EchoTest(TransportTestCase):
+    echo = True
+
+    def test_reply(self):
+        future = self.transport.send('vialOn 1 5')
+        self.port.wait_for_writes(1)
+        self.port.feed('>vialOn 1 5\r\nvial and dummy on\r\n')
+        self.assertEqual(future.result(1.), 'vial and dummy on\r\n')
+        self.assertEqual(self.port.writes, ['vialOn 1 5\r'])
+
+    def test_stale_lines_before_echo(self):
+        future = self.transport.send('MFC 1 1')
+        self.port.wait_for_writes(1)
+        self.port.feed('0.50\r\n>vialOff 1 5\r\nvial and dummy off\r\n>MFC 1 1\r\n0.25\r\n')
+        self.assertEqual(future.result(1.), '0.25\r\n')
+
+    def test_prompt_before_reply(self):
+        # the device prompts for the next command without replying to the first one.
+        first = self.transport.send('vialOn 1 5')
+        second = self.transport.send('vialOff 1 5')
+        self.port.wait_for_writes(2)
+        self.port.feed('>vialOn 1 5\r\n>vialOff 1 5\r\nvial and dummy off\r\n')
+        self.assertIsNone(first.result(1.))
+        self.assertEqual(second.result(1.), 'vial and dummy off\r\n')
+
+    def test_async_lines(self):
+        lines = []
+        self.transport.async_prefix = '!'
+        self.transport.add_async_listener(lines.append)
+        future = self.transport.send('seqRun 1')
+        self.port.wait_for_writes(1)
+        self.port.feed('>seqRun 1\r\n>!seq 0 50 0\r\nseq started\r\n!seqDone 1\r\n')
+        self.assertEqual(future.result(1.), 'seq started\r\n')
+        deadline = time.time() + 1.
+        while len(lines) < 2 and time.time() < deadline:
+            time.sleep(.01)
+        self.assertEqual(lines, ['!seq 0 50 0', '!seqDone 1'])
+
+
+class NoEchoTest(TransportTestCase):
+    eol = '\r'
+    terminator = ''
+
+    def test_reply_in_order(self):
+        futures = self.transport.send_many(['A\r', 'B\r'])
+        self.port.wait_for_writes(2)
+        self.port.feed(frame('A') + frame('B'))
+        self.assertEqual([f.result(1.) for f in futures], [frame('A'), frame('B')])
+
+    def test_timeout(self):
+        t = time.time()
+        future = self.transport.send('A\r')
+        self.assertIsNone(future.result(1.))
+        self.assertTrue(future.done())
+        self.assertLess(time.time() - t, .2 + .5)
+
+    def test_late_reply_after_timeout(self):
+        first = self.transport.send('A\r', unit('A'))
+        self.assertIsNone(first.result(1.))
+        second = self.transport.send('B\r', unit('B'))
+        self.port.wait_for_writes(2)
+        self.port.feed(frame('A') + frame('B'))  # the reply to A arrives after it timed out.
+        self.assertEqual(second.result(1.), frame('B'))
+
+    def test_late_reply_without_match(self):
+        # without a match function, the next line is the reply to the oldest command.
+        self.assertIsNone(self.transport.send('A\r').result(1.))
+        second = self.transport.send('B\r')
+        self.port.wait_for_writes(2)
+        self.port.feed(frame('A'))
+        self.assertEqual(second.result(1.), frame('A'))
+
+    def test_abandoned_future(self):
+        # the caller stops waiting before the reply arrives. The reply still goes to its command, not the next one.
+        first = self.transport.send('A\r', unit('A'))
+        self.assertIsNone(first.result(.01))
+        second = self.transport.send('B\r', unit('B'))
+        self.port.wait_for_writes(2)
+        self.port.feed(frame('A') + frame('B'))
+        self.assertEqual(second.result(1.), frame('B'))
+        self.assertEqual(first.result(1.), frame('A'))
+
+    def test_unsolicited_line(self):
+        self.port.feed(frame('A'))
+        while self.port.inWaiting():  # the line is read (and discarded) before the command is sent.
+            time.sleep(.01)
+        time.sleep(.05)
+        future = self.transport.send('B\r')
+        self.port.wait_for_writes(1)
+        self.port.feed(frame('B'))
+        self.assertEqual(future.result(1.), frame('B'))
+
+    def test_window(self):
+        self.transport.close()
+        self.port = FakePort()
+        self.transport = self.make_transport(max_in_flight=2, reply_timeout=5.)
+        futures = self.transport.send_many(['A\r', 'B\r', 'C\r'])
+        self.port.wait_for_writes(2)
+        self.assertEqual(self.port.wait_for_writes(3, .1), 2)
+        self.port.feed(frame('A'))
+        self.assertEqual(self.port.wait_for_writes(3), 3)
+        self.port.feed(frame('B') + frame('C'))
+        self.assertEqual([f.result(1.) for f in futures], [frame('A'), frame('B'), frame('C')])
+
+    def test_close(self):
+        self.transport.close()
+        self.port = FakePort()
+        self.transport = self.make_transport(max_in_flight=1, reply_timeout=5.)
+        futures = self.transport.send_many(['A\r', 'B\r'])  # B is still queued behind the window.
+        self.port.wait_for_writes(1)
+        self.transport.close()
+        self.assertEqual([f.done() for f in futures], [True, True])
+        self.assertEqual([f.result() for f in futures], [None, None])
+        self.assertTrue(self.port.closed)
+        self.assertIsNone(self.transport.send('A\r').result(1.))
+
+    def test_callback(self):
+        replies = []
+        future = self.transport.send('A\r')
+        future.add_done_callback(lambda f: replies.append(f.result()))
+        self.port.wait_for_writes(1)
+        self.port.feed(frame('A'))
+        future.result(1.)
+        deadline = time.time() + 1.  # callbacks run on the reader thread, after the future is resolved.
+        while not replies and time.time() < deadline:
+            time.sleep(.01)
+        self.assertEqual(replies, [frame('A')])
+        future.add_done_callback(lambda f: replies.append(f.result()))  # already resolved: called immediately.
+        self.assertEqual(replies, [frame('A'), frame('A')])
+
+
+if __name__ == '__main__':
+    unittest.main()